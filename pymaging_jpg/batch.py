@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2012, Jonas Obrist
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the Jonas Obrist nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL JONAS OBRIST BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Decoding of many images on a pool of processes, an image per task, to get
+around the GIL for bulk ingestion.
+
+The pixels of a decoded image come back to the calling process in a block of
+multiprocessing.shared_memory (Python 3.8 and later) instead of being pickled
+through the result pipe; the block is copied out and freed as the result is
+yielded. Without shared memory they are pickled.
+
+An image that can't be decoded gives a result with its error rather than
+raising, so one broken file doesn't stop the batch.
+"""
+from collections import namedtuple
+import mmap
+import multiprocessing
+
+from pymaging_jpg.compat import as_buffer, text_type
+from pymaging_jpg.pool import worker_pool
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    shared_memory = None
+
+available = shared_memory is not None
+
+# Number of images in flight per worker, queued or being decoded
+TASKS_PER_WORKER = 2
+
+# the decoding of source, the item at index of the input of decode_many:
+# width * height pixels of the mode, or None and the exception in error
+DecodeResult = namedtuple('DecodeResult', ['index', 'source', 'width', 'height', 'pixels', 'error'])
+
+
+def is_path(source):
+    """a path is text (unicode on Python 2) or an os.PathLike object, other
+    sources are the jpeg data itself"""
+    return isinstance(source, text_type) or hasattr(source, '__fspath__')
+
+
+def picklable(source):
+    """source as it can be sent to a worker; memoryviews and mmaps can't be"""
+    if is_path(source) or isinstance(source, (bytes, bytearray)):
+        return source
+    source = as_buffer(source)
+    if isinstance(source, mmap.mmap):
+        return source[:]
+    if isinstance(source, memoryview):
+        return source.tobytes()
+    return source
+
+
+def to_shared(pixels):
+    """copy pixels to a new shared memory block, returns its (name, size);
+    the block is freed by from_shared in the process that gets the result"""
+    block = shared_memory.SharedMemory(create=True, size=len(pixels))
+    try:
+        block.buf[:len(pixels)] = pixels
+        return block.name, len(pixels)
+    finally:
+        block.close()
+
+
+def from_shared(shared):
+    """the pixels in the shared memory block of to_shared, which is freed"""
+    name, size = shared
+    block = shared_memory.SharedMemory(name)
+    try:
+        return bytearray(block.buf[:size])
+    finally:
+        block.close()
+        block.unlink()
+
+
+def decode_item(source, mode, scale, use_numpy, shared):
+    """decode one image, runs in the workers; returns (width, height, pixels,
+    error), pixels being the (name, size) of a shared memory block if shared"""
+    try:
+        with worker_pool(use_numpy).decoder() as decoder:
+            if is_path(source):
+                with open(source, 'rb') as fobj:
+                    pixels = decoder.decode_stream(fobj, scale=scale, mode=mode)
+            else:
+                pixels = decoder.decode(source, scale=scale, mode=mode)
+            width, height = decoder.out_width, decoder.out_height
+        if shared:
+            pixels = to_shared(pixels)
+    except Exception as error:
+        return None, None, None, error
+    return width, height, pixels, None
+
+
+def result(future, index, source):
+    """the DecodeResult of the future of a decode_item call"""
+    try:
+        width, height, pixels, error = future.result()
+    except Exception as error:
+        # the worker died, or the error of the image couldn't be pickled
+        return DecodeResult(index, source, None, None, None, error)
+    if error is None and available:
+        pixels = from_shared(pixels)
+    return DecodeResult(index, source, width, height, pixels, error)
+
+
+def decode_many(sources, workers=None, mode='RGB', scale=1, use_numpy=None, executor=None):
+    """
+    Decode the images of sources, paths or jpeg data in bytes, bytearrays,
+    memoryviews or mmaps, on executor, a concurrent.futures.ProcessPoolExecutor
+    with workers processes by default, and yield a DecodeResult per image as
+    they are done, so not in the order of sources. Paths are opened by the
+    workers, jpeg data is sent to them.
+    mode: 'RGB', 'BGR', 'RGBA' or 'L', see TonyJpegDecoder.decode
+    scale: 1, 2, 4 or 8, decode the images at 1/scale of their size
+    sources may be a generator, only a few images per worker are taken from it
+    ahead of the results.
+    """
+    if mode not in ('RGB', 'BGR', 'RGBA', 'L'):
+        raise ValueError("Unsupported mode for decode_many: %r" % mode)
+    from concurrent.futures import FIRST_COMPLETED, wait
+    if available:
+        # started before the workers, so they share it: otherwise the tracker
+        # of a worker frees the blocks it made when the worker exits
+        resource_tracker.ensure_running()
+    workers = workers or multiprocessing.cpu_count()
+    own_executor = executor is None
+    if own_executor:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(workers)
+    sources = enumerate(sources)
+    pending = {}
+    try:
+        while True:
+            for index, source in sources:
+                future = executor.submit(decode_item, picklable(source), mode, scale,
+                                         use_numpy, available)
+                pending[future] = index, source
+                if len(pending) >= workers * TASKS_PER_WORKER:
+                    break
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, source = pending.pop(future)
+                yield result(future, index, source)
+    finally:
+        # stopped early, free the shared memory of the images not yielded
+        for future in pending:
+            if not future.cancel():
+                result(future, *pending[future])
+        if own_executor:
+            executor.shutdown()
+
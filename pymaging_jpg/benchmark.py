@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2012, Jonas Obrist
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the Jonas Obrist nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL JONAS OBRIST BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Decoding and encoding benchmarks on a synthetic corpus, to tell whether a
+change makes the decoder or the encoder faster or slower:
+
+    python -m pymaging_jpg.benchmark --save baseline.json
+    python -m pymaging_jpg.benchmark --compare baseline.json
+
+The corpus is made by the encoder of the package from the same pixels every
+time, in several sizes, qualities, chroma subsamplings and restart
+intervals. Each image is timed through jpg.decode, the best of a few runs,
+in megapixels per second, with the peak memory of another decode, traced
+with tracemalloc, which takes much longer than the others. Another decode
+with the pure Python reconstruction times the stages of the decoder, those
+of stats.STAGES: the headers, the entropy decoding, the inverse DCT, the
+color conversion, and the output assembly, the rest of the decoding: the
+tile loop and the copies into the output buffer. The timers add to the
+stages they time, so the breakdown is for their share of the decoding, not
+for their absolute times. The
+encoding of each image is timed as well, the best of a few runs, as another
+result named after the image with an -encode suffix.
+"""
+from __future__ import print_function
+from pymaging_jpg.encoder import TonyJpegEncoder
+from pymaging_jpg.jpg import decode
+from pymaging_jpg.raw import TonyJpegDecoder
+from pymaging_jpg.stats import STAGES, timed, timer
+from collections import namedtuple
+import argparse
+import io
+import json
+import sys
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+SIZES = {
+    'tiny': (48, 32),
+    'small': (160, 120),
+    'medium': (640, 480),
+    'large': (1600, 1200),
+}
+DEFAULT_SIZES = ('small', 'medium')
+QUALITIES = (75, 95)
+SUBSAMPLINGS = ('4:2:0', '4:4:4')
+# no restart interval, and one every MCU row
+RESTART_ROWS = (0, 1)
+DEFAULT_REPEAT = 3
+# slower than the baseline by more than that is a regression
+DEFAULT_TOLERANCE = 0.10
+
+Case = namedtuple('Case', ['name', 'width', 'height', 'quality', 'subsampling', 'restart_rows'])
+
+# seconds is the best time of jpg.decode, peak_memory in bytes, None without
+# tracemalloc, and stages the {stage: seconds} of the breakdown; for the
+# encoding, seconds is the best time of the encoder, without the others
+Result = namedtuple('Result', ['name', 'megapixels', 'seconds', 'mpps', 'peak_memory', 'stages'])
+
+
+def synthetic_pixels(width, height, seed=1):
+    """RGB pixels of a photo-like image, the same for the same arguments:
+    smooth gradients with some texture, and noise from a linear congruential
+    generator"""
+    pixels = bytearray(width * height * 3)
+    state = seed
+    pos = 0
+    for y in range(height):
+        for x in range(width):
+            state = (state * 1103515245 + 12345) & 0x7fffffff
+            noise = (state >> 16) & 15
+            pixels[pos] = (x * 255 // width + noise) & 255
+            pixels[pos + 1] = (y * 255 // height + ((x >> 3) ^ (y >> 3)) + noise) & 255
+            pixels[pos + 2] = ((x + y) * 127 // (width + height) + 64 + noise) & 255
+            pos += 3
+    return pixels
+
+
+def cases(sizes=DEFAULT_SIZES):
+    """the Cases of the corpus, for the SIZES named"""
+    for size in sizes:
+        width, height = SIZES[size]
+        for quality in QUALITIES:
+            for subsampling in SUBSAMPLINGS:
+                for restart_rows in RESTART_ROWS:
+                    name = '%s-q%d-%s%s' % (size, quality, subsampling.replace(':', ''),
+                                            '-restart' if restart_rows else '')
+                    yield Case(name, width, height, quality, subsampling, restart_rows)
+
+
+def corpus(sizes=DEFAULT_SIZES):
+    """yields the Cases of the corpus, their pixels and their jpeg streams"""
+    pixels = {}
+    for case in cases(sizes):
+        key = case.width, case.height
+        if key not in pixels:
+            pixels[key] = synthetic_pixels(case.width, case.height)
+        encoder = TonyJpegEncoder(case.quality, case.subsampling, case.restart_rows)
+        yield case, pixels[key], encoder.encode(pixels[key], case.width, case.height)
+
+
+def time_encode(case, pixels, repeat=DEFAULT_REPEAT):
+    """the best time of the encoding of the pixels of case in seconds"""
+    best = None
+    for _ in range(repeat):
+        encoder = TonyJpegEncoder(case.quality, case.subsampling, case.restart_rows)
+        start = timer()
+        encoder.encode(pixels, case.width, case.height)
+        seconds = timer() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best
+
+
+def time_decode(jpegsrc, repeat=DEFAULT_REPEAT):
+    """the best time of jpg.decode of jpegsrc in seconds"""
+    best = None
+    for _ in range(repeat):
+        start = timer()
+        image = decode(io.BytesIO(jpegsrc))
+        seconds = timer() - start
+        if image is None:
+            raise ValueError("The decoding failed")
+        if best is None or seconds < best:
+            best = seconds
+    return best
+
+
+def peak_memory(jpegsrc):
+    """the peak of the memory allocated by jpg.decode of jpegsrc in bytes,
+    None without tracemalloc"""
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        decode(io.BytesIO(jpegsrc))
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def stage_times(jpegsrc):
+    """the {stage: seconds} of a decode of jpegsrc with the pure Python
+    reconstruction, see STAGES; output has the time of the rest"""
+    decoder = TonyJpegDecoder(use_numpy=False)
+    totals = dict((stage, 0.0) for stage, methods in STAGES)
+    # the methods are looked up on the decoder for each call, the timed ones
+    # of the instance come first
+    for stage, methods in STAGES:
+        for name in methods:
+            setattr(decoder, name, timed(getattr(decoder, name), lambda: totals, stage))
+    start = timer()
+    decoder.decode(jpegsrc)
+    totals['output'] = max(timer() - start - sum(totals.values()), 0.0)
+    return totals
+
+
+def run(sizes=DEFAULT_SIZES, repeat=DEFAULT_REPEAT, memory=True, report=None):
+    """the Results of the corpus of sizes, without peak memory unless memory;
+    report, if given, is called with each one as it comes"""
+    results = []
+    for case, pixels, jpegsrc in corpus(sizes):
+        megapixels = case.width * case.height / 1e6
+        seconds = time_decode(jpegsrc, repeat)
+        decoding = Result(case.name, megapixels, seconds, megapixels / seconds,
+                          peak_memory(jpegsrc) if memory else None, stage_times(jpegsrc))
+        seconds = time_encode(case, pixels, repeat)
+        encoding = Result(case.name + '-encode', megapixels, seconds, megapixels / seconds, None, {})
+        for result in (decoding, encoding):
+            if report is not None:
+                report(result)
+            results.append(result)
+    return results
+
+
+def save_results(results, fileobj):
+    """write results as a baseline for compare"""
+    json.dump({'version': 1, 'results': dict((result.name, result._asdict()) for result in results)},
+              fileobj, indent=2, sort_keys=True)
+
+
+def load_baseline(fileobj):
+    """the {name: Result} of a file of save_results"""
+    data = json.load(fileobj)
+    if data.get('version') != 1:
+        raise ValueError("Unsupported baseline version: %r" % data.get('version'))
+    return dict((name, Result(**fields)) for name, fields in data['results'].items())
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """the (name, seconds / baseline seconds) of the results that are in the
+    baseline, and the names of those slower by more than tolerance"""
+    ratios = []
+    regressions = []
+    for result in results:
+        if result.name not in baseline:
+            continue
+        ratio = result.seconds / baseline[result.name].seconds
+        ratios.append((result.name, ratio))
+        if ratio > 1 + tolerance:
+            regressions.append(result.name)
+    return ratios, regressions
+
+
+def format_result(result):
+    total = sum(result.stages.values()) or 1.0
+    stages = ' '.join('%s %2.0f%%' % (stage, result.stages[stage] * 100 / total)
+                      for stage in [stage for stage, methods in STAGES] + ['output']
+                      if stage in result.stages)
+    memory = '%7.0f KiB' % (result.peak_memory / 1024.0) if result.peak_memory is not None else '        n/a'
+    return ('%-28s %8.3f s %7.3f MP/s %s  %s' % (result.name, result.seconds, result.mpps, memory, stages)).rstrip()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m pymaging_jpg.benchmark',
+                                     description="Benchmark jpg.decode and the encoder on a synthetic corpus.")
+    parser.add_argument('--sizes', default=','.join(DEFAULT_SIZES),
+                        help="comma separated sizes among %s" % ', '.join(sorted(SIZES)))
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help="time the best of that many decodes and encodes")
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help="skip the peak memory, tracemalloc makes a decode tens of times slower")
+    parser.add_argument('--save', metavar='FILE', help="save the results as a baseline")
+    parser.add_argument('--compare', metavar='FILE', help="compare the results with a baseline")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="slowdown over the baseline that fails the comparison")
+    args = parser.parse_args(argv)
+    sizes = args.sizes.split(',')
+    for size in sizes:
+        if size not in SIZES:
+            parser.error("unknown size: %s" % size)
+    report = lambda result: print(format_result(result))
+    results = run(sizes, args.repeat, args.memory, report)
+    if args.save:
+        with open(args.save, 'w') as fileobj:
+            save_results(results, fileobj)
+    if args.compare:
+        with open(args.compare) as fileobj:
+            ratios, regressions = compare(results, load_baseline(fileobj), args.tolerance)
+        for name, ratio in ratios:
+            print('%-28s %+6.1f%%%s' % (name, (ratio - 1) * 100, '  REGRESSION' if name in regressions else ''))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2012, Jonas Obrist
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the Jonas Obrist nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL JONAS OBRIST BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Reading the quantized DCT coefficients of a jpeg instead of its pixels, for
+tools that work in the DCT domain: deduplication, forensics, requantization,
+lossless transforms; and writing them back as a jpeg.
+
+Only the entropy decoder and encoder run; there is no dequantization,
+inverse DCT or color conversion, so nothing is lost.
+"""
+from pymaging_jpg.encoder import TonyJpegEncoder, count_blocks, marker, new_counts
+from pymaging_jpg.raw import (M_APP0, M_DHT, M_DQT, M_EOI, M_SOF0, M_SOI, M_SOS,
+    TonyJpegDecoder, CHUNK_SIZE, jpeg_natural_order)
+from array import array
+from collections import namedtuple
+import struct
+
+# see read_coefficients
+JpegCoefficients = namedtuple('JpegCoefficients', [
+    'width', 'height', 'progressive', 'components'
+])
+
+# the blocks of a component are in rows of width_in_blocks, height_in_blocks
+# rows, in whole MCUs: the blocks past the edge of the image are padding.
+# coefficients holds the 64 coefficients of each block, in natural (row by
+# row) order, as signed 16 bit integers; quant_table the 64 entries of the
+# quantization table of the component, in natural order as well
+ComponentCoefficients = namedtuple('ComponentCoefficients', [
+    'component_id', 'h_samp_factor', 'v_samp_factor', 'width_in_blocks',
+    'height_in_blocks', 'quant_table', 'coefficients'
+])
+
+
+def read_coefficients(fileobj, chunk_size=CHUNK_SIZE):
+    """entropy decode the jpeg in fileobj, chunk_size bytes at a time, and
+    return its quantized dct coefficients as JpegCoefficients"""
+    decoder = TonyJpegDecoder(use_numpy=False)
+    decoder.set_input(fileobj, chunk_size)
+    decoder.read_headers()
+    decoder.start_output()
+    buffers = []
+    for comp in decoder.comp_info:
+        width = decoder.cxTile * comp.h_samp_factor
+        height = decoder.cyTile * comp.v_samp_factor
+        buffers.append((width, height, array('h', [0]) * (width * height * 64)))
+    if decoder.Progressive:
+        # the scans add up in the coefficient buffer of the decoder
+        decoder.decode_scans()
+        for (width, height, coefficients), blocks in zip(buffers, decoder.coef_buffer):
+            for pos, coeff in enumerate(blocks):
+                coefficients[pos * 64:pos * 64 + 64] = array('h', coeff)
+    else:
+        # where each block of an MCU goes: its component, and its row and
+        # column in the MCU
+        layout = []
+        for comp in decoder.comp_info:
+            for v in range(comp.v_samp_factor):
+                for h in range(comp.h_samp_factor):
+                    layout.append((comp.component_index, comp.v_samp_factor,
+                                   comp.h_samp_factor, v, h))
+        for tile in range(decoder.cxTile * decoder.cyTile):
+            decoder.fill_tile_input()
+            yTile, xTile = divmod(tile, decoder.cxTile)
+            for coeff, (ci, vsamp, hsamp, v, h) in zip(decoder.decode_one_tile(), layout):
+                width, height, coefficients = buffers[ci]
+                pos = ((yTile * vsamp + v) * width + xTile * hsamp + h) * 64
+                coefficients[pos:pos + 64] = array('h', coeff)
+    components = [
+        ComponentCoefficients(comp.component_id, comp.h_samp_factor, comp.v_samp_factor,
+                              width, height, list(decoder.qtables[comp.quant_tbl_no]),
+                              coefficients)
+        for comp, (width, height, coefficients) in zip(decoder.comp_info, buffers)
+    ]
+    return JpegCoefficients(decoder.Width, decoder.Height, decoder.Progressive, components)
+
+
+def zigzag_blocks(coefficients):
+    """the quantized blocks of JpegCoefficients in the order of a baseline
+    scan, interleaved if there are several components, as (coefficients in
+    zigzag order, component) pairs, see TonyJpegEncoder.encode_blocks"""
+    zigzag = jpeg_natural_order[:64]
+    components = coefficients.components
+    first = components[0]
+    cxMcu = first.width_in_blocks // first.h_samp_factor
+    cyMcu = first.height_in_blocks // first.v_samp_factor
+    for yMcu in range(cyMcu):
+        for xMcu in range(cxMcu):
+            for ci, comp in enumerate(components):
+                h, v = comp.h_samp_factor, comp.v_samp_factor
+                blocks = comp.coefficients
+                for y in range(yMcu * v, yMcu * v + v):
+                    for x in range(xMcu * h, xMcu * h + h):
+                        pos = (y * comp.width_in_blocks + x) * 64
+                        yield [blocks[pos + i] for i in zigzag], ci
+
+
+def write_coefficients(coefficients, optimize=False):
+    """the baseline JFIF stream of JpegCoefficients, Huffman coded with the
+    standard tables, or with tables optimized for the image
+
+    The grids of blocks must be in whole MCUs, as read_coefficients gives
+    them; a single component is coded as a grayscale image, with sampling
+    factors of 1.
+    """
+    components = coefficients.components
+    if len(components) not in (1, 3):
+        raise ValueError("Unsupported number of components: %d" % len(components))
+    if len(components) == 1:
+        components = [components[0]._replace(h_samp_factor=1, v_samp_factor=1)]
+        coefficients = coefficients._replace(components=components)
+    encoder = TonyJpegEncoder()
+    if optimize:
+        counts = count_blocks(zigzag_blocks(coefficients), new_counts())
+        if len(components) == 1:
+            # the chrominance tables are written but not used
+            counts[2:] = counts[:2]
+        encoder.set_optimal_tables(counts)
+    # the distinct quantization tables, in zigzag order
+    qtables = []
+    for comp in components:
+        qtbl = [comp.quant_table[i] for i in jpeg_natural_order[:64]]
+        if qtbl not in qtables:
+            qtables.append(qtbl)
+    segments = [struct.pack('>BB', 0xFF, M_SOI)]
+    # JFIF 1.01, no density unit, aspect ratio 1:1, no thumbnail
+    segments.append(marker(M_APP0, b'JFIF\x00' + struct.pack('>BBBHHBB', 1, 1, 0, 1, 1, 0, 0)))
+    dqt = bytearray()
+    for index, qtbl in enumerate(qtables):
+        dqt.append(index)
+        dqt.extend(qtbl)
+    segments.append(marker(M_DQT, bytes(dqt)))
+    sof = bytearray(struct.pack('>BHHB', 8, coefficients.height, coefficients.width,
+                                len(components)))
+    sos = bytearray([len(components)])
+    for ci, comp in enumerate(components):
+        qtbl = [comp.quant_table[i] for i in jpeg_natural_order[:64]]
+        sof.extend((comp.component_id, (comp.h_samp_factor << 4) | comp.v_samp_factor,
+                    qtables.index(qtbl)))
+        # the luminance tables for the first component
+        sos.extend((comp.component_id, 0x11 if ci else 0x00))
+    sos.extend((0, 63, 0))
+    segments.append(marker(M_SOF0, bytes(sof)))
+    segments.append(marker(M_DHT, encoder.dht()))
+    segments.append(marker(M_SOS, bytes(sos)))
+    segments.append(encoder.encode_blocks(zigzag_blocks(coefficients)))
+    segments.append(struct.pack('>BB', 0xFF, M_EOI))
+    return b''.join(segments)
@@ -23,11 +23,61 @@
 # ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import binascii
+import mmap
 import sys
 
 
 if sys.version < '3':
+    text_type = unicode
+
     def byteord(thing):
         return ord(thing)
+
+    def as_buffer(data):
+        """data as a bytearray, the bytes type that indexes to ints"""
+        if isinstance(data, bytearray):
+            return data
+        if isinstance(data, memoryview):
+            return bytearray(data.tobytes())
+        # str, buffer, mmap...
+        return bytearray(data[:])
+
+    def bytes_to_int(data):
+        return int(binascii.hexlify(data), 16)
+
+    def int_to_bytes(value, length):
+        return binascii.unhexlify('%0*x' % (length * 2, value))
 else:
+    text_type = str
     byteord = lambda thing: thing
+
+    def as_buffer(data):
+        """data as an object that indexes to ints, without copying it: bytes,
+        bytearray and mmap as they are, and the one a memoryview of the whole
+        of it is of, as they have find(); other contiguous buffers, eg. a
+        slice of a memoryview of an mmap, as a memoryview of bytes, see
+        view_find; the others are copied"""
+        if isinstance(data, (bytes, bytearray, mmap.mmap)):
+            return data
+        view = memoryview(data)
+        if not view.c_contiguous:
+            return view.tobytes()
+        if (isinstance(view.obj, (bytes, bytearray, mmap.mmap))
+                and view.nbytes == len(view.obj)):
+            return view.obj
+        if view.format != 'B' or view.ndim != 1:
+            view = view.cast('B')
+        return view
+
+    def bytes_to_int(data):
+        return int.from_bytes(data, 'big')
+
+    def int_to_bytes(value, length):
+        return value.to_bytes(length, 'big')
+
+
+def view_find(view, byte, start, end):
+    """view.find(byte, start, end) for a memoryview, which has no find()"""
+    pos = view[start:end].tobytes().find(byte)
+    return pos + start if pos >= 0 else -1
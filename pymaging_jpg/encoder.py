@@ -0,0 +1,633 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2012, Jonas Obrist
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the Jonas Obrist nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL JONAS OBRIST BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Baseline sequential JPEG encoder, the counterpart of raw.TonyJpegDecoder.
+
+The RGB samples are converted to YCbCr, optionally subsampled 4:2:0,
+transformed by the AA&N forward DCT of the IJG jfdctfst.c, quantized with
+quality scaled versions of the tables of the JPEG spec section K.1 and
+Huffman coded with the standard tables of section K.3, or with tables
+optimized for the image from a first pass over it.
+
+With restart intervals, the image is coded in strips of MCU rows that do
+not depend on each other; pymaging_jpg.parallel encodes them on several
+processes.
+"""
+from pymaging_jpg.compat import int_to_bytes
+from pymaging_jpg.raw import (M_APP0, M_DHT, M_DQT, M_DRI, M_EOI, M_RST0, M_SOF0, M_SOI, M_SOS,
+    MULTIPLY, aanscales, jpeg_natural_order, quality_scaled_table,
+    std_chrominance_quant_tbl, std_luminance_quant_tbl)
+import struct
+
+DEFAULT_QUALITY = 75
+DEFAULT_SUBSAMPLING = '4:2:0'
+# horizontal and vertical sampling factor of Y, by chroma subsampling
+SUBSAMPLINGS = {'4:4:4': 1, '4:2:0': 2}
+
+# The standard Huffman tables of the JPEG spec section K.3, as in a DHT
+# segment: the counts of the codes of 1 to 16 bits, then the symbols.
+bits_dc_luminance = [0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0]
+val_dc_luminance = list(range(12))
+
+bits_dc_chrominance = [0, 3, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0]
+val_dc_chrominance = list(range(12))
+
+bits_ac_luminance = [0, 2, 1, 3, 3, 2, 4, 3, 5, 5, 4, 4, 0, 0, 1, 0x7d]
+val_ac_luminance = [
+    0x01, 0x02, 0x03, 0x00, 0x04, 0x11, 0x05, 0x12,
+    0x21, 0x31, 0x41, 0x06, 0x13, 0x51, 0x61, 0x07,
+    0x22, 0x71, 0x14, 0x32, 0x81, 0x91, 0xa1, 0x08,
+    0x23, 0x42, 0xb1, 0xc1, 0x15, 0x52, 0xd1, 0xf0,
+    0x24, 0x33, 0x62, 0x72, 0x82, 0x09, 0x0a, 0x16,
+    0x17, 0x18, 0x19, 0x1a, 0x25, 0x26, 0x27, 0x28,
+    0x29, 0x2a, 0x34, 0x35, 0x36, 0x37, 0x38, 0x39,
+    0x3a, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48, 0x49,
+    0x4a, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58, 0x59,
+    0x5a, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68, 0x69,
+    0x6a, 0x73, 0x74, 0x75, 0x76, 0x77, 0x78, 0x79,
+    0x7a, 0x83, 0x84, 0x85, 0x86, 0x87, 0x88, 0x89,
+    0x8a, 0x92, 0x93, 0x94, 0x95, 0x96, 0x97, 0x98,
+    0x99, 0x9a, 0xa2, 0xa3, 0xa4, 0xa5, 0xa6, 0xa7,
+    0xa8, 0xa9, 0xaa, 0xb2, 0xb3, 0xb4, 0xb5, 0xb6,
+    0xb7, 0xb8, 0xb9, 0xba, 0xc2, 0xc3, 0xc4, 0xc5,
+    0xc6, 0xc7, 0xc8, 0xc9, 0xca, 0xd2, 0xd3, 0xd4,
+    0xd5, 0xd6, 0xd7, 0xd8, 0xd9, 0xda, 0xe1, 0xe2,
+    0xe3, 0xe4, 0xe5, 0xe6, 0xe7, 0xe8, 0xe9, 0xea,
+    0xf1, 0xf2, 0xf3, 0xf4, 0xf5, 0xf6, 0xf7, 0xf8,
+    0xf9, 0xfa
+]
+
+bits_ac_chrominance = [0, 2, 1, 2, 4, 4, 3, 4, 7, 5, 4, 4, 0, 1, 2, 0x77]
+val_ac_chrominance = [
+    0x00, 0x01, 0x02, 0x03, 0x11, 0x04, 0x05, 0x21,
+    0x31, 0x06, 0x12, 0x41, 0x51, 0x07, 0x61, 0x71,
+    0x13, 0x22, 0x32, 0x81, 0x08, 0x14, 0x42, 0x91,
+    0xa1, 0xb1, 0xc1, 0x09, 0x23, 0x33, 0x52, 0xf0,
+    0x15, 0x62, 0x72, 0xd1, 0x0a, 0x16, 0x24, 0x34,
+    0xe1, 0x25, 0xf1, 0x17, 0x18, 0x19, 0x1a, 0x26,
+    0x27, 0x28, 0x29, 0x2a, 0x35, 0x36, 0x37, 0x38,
+    0x39, 0x3a, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48,
+    0x49, 0x4a, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58,
+    0x59, 0x5a, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68,
+    0x69, 0x6a, 0x73, 0x74, 0x75, 0x76, 0x77, 0x78,
+    0x79, 0x7a, 0x82, 0x83, 0x84, 0x85, 0x86, 0x87,
+    0x88, 0x89, 0x8a, 0x92, 0x93, 0x94, 0x95, 0x96,
+    0x97, 0x98, 0x99, 0x9a, 0xa2, 0xa3, 0xa4, 0xa5,
+    0xa6, 0xa7, 0xa8, 0xa9, 0xaa, 0xb2, 0xb3, 0xb4,
+    0xb5, 0xb6, 0xb7, 0xb8, 0xb9, 0xba, 0xc2, 0xc3,
+    0xc4, 0xc5, 0xc6, 0xc7, 0xc8, 0xc9, 0xca, 0xd2,
+    0xd3, 0xd4, 0xd5, 0xd6, 0xd7, 0xd8, 0xd9, 0xda,
+    0xe2, 0xe3, 0xe4, 0xe5, 0xe6, 0xe7, 0xe8, 0xe9,
+    0xea, 0xf2, 0xf3, 0xf4, 0xf5, 0xf6, 0xf7, 0xf8,
+    0xf9, 0xfa
+]
+
+
+def build_huffman_codes(bits, huffval):
+    """the (code, size) of each symbol of a DHT table, section C.2"""
+    codes = [(0, 0)] * 256
+    code = 0
+    k = 0
+    for size in range(1, 17):
+        for _ in range(bits[size - 1]):
+            codes[huffval[k]] = (code, size)
+            code += 1
+            k += 1
+        code <<= 1
+    return codes
+
+
+def build_aan_divisors(qtbl):
+    """the quantization table qtbl, in natural order, scaled like the
+    output of the AA&N forward dct (by the aanscales and by 8)"""
+    return [(q * aan + (1 << 10)) >> 11 for q, aan in zip(qtbl, aanscales)]
+
+
+def build_rgb_ycc_tables():
+    """RGB -> YCbCr conversion, the inverse of raw.build_color_tables
+
+    The samples are also centered on 0 for the dct: Y is given less
+    CENTERJSAMPLE, and Cb and Cr without adding it.
+         Y  =  0.29900 * R + 0.58700 * G + 0.11400 * B
+         Cb = -0.16874 * R - 0.33126 * G + 0.50000 * B
+         Cr =  0.50000 * R - 0.41869 * G - 0.08131 * B
+    The products are scaled up by 2^16 and the rounding is included in the
+    tables of B for Y and of the 0.5 factor.
+
+    returns the RToY, GToY, BToY, RToCb, GToCb, HalfTo, GToCr and BToCr tables
+    """
+    nScale = 1 << 16
+    nHalf = nScale >> 1
+    FIX = lambda x: int((x) * nScale + 0.5)
+    RToY = [FIX(0.29900) * i for i in range(256)]
+    GToY = [FIX(0.58700) * i for i in range(256)]
+    BToY = [FIX(0.11400) * i + nHalf - (128 << 16) for i in range(256)]
+    RToCb = [- FIX(0.16874) * i for i in range(256)]
+    GToCb = [- FIX(0.33126) * i for i in range(256)]
+    # B=>Cb and R=>Cr are the same; nHalf - 1 keeps the result below 128
+    HalfTo = [FIX(0.50000) * i + nHalf - 1 for i in range(256)]
+    GToCr = [- FIX(0.41869) * i for i in range(256)]
+    BToCr = [- FIX(0.08131) * i for i in range(256)]
+    return RToY, GToY, BToY, RToCb, GToCb, HalfTo, GToCr, BToCr
+
+
+YCC_TABLES = build_rgb_ycc_tables()
+
+# the DHT tables of the luminance DC and AC and of the chrominance DC and AC
+STD_HUFFMAN_TABLES = [
+    (bits_dc_luminance, val_dc_luminance),
+    (bits_ac_luminance, val_ac_luminance),
+    (bits_dc_chrominance, val_dc_chrominance),
+    (bits_ac_chrominance, val_ac_chrominance)]
+
+
+def build_optimal_table(freq):
+    """the bits and huffval of a DHT table for the symbol counts freq, like
+    the IJG jpeg_gen_optimal_table (section K.2): a Huffman code limited to
+    16 bits, in which no code is all 1 bits"""
+    freq = list(freq[:256]) + [1]    # reserve one code point
+    # codesize[k] = code length of symbol k, others[k] = next symbol in
+    # the current branch of the tree
+    codesize = [0] * 257
+    others = [-1] * 257
+    while True:
+        # the least frequent nonzero symbol c1, the higher one on a tie
+        c1 = c2 = -1
+        v1 = v2 = None
+        for i, v in enumerate(freq):
+            if v and (v1 is None or v <= v1):
+                c2, v2 = c1, v1
+                c1, v1 = i, v
+            elif v and (v2 is None or v <= v2):
+                c2, v2 = i, v
+        # done if we've merged everything into one frequency
+        if c2 < 0:
+            break
+        # the merge of c1 and c2 stays at c1
+        freq[c1] += freq[c2]
+        freq[c2] = 0
+        # increment the codesize of everything in c1's tree branch
+        codesize[c1] += 1
+        while others[c1] >= 0:
+            c1 = others[c1]
+            codesize[c1] += 1
+        # chain c2 onto c1's tree branch
+        others[c1] = c2
+        # increment the codesize of everything in c2's tree branch
+        codesize[c2] += 1
+        while others[c2] >= 0:
+            c2 = others[c2]
+            codesize[c2] += 1
+
+    bits = [0] * 33
+    for size in codesize:
+        if size:
+            bits[size] += 1
+    # limit the code lengths to 16 bits, section K.2 figure K.3
+    for i in range(32, 16, -1):
+        while bits[i] > 0:
+            j = i - 2    # find length of new prefix to be used
+            while bits[j] == 0:
+                j -= 1
+            bits[i] -= 2    # remove two symbols
+            bits[i - 1] += 1    # one goes in this length
+            bits[j + 1] += 2    # two new symbols in this length
+            bits[j] -= 1    # symbol of this length is now a prefix
+    # remove the count of the reserved code point from the longest codes
+    i = 16
+    while bits[i] == 0:
+        i -= 1
+    bits[i] -= 1
+    huffval = [symbol for size in range(1, 33) for symbol in range(256)
+               if codesize[symbol] == size]
+    return bits[1:17], huffval
+
+
+def marker(code, payload):
+    """a marker segment with its length"""
+    return struct.pack('>BBH', 0xFF, code, len(payload) + 2) + payload
+
+
+class TonyJpegEncoder(object):
+    def __init__(self, quality=DEFAULT_QUALITY, subsampling=DEFAULT_SUBSAMPLING,
+                 restart_rows=0, optimize=False):
+        """
+        quality: 1 to 100, like the IJG cjpeg -quality
+        subsampling: '4:4:4' or '4:2:0'
+        restart_rows: a restart interval of that many MCU rows, 0 for none
+        optimize: use Huffman tables optimized for the image rather than the
+        standard ones, at the cost of a first pass that counts the symbols
+
+        The fast AA&N forward DCT of jfdctfst.c limits the precision from
+        quality 95 on, most with 4:4:4.
+        """
+        if not 1 <= quality <= 100:
+            raise ValueError("Quality must be between 1 and 100: %r" % (quality,))
+        if subsampling not in SUBSAMPLINGS:
+            raise ValueError("Unsupported subsampling: %r" % (subsampling,))
+        self.quality = quality
+        self.subsampling = subsampling
+        self.restart_rows = restart_rows
+        self.optimize = optimize
+        # sampling factors of Y, Cb and Cr have 1 and 1
+        self.Sampling = SUBSAMPLINGS[subsampling]
+        self.McuSize = 8 * self.Sampling
+        self.qtblY = quality_scaled_table(std_luminance_quant_tbl, quality)
+        self.qtblCbCr = quality_scaled_table(std_chrominance_quant_tbl, quality)
+        # (natural order index, divisor, half the divisor), in zigzag order
+        self.zigzagY = self.zigzag_divisors(self.qtblY)
+        self.zigzagCbCr = self.zigzag_divisors(self.qtblCbCr)
+        self.set_huffman_tables(STD_HUFFMAN_TABLES)
+        self.workspace = [0] * 64
+        self.Width = self.Height = 0
+        self.cxMcu = self.cyMcu = 0
+        self.RestartRows = self.restart_interval = 0
+        self.out = None
+
+    def clone(self):
+        """a new encoder with the settings and Huffman tables of this one"""
+        encoder = TonyJpegEncoder(self.quality, self.subsampling, self.restart_rows, self.optimize)
+        encoder.set_huffman_tables(self.huffman_tables)
+        return encoder
+
+    def zigzag_divisors(self, qtbl):
+        divisors = build_aan_divisors(qtbl)
+        return [(i, divisors[i], divisors[i] // 2) for i in jpeg_natural_order[:64]]
+
+    def set_huffman_tables(self, tables):
+        """use the (bits, huffval) DHT tables of the luminance DC and AC and
+        the chrominance DC and AC"""
+        self.huffman_tables = tables
+        self.htblYDC, self.htblYAC, self.htblCbCrDC, self.htblCbCrAC = [
+            build_huffman_codes(bits, huffval) for bits, huffval in tables]
+
+    def encode(self, pixels, width, height, pixelsize=3):
+        """
+        the JFIF stream of an image given as rows of width pixels, top to
+        bottom, of pixelsize bytes each, red, green and blue first
+        """
+        self.start(width, height)
+        strips = self.strips()
+        if self.optimize:
+            counts = new_counts()
+            for first, last in strips:
+                self.count_rows(pixels, pixelsize, first, last, counts)
+            self.set_optimal_tables(counts)
+        return self.finish([self.encode_rows(pixels, pixelsize, first, last)
+                            for first, last in strips])
+
+    def start(self, width, height, restart_rows=None):
+        """set up the encoding of an image of width*height pixels, with
+        restart_rows rather than self.restart_rows if it is given"""
+        if not (0 < width < 65536 and 0 < height < 65536):
+            raise ValueError("Unsupported image size: %dx%d" % (width, height))
+        self.Width, self.Height = width, height
+        self.cxMcu = (width + self.McuSize - 1) // self.McuSize
+        self.cyMcu = (height + self.McuSize - 1) // self.McuSize
+        if restart_rows is None:
+            restart_rows = self.restart_rows
+        self.RestartRows = restart_rows
+        self.restart_interval = restart_rows * self.cxMcu
+        if self.restart_interval > 65535:
+            raise ValueError("Restart interval of more than 65535 MCUs: %d" % self.restart_interval)
+
+    def strips(self):
+        """the first and last MCU rows of the restart intervals, or of the
+        whole image without restart interval"""
+        step = self.RestartRows or self.cyMcu
+        return [(first, min(first + step, self.cyMcu)) for first in range(0, self.cyMcu, step)]
+
+    def set_optimal_tables(self, counts):
+        """use the Huffman tables optimized for the symbol counts of count_rows"""
+        self.set_huffman_tables([build_optimal_table(freq) for freq in counts])
+
+    def finish(self, strips):
+        """the JFIF stream of the coded strips, separated by RSTn markers"""
+        data = [self.headers()]
+        for n, strip in enumerate(strips):
+            if n:
+                data.append(struct.pack('>BB', 0xFF, M_RST0 + (n - 1) % 8))
+            data.append(strip)
+        data.append(struct.pack('>BB', 0xFF, M_EOI))
+        return b''.join(data)
+
+    def headers(self):
+        """SOI up to SOS, with the tables of the encoder"""
+        zigzag = jpeg_natural_order[:64]
+        segments = [struct.pack('>BB', 0xFF, M_SOI)]
+        # JFIF 1.01, no density unit, aspect ratio 1:1, no thumbnail
+        segments.append(marker(M_APP0, b'JFIF\x00' + struct.pack('>BBBHHBB', 1, 1, 0, 1, 1, 0, 0)))
+        dqt = bytearray()
+        for index, qtbl in enumerate((self.qtblY, self.qtblCbCr)):
+            dqt.append(index)
+            dqt.extend(qtbl[i] for i in zigzag)
+        segments.append(marker(M_DQT, bytes(dqt)))
+        sampling = (self.Sampling << 4) | self.Sampling
+        segments.append(marker(M_SOF0, struct.pack(
+            '>BHHB9B', 8, self.Height, self.Width, 3,
+            1, sampling, 0, 2, 0x11, 1, 3, 0x11, 1)))
+        segments.append(marker(M_DHT, self.dht()))
+        if self.restart_interval:
+            segments.append(marker(M_DRI, struct.pack('>H', self.restart_interval)))
+        segments.append(marker(M_SOS, struct.pack('>B6B3B', 3, 1, 0x00, 2, 0x11, 3, 0x11, 0, 63, 0)))
+        return b''.join(segments)
+
+    def dht(self):
+        """the payload of the DHT segment with the Huffman tables"""
+        dht = bytearray()
+        for index, (bits, huffval) in zip((0x00, 0x10, 0x01, 0x11), self.huffman_tables):
+            dht.append(index)
+            dht.extend(bits)
+            dht.extend(huffval)
+        return bytes(dht)
+
+    def convert_rows(self, pixels, pixelsize, first_row):
+        """the Y, Cb and Cr rows of the MCU row from image row first_row,
+        padded to whole MCUs by repeating the last column and row, and with
+        the chroma subsampled"""
+        width, height = self.Width, self.Height
+        McuSize = self.McuSize
+        padded = self.cxMcu * McuSize
+        RToY, GToY, BToY, RToCb, GToCb, HalfTo, GToCr, BToCr = YCC_TABLES
+        rowsY, rowsCb, rowsCr = [], [], []
+        for y in range(first_row, first_row + McuSize):
+            pos = min(y, height - 1) * width * pixelsize
+            end = pos + width * pixelsize
+            rgb = list(zip(pixels[pos:end:pixelsize], pixels[pos + 1:end:pixelsize],
+                           pixels[pos + 2:end:pixelsize]))
+            rgb.extend(rgb[-1:] * (padded - width))
+            rowsY.append([(RToY[r] + GToY[g] + BToY[b]) >> 16 for r, g, b in rgb])
+            rowsCb.append([(RToCb[r] + GToCb[g] + HalfTo[b]) >> 16 for r, g, b in rgb])
+            rowsCr.append([(HalfTo[r] + GToCr[g] + BToCr[b]) >> 16 for r, g, b in rgb])
+        if self.Sampling == 2:
+            rowsCb = self.downsample(rowsCb)
+            rowsCr = self.downsample(rowsCr)
+        return rowsY, rowsCb, rowsCr
+
+    def downsample(self, rows):
+        """average 2*2 samples"""
+        return [[(a + b + c + d + 2) >> 2 for a, b, c, d in
+                 zip(row0[0::2], row0[1::2], row1[0::2], row1[1::2])]
+                for row0, row1 in zip(rows[0::2], rows[1::2])]
+
+    def quantized_blocks(self, pixels, pixelsize, first, last):
+        """the quantized coefficients, in zigzag order, of the blocks of the
+        MCU rows first to last, with their component: 0, 1 or 2 for Y, Cb, Cr"""
+        Sampling = self.Sampling
+        McuSize = self.McuSize
+        quantize_block = self.quantize_block
+        zigzagY, zigzagCbCr = self.zigzagY, self.zigzagCbCr
+        for mcu_row in range(first, last):
+            rowsY, rowsCb, rowsCr = self.convert_rows(pixels, pixelsize, mcu_row * McuSize)
+            for mcu_col in range(self.cxMcu):
+                x = mcu_col * McuSize
+                for v in range(Sampling):
+                    rows = rowsY[v * 8:v * 8 + 8]
+                    for h in range(Sampling):
+                        yield quantize_block(rows, x + h * 8, zigzagY), 0
+                x = mcu_col * 8
+                yield quantize_block(rowsCb, x, zigzagCbCr), 1
+                yield quantize_block(rowsCr, x, zigzagCbCr), 2
+
+    def encode_rows(self, pixels, pixelsize, first, last):
+        """the entropy coded data of the MCU rows first to last, byte stuffed
+        and padded to a whole byte; the DC predictions start at 0"""
+        return self.encode_blocks(self.quantized_blocks(pixels, pixelsize, first, last))
+
+    def encode_blocks(self, blocks):
+        """the entropy coded data of the quantized blocks, (coefficients in
+        zigzag order, component) pairs in the order of the scan, byte stuffed
+        and padded to a whole byte; the luminance tables code component 0,
+        the chrominance ones the others"""
+        tables = [(self.htblYDC, self.htblYAC)] + [(self.htblCbCrDC, self.htblCbCrAC)] * 2
+        last_dc = [0, 0, 0]
+        # the data as a bit string, in bytes, with the bits left over
+        self.out = bytearray()
+        self.put_buffer = self.put_bits = 0
+        encode_block = self.encode_block
+        for block, component in blocks:
+            dctbl, actbl = tables[component]
+            encode_block(block, last_dc[component], dctbl, actbl)
+            last_dc[component] = block[0]
+        # pad the last byte with 1 bits
+        bits = -self.put_bits & 7
+        self.emit((1 << bits) - 1, bits)
+        data, self.out = bytes(self.out), None
+        return data.replace(b'\xff', b'\xff\x00')
+
+    def count_rows(self, pixels, pixelsize, first, last, counts):
+        """add the counts of the Huffman symbols of the MCU rows first to last
+        to counts, the symbol counts of each table from new_counts()"""
+        return count_blocks(self.quantized_blocks(pixels, pixelsize, first, last), counts)
+
+    def emit(self, code, size):
+        """append size bits, then move the whole bytes to out"""
+        buffer = (self.put_buffer << size) | code
+        bits = self.put_bits + size
+        if bits >= 8:
+            left = bits & 7
+            self.out += int_to_bytes(buffer >> left, bits >> 3)
+            buffer &= (1 << left) - 1
+            bits = left
+        self.put_buffer, self.put_bits = buffer, bits
+
+    def forward_dct(self, rows, x):
+        """AA&N DCT algorithm implemention, of the 8*8 samples at column x
+        of the 8 rows, into the workspace; the results are scaled up by 8
+        and the aanscales, see build_aan_divisors"""
+        FIX_0_382683433 = 98         # FIX(0.382683433)
+        FIX_0_541196100 = 139        # FIX(0.541196100)
+        FIX_0_707106781 = 181        # FIX(0.707106781)
+        FIX_1_306562965 = 334        # FIX(1.306562965)
+
+        workspace = self.workspace
+
+        # Pass 1: process rows
+        for wsptr in range(0, 64, 8):
+            d0, d1, d2, d3, d4, d5, d6, d7 = rows[wsptr >> 3][x:x + 8]
+            tmp0 = d0 + d7
+            tmp7 = d0 - d7
+            tmp1 = d1 + d6
+            tmp6 = d1 - d6
+            tmp2 = d2 + d5
+            tmp5 = d2 - d5
+            tmp3 = d3 + d4
+            tmp4 = d3 - d4
+
+            # Even part
+            tmp10 = tmp0 + tmp3    # phase 2
+            tmp13 = tmp0 - tmp3
+            tmp11 = tmp1 + tmp2
+            tmp12 = tmp1 - tmp2
+
+            workspace[wsptr] = tmp10 + tmp11    # phase 3
+            workspace[wsptr + 4] = tmp10 - tmp11
+
+            z1 = MULTIPLY(tmp12 + tmp13, FIX_0_707106781)    # c4
+            workspace[wsptr + 2] = tmp13 + z1    # phase 5
+            workspace[wsptr + 6] = tmp13 - z1
+
+            # Odd part
+            tmp10 = tmp4 + tmp5    # phase 2
+            tmp11 = tmp5 + tmp6
+            tmp12 = tmp6 + tmp7
+
+            # The rotator is modified from fig 4-8 to avoid extra negations.
+            z5 = MULTIPLY(tmp10 - tmp12, FIX_0_382683433)    # c6
+            z2 = MULTIPLY(tmp10, FIX_0_541196100) + z5    # c2-c6
+            z4 = MULTIPLY(tmp12, FIX_1_306562965) + z5    # c2+c6
+            z3 = MULTIPLY(tmp11, FIX_0_707106781)    # c4
+
+            z11 = tmp7 + z3    # phase 5
+            z13 = tmp7 - z3
+
+            workspace[wsptr + 5] = z13 + z2    # phase 6
+            workspace[wsptr + 3] = z13 - z2
+            workspace[wsptr + 1] = z11 + z4
+            workspace[wsptr + 7] = z11 - z4
+
+        # Pass 2: process columns
+        for col in range(8):
+            tmp0 = workspace[col] + workspace[col + 56]
+            tmp7 = workspace[col] - workspace[col + 56]
+            tmp1 = workspace[col + 8] + workspace[col + 48]
+            tmp6 = workspace[col + 8] - workspace[col + 48]
+            tmp2 = workspace[col + 16] + workspace[col + 40]
+            tmp5 = workspace[col + 16] - workspace[col + 40]
+            tmp3 = workspace[col + 24] + workspace[col + 32]
+            tmp4 = workspace[col + 24] - workspace[col + 32]
+
+            # Even part
+            tmp10 = tmp0 + tmp3
+            tmp13 = tmp0 - tmp3
+            tmp11 = tmp1 + tmp2
+            tmp12 = tmp1 - tmp2
+
+            workspace[col] = tmp10 + tmp11
+            workspace[col + 32] = tmp10 - tmp11
+
+            z1 = MULTIPLY(tmp12 + tmp13, FIX_0_707106781)
+            workspace[col + 16] = tmp13 + z1
+            workspace[col + 48] = tmp13 - z1
+
+            # Odd part
+            tmp10 = tmp4 + tmp5
+            tmp11 = tmp5 + tmp6
+            tmp12 = tmp6 + tmp7
+
+            z5 = MULTIPLY(tmp10 - tmp12, FIX_0_382683433)
+            z2 = MULTIPLY(tmp10, FIX_0_541196100) + z5
+            z4 = MULTIPLY(tmp12, FIX_1_306562965) + z5
+            z3 = MULTIPLY(tmp11, FIX_0_707106781)
+
+            z11 = tmp7 + z3
+            z13 = tmp7 - z3
+
+            workspace[col + 40] = z13 + z2
+            workspace[col + 24] = z13 - z2
+            workspace[col + 8] = z11 + z4
+            workspace[col + 56] = z11 - z4
+
+    def quantize_block(self, rows, x, zigzag):
+        """the quantized coefficients of the block at column x of the 8 rows,
+        in zigzag order; zigzag holds the divisors, see zigzag_divisors"""
+        self.forward_dct(rows, x)
+        workspace = self.workspace
+        return [(workspace[i] + half) // q if workspace[i] >= 0 else -((half - workspace[i]) // q)
+                for i, q, half in zigzag]
+
+    def encode_block(self, block, last_dc, dctbl, actbl):
+        """Huffman code the quantized block"""
+        # the DC difference, section F.1.2.1
+        temp = block[0] - last_dc
+        nbits = abs(temp).bit_length()
+        if temp < 0:
+            temp += (1 << nbits) - 1
+        code, size = dctbl[nbits]
+        buffer = (code << nbits) | temp
+        bits = size + nbits
+
+        # the AC coefficients, section F.1.2.2
+        run = 0
+        for temp in block[1:]:
+            if not temp:
+                run += 1
+                continue
+            while run > 15:
+                # ZRL, a run of 16 zeros
+                code, size = actbl[0xF0]
+                buffer = (buffer << size) | code
+                bits += size
+                run -= 16
+            nbits = abs(temp).bit_length()
+            if temp < 0:
+                temp += (1 << nbits) - 1
+            code, size = actbl[(run << 4) + nbits]
+            buffer = (((buffer << size) | code) << nbits) | temp
+            bits += size + nbits
+            run = 0
+        if run:
+            # EOB
+            code, size = actbl[0]
+            buffer = (buffer << size) | code
+            bits += size
+        self.emit(buffer, bits)
+
+
+def new_counts():
+    """symbol counts for TonyJpegEncoder.count_rows"""
+    return [[0] * 257 for _ in range(4)]
+
+
+def count_blocks(blocks, counts):
+    """add the counts of the Huffman symbols of the quantized blocks, see
+    TonyJpegEncoder.encode_blocks, to counts, from new_counts()"""
+    tables = [(counts[0], counts[1])] + [(counts[2], counts[3])] * 2
+    last_dc = [0, 0, 0]
+    for block, component in blocks:
+        dc_counts, ac_counts = tables[component]
+        dc_counts[abs(block[0] - last_dc[component]).bit_length()] += 1
+        last_dc[component] = block[0]
+        run = 0
+        for temp in block[1:]:
+            if not temp:
+                run += 1
+                continue
+            while run > 15:
+                ac_counts[0xF0] += 1
+                run -= 16
+            ac_counts[(run << 4) + abs(temp).bit_length()] += 1
+            run = 0
+        if run:
+            ac_counts[0] += 1
+    return counts
+
+
+def add_counts(counts, more):
+    for freq, add in zip(counts, more):
+        for symbol, n in enumerate(add):
+            freq[symbol] += n
+    return counts
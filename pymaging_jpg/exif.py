@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2012, Jonas Obrist
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the Jonas Obrist nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL JONAS OBRIST BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+The EXIF data of a jpeg: its orientation, and the small jpeg thumbnail most
+cameras embed in it, which makes a preview without decoding the image.
+
+Only the first two IFDs of the TIFF data in the APP1 segment are read, IFD0
+for the orientation and IFD1 for the thumbnail.
+"""
+from pymaging_jpg.raw import TonyJpegDecoder, CHUNK_SIZE
+from collections import namedtuple
+import struct
+
+# TIFF tags
+ORIENTATION = 0x0112
+JPEG_INTERCHANGE_FORMAT = 0x0201
+JPEG_INTERCHANGE_FORMAT_LENGTH = 0x0202
+# TIFF types of a single value that fits in an entry
+SHORT = 3
+LONG = 4
+
+# the transform.TRANSFORMS operation that displays an image of each EXIF
+# orientation the right way up
+ORIENTATIONS = {
+    1: None,
+    2: 'flip-horizontal',
+    3: 'rotate-180',
+    4: 'flip-vertical',
+    5: 'transpose',
+    6: 'rotate-90',
+    7: 'transverse',
+    8: 'rotate-270',
+}
+
+# orientation is 1 if the image has no EXIF data, and thumbnail None if there
+# is no jpeg thumbnail in it, otherwise the whole jpeg stream of it
+ExifInfo = namedtuple('ExifInfo', ['orientation', 'thumbnail'])
+
+# see decode_thumbnail
+Preview = namedtuple('Preview', ['pixels', 'width', 'height', 'orientation', 'embedded'])
+
+
+def read_ifd(data, order, offset):
+    """the {tag: value} of the entries with a single SHORT or LONG value of
+    the IFD at offset in data, and the offset of the next IFD, 0 for none"""
+    if not 8 <= offset <= len(data) - 2:
+        return {}, 0
+    count = struct.unpack_from(order + 'H', data, offset)[0]
+    end = offset + 2 + count * 12
+    if end > len(data):
+        return {}, 0
+    entries = {}
+    for pos in range(offset + 2, end, 12):
+        tag, kind, n = struct.unpack_from(order + 'HHI', data, pos)
+        if n == 1 and kind == SHORT:
+            entries[tag] = struct.unpack_from(order + 'H', data, pos + 8)[0]
+        elif n == 1 and kind == LONG:
+            entries[tag] = struct.unpack_from(order + 'I', data, pos + 8)[0]
+    next_ifd = 0
+    if end + 4 <= len(data):
+        next_ifd = struct.unpack_from(order + 'I', data, end)[0]
+    return entries, next_ifd
+
+
+def parse_exif(data):
+    """the ExifInfo of the TIFF data of an EXIF segment; whatever is missing
+    or out of bounds in it is left out"""
+    if len(data) >= 8 and data[:4] == b'II*\x00':
+        order = '<'
+    elif len(data) >= 8 and data[:4] == b'MM\x00*':
+        order = '>'
+    else:
+        return ExifInfo(1, None)
+    ifd0, offset = read_ifd(data, order, struct.unpack_from(order + 'I', data, 4)[0])
+    orientation = ifd0.get(ORIENTATION, 1)
+    if orientation not in ORIENTATIONS:
+        orientation = 1
+    ifd1 = read_ifd(data, order, offset)[0] if offset else {}
+    start = ifd1.get(JPEG_INTERCHANGE_FORMAT, 0)
+    length = ifd1.get(JPEG_INTERCHANGE_FORMAT_LENGTH, 0)
+    thumbnail = None
+    if start and length and start + length <= len(data):
+        thumbnail = data[start:start + length]
+        if thumbnail[:2] != b'\xff\xd8':
+            # not a jpeg, eg. an uncompressed TIFF thumbnail
+            thumbnail = None
+    return ExifInfo(orientation, thumbnail)
+
+
+def read_exif(fileobj, chunk_size=CHUNK_SIZE, decoder=None):
+    """the ExifInfo of the jpeg in fileobj, from its headers, read chunk_size
+    bytes at a time"""
+    if decoder is None:
+        decoder = TonyJpegDecoder()
+    decoder.reset()
+    decoder.save_exif = True
+    decoder.set_input(fileobj, chunk_size)
+    decoder.read_markers()
+    if decoder.exif is None:
+        return ExifInfo(1, None)
+    return parse_exif(decoder.exif)
+
+
+def decode_thumbnail(fileobj, mode='RGB', scale=1, chunk_size=CHUNK_SIZE):
+    """a Preview of the jpeg in fileobj: the pixels of the thumbnail in its
+    EXIF data, decoded in mode, and the orientation of the image; only if
+    there is no thumbnail, or it cannot be decoded, the image itself is
+    decoded at 1/scale of its size, and embedded is False"""
+    start = fileobj.tell()
+    decoder = TonyJpegDecoder()
+    info = read_exif(fileobj, chunk_size, decoder)
+    if info.thumbnail is not None:
+        try:
+            pixels = decoder.decode(info.thumbnail, mode=mode)
+        except (ValueError, IndexError):
+            # a broken thumbnail, the image may be fine
+            pass
+        else:
+            return Preview(pixels, decoder.out_width, decoder.out_height, info.orientation, True)
+    fileobj.seek(start)
+    pixels = decoder.decode_stream(fileobj, chunk_size, scale=scale, mode=mode)
+    return Preview(pixels, decoder.out_width, decoder.out_height, info.orientation, False)
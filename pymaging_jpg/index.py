@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2012, Jonas Obrist
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the Jonas Obrist nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL JONAS OBRIST BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Persistent index of the entropy coded data of a jpeg.
+
+Huffman decoding is sequential, so getting to a tile in the middle of an
+image means decoding all the tiles before it. An EntropyIndex records the
+state of the entropy decoder every interval tiles, so a decoder can start
+from the last checkpoint before the tiles it needs, see
+TonyJpegDecoder.seek_tile. It can be saved to a small sidecar file.
+
+The checkpoints are byte offsets into one particular file, so the index also
+records the position, length and a hash of its scan data; a decoder checks
+them before it uses the index, another encoding of the same image is
+rejected.
+"""
+from pymaging_jpg.raw import TonyJpegDecoder, CHUNK_SIZE
+import struct
+import zlib
+
+DEFAULT_INTERVAL = 64
+
+INDEX_MAGIC = b'JPGI'
+INDEX_VERSION = 3
+# magic, version, interval, width, height, scan data start, length and hash,
+# number of checkpoints
+INDEX_HEADER = struct.Struct('<4sBIHHIIII')
+# bytes hashed at each end of the scan data
+HASH_BYTES = 4096
+# see TonyJpegDecoder.save_entropy_state
+CHECKPOINT = struct.Struct('<IBQhhhHBB')
+
+
+def scan_hash(decoder, start, length):
+    """crc32 of the first and last HASH_BYTES of the length bytes of scan
+    data at start of the jpeg stream of decoder"""
+    if length <= 2 * HASH_BYTES:
+        data = decoder.peek_stream(start, length)
+    else:
+        data = (decoder.peek_stream(start, HASH_BYTES) +
+                decoder.peek_stream(start + length - HASH_BYTES, HASH_BYTES))
+    return zlib.crc32(data) & 0xFFFFFFFF
+
+
+class EntropyIndex(object):
+    def __init__(self, interval, width, height, scan_start, scan_length, scan_hash, checkpoints):
+        self.interval = interval
+        self.width = width
+        self.height = height
+        # the scan data from its start up to where the entropy decoding of
+        # the last tile stopped reading, see scan_hash
+        self.scan_start = scan_start
+        self.scan_length = scan_length
+        self.scan_hash = scan_hash
+        # entropy decoder state before the tiles 0, interval, 2 * interval...
+        self.checkpoints = checkpoints
+
+    def check(self, decoder):
+        """raise a ValueError unless the index is one of the image decoder
+        has read the headers of"""
+        if (self.width, self.height) != (decoder.Width, decoder.Height):
+            raise ValueError("The index is for a %dx%d image, not %dx%d" % (
+                self.width, self.height, decoder.Width, decoder.Height))
+        if scan_hash(decoder, self.scan_start, self.scan_length) != self.scan_hash:
+            raise ValueError("The index is for other scan data than that of the image, "
+                             "eg. another encoding of it")
+
+    def checkpoint_before(self, tile):
+        """returns the last checkpoint at or before tile as (tile, state)"""
+        i = min(tile // self.interval, len(self.checkpoints) - 1)
+        return i * self.interval, self.checkpoints[i]
+
+    def save(self, fileobj):
+        fileobj.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, self.interval,
+                                        self.width, self.height, self.scan_start,
+                                        self.scan_length, self.scan_hash, len(self.checkpoints)))
+        for state in self.checkpoints:
+            fileobj.write(CHECKPOINT.pack(*state))
+
+    @classmethod
+    def load(cls, fileobj):
+        header = fileobj.read(INDEX_HEADER.size)
+        if len(header) != INDEX_HEADER.size or header[:4] != INDEX_MAGIC:
+            raise ValueError("Not a jpeg index")
+        (magic, version, interval, width, height, scan_start, scan_length,
+         scan_hash, count) = INDEX_HEADER.unpack(header)
+        if version != INDEX_VERSION:
+            raise ValueError("Unsupported jpeg index version %d, rebuild the index" % version)
+        data = fileobj.read(CHECKPOINT.size * count)
+        if len(data) != CHECKPOINT.size * count:
+            raise ValueError("Truncated jpeg index")
+        checkpoints = [
+            CHECKPOINT.unpack_from(data, i * CHECKPOINT.size) for i in range(count)
+        ]
+        return cls(interval, width, height, scan_start, scan_length, scan_hash, checkpoints)
+
+
+def build_index(fileobj, interval=DEFAULT_INTERVAL, chunk_size=CHUNK_SIZE):
+    """entropy decode the jpeg in fileobj (without reconstructing any pixels)
+    and return an EntropyIndex with a checkpoint every interval tiles"""
+    decoder = TonyJpegDecoder(use_numpy=False)
+    decoder.set_input(fileobj, chunk_size)
+    decoder.read_headers()
+    if decoder.Progressive:
+        raise ValueError("Progressive images can not be indexed")
+    decoder.start_output()
+    scan_start = decoder.DataOffset + decoder.DataPos
+    checkpoints = []
+    for tile in range(decoder.cxTile * decoder.cyTile):
+        decoder.fill_tile_input()
+        if tile % interval == 0:
+            checkpoints.append(decoder.save_entropy_state())
+        decoder.decode_one_tile()
+    scan_length = decoder.DataOffset + decoder.DataPos - scan_start
+    return EntropyIndex(interval, decoder.Width, decoder.Height, scan_start, scan_length,
+                        scan_hash(decoder, scan_start, scan_length), checkpoints)
@@ -23,38 +23,119 @@
 # ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
-from pymaging.colors import RGB
+from pymaging.colors import ColorType, RGB, RGBA
 from pymaging.exceptions import FormatNotSupported
 from pymaging.formats import Format
 from pymaging.image import Image
-from pymaging_jpg.raw import TonyJpegDecoder
+from pymaging_jpg.exif import decode_thumbnail
+from pymaging_jpg.encoder import DEFAULT_QUALITY, DEFAULT_SUBSAMPLING, TonyJpegEncoder
+from pymaging_jpg.parallel import decode as parallel_decode, encode as parallel_encode
+from pymaging_jpg.raw import MODES, TonyJpegDecoder
 from pymaging.pixelarray import get_pixel_array
-import array
+import mmap
+
 
 PIXELSIZE = 3
+PROBE_CHUNK_SIZE = 4096
+# the color types of the decoder modes that make images, L images have a
+# single channel
+L = ColorType(1, False)
+COLOR_TYPES = {'RGB': RGB, 'RGBA': RGBA, 'L': L}
 
-def decode(fileobj):
+def probe(fileobj, chunk_size=PROBE_CHUNK_SIZE):
+    """
+    Read the headers up to the start of scan, chunk_size bytes at a time, and
+    return a raw.JpegInfo without decoding any pixels. Raises ValueError if
+    fileobj is not a supported jpeg.
+    """
     decoder = TonyJpegDecoder()
-    jpegsrc = fileobj.read()
+    decoder.set_input(fileobj, chunk_size)
+    decoder.read_markers()
+    return decoder.get_info()
+
+def map_file(fileobj):
+    """
+    A read only mmap.mmap of a real file at its start, or its remaining data
+    read in memory for other file objects.
+    """
     try:
-        bmpout = decoder.decode(jpegsrc)
-    except:
+        if fileobj.tell() == 0:
+            return mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, EnvironmentError, ValueError):
+        # no file descriptor (io.UnsupportedOperation) or an empty file
+        pass
+    return fileobj.read()
+
+def decode(fileobj, parallel=False, region=None, scale=1, mode='RGB', index=None):
+    """
+    parallel: decode the restart interval segments of the image on a pool of
+    processes, see pymaging_jpg.parallel; a file is memory mapped for that
+    instead of read in memory
+    region: only decode the (x, y, width, height) crop of the image; the
+    decoding stops after the last row of tiles in it, so parallel is ignored
+    scale: 1, 2, 4 or 8, decode the image at 1/scale of its size with reduced
+    size IDCTs, for thumbnails; parallel is ignored as well
+    mode: 'RGB', 'RGBA' (opaque), or 'L' for a single channel image of the
+    luma, which skips all the work on the chroma but its entropy decoding;
+    see TonyJpegDecoder.decode for the BGR and planar YCbCr modes
+    index: an index.EntropyIndex of the image, to skip to the first row of
+    tiles of region faster; the jpeg has to start at position 0 of fileobj
+    """
+    if mode not in COLOR_TYPES:
+        raise ValueError("Unsupported mode for an image: %r" % mode)
+    decoder = TonyJpegDecoder()
+    try:
+        # pixels of mode, top to bottom, ready for the pixel array as they are
+        if parallel and region is None and scale == 1:
+            inbuf = map_file(fileobj)
+            try:
+                pixels = parallel_decode(decoder, inbuf, mode=mode)
+            finally:
+                if isinstance(inbuf, mmap.mmap):
+                    inbuf.close()
+        else:
+            pixels = decoder.decode_stream(fileobj, region=region, scale=scale, mode=mode, index=index)
+    except Exception:
         fileobj.seek(0)
         return None
-    pixels = array.array('B')
-    row_width = decoder.Width * PIXELSIZE
-    # rows are bottom to top
-    for reversed_row_num in range(decoder.Height - 1, -1, -1):
-        start = reversed_row_num * (row_width + 2)
-        end = start + row_width
-        pixels.extend(bmpout[start:end])
-        #pixels.extend(bmpout[:3 * decoder.Width])
-        #del bmpout[:3 * decoder.Width]
-        #del bmpout[:2] # kill padding
-    pixel_array = get_pixel_array(pixels, decoder.Width, decoder.Height, PIXELSIZE)
-    return Image(pixel_array, RGB)
-
-def encode(image, fileobj):
-    raise FormatNotSupported('jpeg')
+    pixel_array = get_pixel_array(pixels, decoder.out_width, decoder.out_height, MODES[mode])
+    return Image(pixel_array, COLOR_TYPES[mode])
+
+def thumbnail(fileobj, mode='RGB', scale=1):
+    """
+    A preview of the image from the jpeg thumbnail in its EXIF data, without
+    decoding the image itself, and the EXIF orientation of the image, a key
+    of exif.ORIENTATIONS. Only an image without a thumbnail is decoded, at
+    1/scale of its size.
+    """
+    if mode not in COLOR_TYPES:
+        raise ValueError("Unsupported mode for an image: %r" % mode)
+    preview = decode_thumbnail(fileobj, mode=mode, scale=scale)
+    pixel_array = get_pixel_array(preview.pixels, preview.width, preview.height, MODES[mode])
+    return Image(pixel_array, COLOR_TYPES[mode]), preview.orientation
+
+def encode(image, fileobj, quality=DEFAULT_QUALITY, subsampling=DEFAULT_SUBSAMPLING,
+           restart_rows=0, optimize=False, parallel=False):
+    """
+    Write image as a baseline JFIF stream, see pymaging_jpg.encoder.
+    quality: 1 to 100; subsampling: '4:4:4' or '4:2:0'
+    restart_rows: a restart marker every that many rows of MCUs
+    optimize: optimized Huffman tables, for a smaller file
+    parallel: code strips of the image on a pool of processes, with restart
+    markers between them, see pymaging_jpg.parallel
+    An alpha channel is dropped.
+    """
+    pixels = image.pixels
+    data, pixelsize = pixels.data, pixels.pixelsize
+    if image.palette:
+        colors = [bytes(bytearray(color[:PIXELSIZE])) for color in image.palette]
+        data, pixelsize = bytearray(b''.join(colors[index] for index in data)), PIXELSIZE
+    if pixelsize < PIXELSIZE:
+        raise FormatNotSupported('jpeg')
+    encoder = TonyJpegEncoder(quality, subsampling, restart_rows, optimize)
+    if parallel:
+        fileobj.write(parallel_encode(encoder, data, image.width, image.height, pixelsize))
+    else:
+        fileobj.write(encoder.encode(data, image.width, image.height, pixelsize))
 
 JPG = Format(decode, encode, ['jpg', 'jpeg'])
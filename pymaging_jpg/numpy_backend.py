@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2012, Jonas Obrist
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the Jonas Obrist nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL JONAS OBRIST BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Optional NumPy implementation of the reconstruction stages of
+raw.TonyJpegDecoder: dequantization, the AA&N inverse DCT, chroma up-sampling
+and YCbCr => RGB conversion of a whole row of tiles at once.
+
+The integer arithmetic is the same as in the pure Python code, so the output
+is bit-exact; available is False if NumPy is not installed.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+available = numpy is not None
+
+FIX_1_082392200 = 277        # FIX(1.082392200)
+FIX_1_414213562 = 362        # FIX(1.414213562)
+FIX_1_847759065 = 473        # FIX(1.847759065)
+FIX_2_613125930 = 669        # FIX(2.613125930)
+
+
+def idct_1d(d0, d1, d2, d3, d4, d5, d6, d7):
+    """one AA&N pass over arrays of the 8 inputs, see TonyJpegDecoder.inverse_dct"""
+    # Even part
+    tmp10 = d0 + d4
+    tmp11 = d0 - d4
+    tmp13 = d2 + d6
+    tmp12 = (((d2 - d6) * FIX_1_414213562) >> 8) - tmp13
+    tmp0 = tmp10 + tmp13
+    tmp3 = tmp10 - tmp13
+    tmp1 = tmp11 + tmp12
+    tmp2 = tmp11 - tmp12
+    # Odd part
+    z13 = d5 + d3
+    z10 = d5 - d3
+    z11 = d1 + d7
+    z12 = d1 - d7
+    tmp7 = z11 + z13
+    tmp11 = ((z11 - z13) * FIX_1_414213562) >> 8
+    z5 = ((z10 + z12) * FIX_1_847759065) >> 8
+    tmp10 = ((z12 * FIX_1_082392200) >> 8) - z5
+    tmp12 = ((z10 * -FIX_2_613125930) >> 8) + z5
+    tmp6 = tmp12 - tmp7
+    tmp5 = tmp11 - tmp6
+    tmp4 = tmp10 + tmp5
+    return (tmp0 + tmp7, tmp1 + tmp6, tmp2 + tmp5, tmp3 - tmp4,
+            tmp3 + tmp4, tmp2 - tmp5, tmp1 - tmp6, tmp0 - tmp7)
+
+
+def inverse_dct(coeffs, quant, range_limit):
+    """De-scale and inverse dct of blocks
+        coeffs          # in, dct coefficients, shape (..., 64)
+        quant           # in, AA&N scaled quant tables, broadcastable to coeffs
+        range_limit     # in, uint8 array, tblRange[384:] of the decoder
+        returns uint8 samples, shape (..., 8, 8)
+    """
+    workspace = (coeffs * quant).reshape(coeffs.shape[:-1] + (8, 8))
+    # Pass 1: process columns, Pass 2: process rows
+    workspace = numpy.stack(idct_1d(*[workspace[..., k, :] for k in range(8)]), axis=-2)
+    samples = numpy.stack(idct_1d(*[workspace[..., k] for k in range(8)]), axis=-1)
+    # descale by a factor of 8 and undo the PASS1_BITS scaling, range-limit
+    return range_limit[(samples >> 5) & 1023]
+
+
+def component_samples(samples, first, h, v):
+    """the samples of the h * v blocks of a component from first on, of
+    tiles of samples, shape (tiles, blocks, 8, 8) => (tiles, v * 8, h * 8)"""
+    count = samples.shape[0]
+    plane = samples[:, first:first + h * v].reshape(count, v, h, 8, 8)
+    return plane.transpose(0, 1, 3, 2, 4).reshape(count, v * 8, h * 8)
+
+
+def tiles_to_band(tiles):
+    """(tiles, rows, cols) => (rows, tiles * cols)"""
+    count, rows, cols = tiles.shape
+    return tiles.transpose(1, 0, 2).reshape(rows, count * cols)
+
+
+class Reconstructor(object):
+    """per image tables of a decoder in NumPy form"""
+    def __init__(self, decoder):
+        self.range_limit = numpy.array(decoder.tblRange[384:], dtype=numpy.uint8)
+        self.CrToR = numpy.array([decoder.CrToR[i] for i in range(256)], dtype=numpy.int64)
+        self.CrToG = numpy.array([decoder.CrToG[i] for i in range(256)], dtype=numpy.int64)
+        self.CbToB = numpy.array([decoder.CbToB[i] for i in range(256)], dtype=numpy.int64)
+        self.CbToG = numpy.array([decoder.CbToG[i] for i in range(256)], dtype=numpy.int64)
+        self.blocks = decoder.BlocksInMcu
+        # the blocks to reconstruct, those of Y only for the L mode
+        self.idct_blocks = decoder.idct_blocks
+        self.quant = numpy.array(decoder.block_quant[:self.idct_blocks], dtype=numpy.int64)
+        self.pixelsize = decoder.PixelSize
+        self.channels = decoder.channels
+        # (first block, h, v, up-sampling h, up-sampling v) of each component
+        self.components = []
+        first = 0
+        for comp in decoder.comp_info:
+            h, v = comp.h_samp_factor, comp.v_samp_factor
+            self.components.append(
+                (first, h, v, decoder.McuWidth // (8 * h), decoder.McuHeight // (8 * v)))
+            first += h * v
+        if decoder.mode == 'L':
+            del self.components[1:]
+
+    def reconstruct_tiles(self, coeffs, outbuf, outpos, nRows, nCols, nRowBytes, top=0, left=0):
+        """turn the dct coefficients of tiles next to each other, a list of 64
+        entry lists, into nRows * nCols pixels of them, starting at row top
+        and column left, written to outbuf at outpos, rows nRowBytes apart;
+        in the mode of the decoder, RGB, BGR, RGBA or L"""
+        coeffs = numpy.array(coeffs, dtype=numpy.int64).reshape(-1, self.blocks, 64)
+        samples = inverse_dct(coeffs[:, :self.idct_blocks], self.quant, self.range_limit)
+        rows = slice(top, top + nRows)
+        cols = slice(left, left + nCols)
+        planes = []
+        for first, h, v, hs, vs in self.components:
+            plane = component_samples(samples, first, h, v)
+            # chroma up-sampling, eg. 2 times in both directions for 4:2:0,
+            # horizontally only for 4:2:2
+            if vs > 1:
+                plane = plane.repeat(vs, axis=1)
+            if hs > 1:
+                plane = plane.repeat(hs, axis=2)
+            planes.append(tiles_to_band(plane)[rows, cols])
+        rgb = numpy.empty((nRows, nCols, self.pixelsize), dtype=numpy.uint8)
+        if self.pixelsize == 4:
+            # opaque RGBA
+            rgb[..., 3] = 255
+        if len(planes) == 1:
+            # grayscale or L, no color conversion
+            rgb[..., :3] = planes[0][..., numpy.newaxis]
+        else:
+            R, G, B = self.channels
+            y, cb, cr = [plane.astype(numpy.int64) for plane in planes]
+            rgb[..., R] = numpy.clip(y + self.CrToR[cr], 0, 255)
+            rgb[..., G] = numpy.clip(y + ((self.CbToG[cb] + self.CrToG[cr]) >> 16), 0, 255)
+            rgb[..., B] = numpy.clip(y + self.CbToB[cb], 0, 255)
+        out = numpy.frombuffer(outbuf, dtype=numpy.uint8)
+        rgb = rgb.reshape(nRows, nCols * self.pixelsize)
+        for row in range(nRows):
+            pos = outpos + row * nRowBytes
+            out[pos:pos + nCols * self.pixelsize] = rgb[row]
+
+    def reconstruct_planes(self, coeffs, planes, sizes, yTile):
+        """turn the dct coefficients of a row of tiles, the row yTile, into
+        the samples of each component, written to its rows of planes, the
+        bytearrays of sizes (width, height), without up-sampling"""
+        coeffs = numpy.array(coeffs, dtype=numpy.int64).reshape(-1, self.blocks, 64)
+        samples = inverse_dct(coeffs, self.quant, self.range_limit)
+        for (first, h, v, hs, vs), plane, (width, height) in zip(self.components, planes, sizes):
+            band = tiles_to_band(component_samples(samples, first, h, v))
+            top = yTile * v * 8
+            nRows = min(v * 8, height - top)
+            out = numpy.frombuffer(plane, dtype=numpy.uint8).reshape(height, width)
+            out[top:top + nRows] = band[:nRows, :width]
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2012, Jonas Obrist
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the Jonas Obrist nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL JONAS OBRIST BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Decoding and encoding of one image on several processes.
+
+With a restart interval (a DRI marker), the entropy coded data is split by
+RSTn markers into segments that can be decoded independently, as the DC
+predictions start over at each of them. The encoder makes use of that the
+other way around: it codes strips of MCU rows, a restart interval each, on
+the processes and joins them with RSTn markers.
+"""
+from pymaging_jpg.compat import as_buffer
+from pymaging_jpg.encoder import add_counts, new_counts
+from pymaging_jpg.pool import worker_pool
+import multiprocessing
+import re
+
+RESTART_MARKER = re.compile(b'\xff[\xd0-\xd7]')
+
+# Number of tasks per worker the segments are grouped into
+TASKS_PER_WORKER = 4
+
+
+def split_segments(inbuf, start):
+    """split the entropy coded data from start at the restart markers"""
+    segments = []
+    for match in RESTART_MARKER.finditer(inbuf, start):
+        segments.append(inbuf[start:match.start()])
+        start = match.end()
+    segments.append(inbuf[start:])
+    return segments
+
+
+def decode_segments(header, segments, first_tile, use_numpy, mode='RGB'):
+    """decode consecutive segments, starting with the tile first_tile;
+    runs in the workers, header is the jpg data up to the entropy coded data"""
+    with worker_pool(use_numpy).decoder() as decoder:
+        decoder.read_headers(header)
+        decoder.mode = mode
+        decoder.start_output()
+        rects = []
+        for segment in segments:
+            rects.extend(decoder.decode_segment(segment, first_tile))
+            first_tile += decoder.restart_interval
+    return rects
+
+
+def decode(decoder, inbuf, executor=None, max_workers=None, mode='RGB'):
+    """
+    Like decoder.decode(inbuf, mode=mode), but decodes the restart interval
+    segments on executor, a concurrent.futures.ProcessPoolExecutor with
+    max_workers processes by default. Images without restart interval are
+    decoded by decoder itself. inbuf may be an mmap.mmap of the file, or a
+    memoryview of it, only the segments sent to the workers are copied out
+    of it.
+    """
+    inbuf = as_buffer(inbuf)
+    decoder.reset()
+    decoder.read_headers(inbuf)
+    decoder.whole_image = True
+    decoder.mode = mode
+    decoder.start_output()
+    total_tiles = decoder.cxTile * decoder.cyTile
+    segments = []
+    # the restart intervals of a progressive image are in its scans, and
+    # planar output is not made of rectangles of pixels
+    if decoder.restart_interval and not decoder.Progressive and mode != 'YCbCr':
+        segments = split_segments(inbuf, decoder.DataPos)
+        # a segment per restart interval, and the remaining data after the last
+        segments = segments[:(total_tiles + decoder.restart_interval - 1) // decoder.restart_interval]
+    if len(segments) < 2 or len(segments) * decoder.restart_interval < total_tiles:
+        return decoder.decode(inbuf, mode=mode)
+
+    header = inbuf[:decoder.DataPos]
+    if isinstance(inbuf, memoryview):
+        # slices of a memoryview can't be sent to the workers
+        header = header.tobytes()
+        segments = [segment.tobytes() for segment in segments]
+    workers = max_workers or multiprocessing.cpu_count()
+    per_task = max(1, len(segments) // (workers * TASKS_PER_WORKER))
+    starts = range(0, len(segments), per_task)
+    own_executor = executor is None
+    if own_executor:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers)
+    try:
+        results = executor.map(
+            decode_segments,
+            [header] * len(starts),
+            [segments[start:start + per_task] for start in starts],
+            [start * decoder.restart_interval for start in starts],
+            [decoder.use_numpy] * len(starts),
+            [mode] * len(starts))
+        # stitch the tiles together
+        outbuf = decoder.outbuf
+        nRowBytes, pixelsize = decoder.nRowBytes, decoder.PixelSize
+        for rects in results:
+            for x, y, width, height, pixels in rects:
+                rowbytes = width * pixelsize
+                for row in range(height):
+                    pos = (y + row) * nRowBytes + x * pixelsize
+                    outbuf[pos:pos + rowbytes] = pixels[row * rowbytes:(row + 1) * rowbytes]
+    finally:
+        if own_executor:
+            executor.shutdown()
+    return outbuf
+
+
+def encode_strips(encoder, pixels, pixelsize, height, strips, count=False):
+    """code consecutive strips, the (first, last) MCU rows of restart
+    intervals, or only count their Huffman symbols; runs in the workers,
+    pixels holds the height image rows of the strips"""
+    offset = strips[0][0]
+    width, restart_rows = encoder.Width, encoder.RestartRows
+    # a copy, the executor may run threads
+    encoder = encoder.clone()
+    encoder.start(width, height, restart_rows)
+    if count:
+        counts = new_counts()
+        for first, last in strips:
+            encoder.count_rows(pixels, pixelsize, first - offset, last - offset, counts)
+        return counts
+    return [encoder.encode_rows(pixels, pixelsize, first - offset, last - offset)
+            for first, last in strips]
+
+
+def encode(encoder, pixels, width, height, pixelsize=3, executor=None, max_workers=None):
+    """
+    Like encoder.encode(pixels, width, height, pixelsize), but codes the
+    restart intervals on executor, a concurrent.futures.ProcessPoolExecutor
+    with max_workers processes by default. Without encoder.restart_rows,
+    the image gets a restart interval per task. The symbols are counted on
+    the executor as well for encoder.optimize.
+    """
+    workers = max_workers or multiprocessing.cpu_count()
+    restart_rows = encoder.restart_rows
+    if not restart_rows:
+        encoder.start(width, height)
+        tasks = workers * TASKS_PER_WORKER
+        restart_rows = (encoder.cyMcu + tasks - 1) // tasks
+    encoder.start(width, height, restart_rows)
+    strips = encoder.strips()
+    if len(strips) < 2:
+        return encoder.encode(pixels, width, height, pixelsize)
+
+    per_task = max(1, len(strips) // (workers * TASKS_PER_WORKER))
+    tasks = [strips[start:start + per_task] for start in range(0, len(strips), per_task)]
+    rowbytes = width * pixelsize
+    rows = []
+    for task in tasks:
+        first = task[0][0] * encoder.McuSize
+        last = min(task[-1][1] * encoder.McuSize, height)
+        rows.append((pixels[first * rowbytes:last * rowbytes], last - first))
+    own_executor = executor is None
+    if own_executor:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers)
+    try:
+        def run(count):
+            return executor.map(
+                encode_strips,
+                [encoder] * len(tasks),
+                [data for data, _ in rows],
+                [pixelsize] * len(tasks),
+                [nrows for _, nrows in rows],
+                tasks,
+                [count] * len(tasks))
+        if encoder.optimize:
+            counts = new_counts()
+            for task_counts in run(True):
+                add_counts(counts, task_counts)
+            encoder.set_optimal_tables(counts)
+        coded = []
+        for task_strips in run(False):
+            coded.extend(task_strips)
+    finally:
+        if own_executor:
+            executor.shutdown()
+    return encoder.finish(coded)
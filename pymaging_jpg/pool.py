@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2012, Jonas Obrist
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the Jonas Obrist nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL JONAS OBRIST BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+A pool of decoders to reuse, with their working buffers, across images.
+
+A decoder allocates its coefficient and sample buffers for the layout of the
+first image it decodes and keeps them for the next ones with the same
+layout, so workers decoding many images should hold on to their decoders.
+"""
+from contextlib import contextmanager
+import threading
+
+from pymaging_jpg.raw import TonyJpegDecoder
+
+DEFAULT_SIZE = 4
+
+
+class DecoderPool(object):
+    """keeps up to size idle decoders; use_numpy is passed to new ones"""
+    def __init__(self, size=DEFAULT_SIZE, use_numpy=None):
+        self.size = size
+        self.use_numpy = use_numpy
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """an idle decoder, or a new one if there is none"""
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return TonyJpegDecoder(self.use_numpy)
+
+    def release(self, decoder):
+        """give back a decoder from acquire, it is dropped if the pool is full"""
+        decoder.reset()
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(decoder)
+
+    @contextmanager
+    def decoder(self):
+        decoder = self.acquire()
+        try:
+            yield decoder
+        finally:
+            self.release(decoder)
+
+
+# decoders of the worker processes of parallel decoding, by use_numpy
+worker_pools = {}
+
+
+def worker_pool(use_numpy):
+    pool = worker_pools.get(use_numpy)
+    if pool is None:
+        pool = worker_pools.setdefault(use_numpy, DecoderPool(use_numpy=use_numpy))
+    return pool
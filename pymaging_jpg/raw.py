@@ -23,8 +23,10 @@ Based on C++ code by Dr. Tony Lin:
 *****************************************************************************/
 """
 # The license is based off the license used by libjpeg
-from pymaging_jpg.compat import byteord
-from functools import reduce
+from pymaging_jpg import numpy_backend
+from pymaging_jpg.compat import as_buffer, bytes_to_int, view_find
+from pymaging_jpg.tables import huffman_tables, quant_tables
+from collections import namedtuple
 
 
 # JPEG marker codes
@@ -93,6 +95,35 @@ M_TEM   = 0x01
 
 M_ERROR = 0x100
 
+# Return codes of read_markers and decompress (the IJG ones, as used by
+# TonyJpegLib)
+JPEG_SUSPENDED = -1
+JPEG_REACHED_SOS = 0
+JPEG_REACHED_EOI = 1
+JPEG_ROW_COMPLETED = 2
+
+# Default number of bytes read from a file object at a time
+CHUNK_SIZE = 65536
+
+# the supported values of TonyJpegDecoder.Scale, and the log2 of the size of
+# the decoded blocks at that scale
+SCALES = {1: 3, 2: 2, 4: 1, 8: 0}
+
+# the output modes of TonyJpegDecoder, and their bytes per pixel: RGB, BGR,
+# or RGBA with an opaque alpha; L for the luma (Y) only, without any chroma
+# reconstruction; YCbCr for a plane of each component at its own resolution,
+# without up-sampling or color conversion
+MODES = {'RGB': 3, 'BGR': 3, 'RGBA': 4, 'L': 1, 'YCbCr': 1}
+# the positions of R, G and B in the pixels of the interleaved color modes
+CHANNELS = {'RGB': (0, 1, 2), 'BGR': (2, 1, 0), 'RGBA': (0, 1, 2)}
+
+# Worst case size of one MCU in the entropy coded data, used to decide when
+# the input has to be refilled (or decoding suspended) before the next MCU:
+# a block needs at most 16 + 11 bits for the DC and 63 * (16 + 10) bits for
+# the AC coefficients, doubled for byte stuffing, a MCU holds at most 10
+# blocks, and the bit buffer may read 8 (stuffed) bytes ahead past a marker.
+MAX_MCU_BYTES = 10 * 2 * ((16 + 11 + 63 * (16 + 10)) // 8 + 1) + 2 * 8 + 2
+
 # jpeg_natural_order[i] is the natural-order position of the i'th
 # element of zigzag order.
 
@@ -119,6 +150,202 @@ jpeg_natural_order = [
 ]
 
 
+# These are the sample quantization tables given in JPEG spec section K.1,
+# in natural order. They are used as the reference for quality estimation.
+std_luminance_quant_tbl = [
+    16,  11,  10,  16,  24,  40,  51,  61,
+    12,  12,  14,  19,  26,  58,  60,  55,
+    14,  13,  16,  24,  40,  57,  69,  56,
+    14,  17,  22,  29,  51,  87,  80,  62,
+    18,  22,  37,  56,  68, 109, 103,  77,
+    24,  35,  55,  64,  81, 104, 113,  92,
+    49,  64,  78,  87, 103, 121, 120, 101,
+    72,  92,  95,  98, 112, 100, 103,  99
+]
+
+std_chrominance_quant_tbl = [
+    17,  18,  24,  47,  99,  99,  99,  99,
+    18,  21,  26,  66,  99,  99,  99,  99,
+    24,  26,  56,  99,  99,  99,  99,  99,
+    47,  66,  99,  99,  99,  99,  99,  99,
+    99,  99,  99,  99,  99,  99,  99,  99,
+    99,  99,  99,  99,  99,  99,  99,  99,
+    99,  99,  99,  99,  99,  99,  99,  99,
+    99,  99,  99,  99,  99,  99,  99,  99
+]
+
+
+def quality_scaled_table(std_tbl, quality):
+    """scale a reference quantization table like IJG's jpeg_quality_scaling"""
+    if quality < 50:
+        scale = 5000 // quality
+    else:
+        scale = 200 - quality * 2
+    return [max(1, min(255, (q * scale + 50) // 100)) for q in std_tbl]
+
+
+def estimate_quality(qtbl, std_tbl=std_luminance_quant_tbl):
+    """Estimate the IJG quality setting (1..100) that produced qtbl
+    by finding the closest quality scaled version of std_tbl"""
+    best_quality, best_error = 100, None
+    for quality in range(100, 0, -1):
+        candidate = quality_scaled_table(std_tbl, quality)
+        error = sum(abs(a - b) for a, b in zip(candidate, qtbl))
+        if best_error is None or error < best_error:
+            best_quality, best_error = quality, error
+    return best_quality
+
+
+# bits looked up at once in the first level Huffman tables; longer codes, up
+# to 16 bits, are looked up in second level tables of the remaining bits
+HUFF_LOOKAHEAD = 10
+HUFF_LOOKAHEAD2 = 16 - HUFF_LOOKAHEAD
+# entry for bit sequences that are no Huffman code, in corrupt data: take
+# all the bits and fake a zero as the safest result
+HUFF_INVALID = (16, 0, 0, 0)
+# the bit buffer is filled up to MAX_GET_BITS bits at once where there is no
+# 0xFF byte in the data, otherwise to at least MIN_GET_BITS bits
+MIN_GET_BITS = 32
+MAX_GET_BITS = 64
+# the longest ac code with its value bits, for 8 bit samples
+AC_GET_BITS = 16 + 10
+
+
+def huff_extend(x, s):
+    """the value of the s bits x after a Huffman code, section F.2.2.1"""
+    if s and x < (1 << (s - 1)):
+        return x + ((-1) << s) + 1
+    return x
+
+
+def build_huffman_table(key):
+    """the HuffTable of a raw DHT table: 16 counts of codes, then the symbols"""
+    data = bytearray(key)
+    htbl = HuffTable()
+    htbl.bits[1:17] = list(data[:16])
+    htbl.huffval[:len(data) - 16] = list(data[16:])
+    htbl.compute()
+    return htbl
+
+
+# These are the sample quantization tables given in JPEG spec section K.1.
+# The spec says that the values given produce "good" quality, and
+# when divided by 2, "very good" quality.
+
+#   scalefactor[0] = 1
+#   scalefactor[k] = cos(k*PI/16) * sqrt(2)    for k=1..7
+# We apply a further scale factor of 8.
+aanscales = [
+  # precomputed values scaled up by 14 bits
+  16384, 22725, 21407, 19266, 16384, 12873,  8867,  4520,
+  22725, 31521, 29692, 26722, 22725, 17855, 12299,  6270,
+  21407, 29692, 27969, 25172, 21407, 16819, 11585,  5906,
+  19266, 26722, 25172, 22654, 19266, 15137, 10426,  5315,
+  16384, 22725, 21407, 19266, 16384, 12873,  8867,  4520,
+  12873, 17855, 16819, 15137, 12873, 10114,  6967,  3552,
+   8867, 12299, 11585, 10426,  8867,  6967,  4799,  2446,
+   4520,  6270,  5906,  5315,  4520,  3552,  2446,  1247]
+
+
+def build_aan_quant_table(key):
+    """the raw DQT table key, in natural order, scaled for the AA&N idct"""
+    half = 1 << 11
+    return [(q * aan + half) >> 12 for q, aan in zip(bytearray(key), aanscales)]
+
+
+def build_range_table():
+    """
+    prepare_range_limit_table(): the range table [5*256+128 = 1408]
+    range table is used for range limiting of idct results
+    On most machines, particularly CPUs with pipelines or instruction prefetch,
+    a (subscript-check-less) C table lookup
+          x = sample_range_limit[x]
+    is faster than explicit tests
+            if (x < 0)  x = 0
+            else if (x > MAXJSAMPLE)  x = MAXJSAMPLE
+    """
+    # tblRange[0, ..., 255], limit[x] = 0 for x < 0
+    # tblRange[256, ..., 511], limit[x] = x
+    # tblRange[512, ..., 895]: first half of post-IDCT table
+    # tblRange[896, ..., 1280]: Second half of post-IDCT table
+    # tblRange[1280, 1407] = tblRange[256, 384]
+    return [0]*256 + list(range(256)) + [255]*(512-128) + [0]*384 + list(range(128))
+
+
+def build_color_tables():
+    """YCbCr -> RGB conversion: most common case
+
+    YCbCr is defined per CCIR 601-1, except that Cb and Cr are
+    normalized to the range 0..MAXJSAMPLE rather than -0.5 .. 0.5.
+    The conversion equations to be implemented are therefore
+         R = Y                + 1.40200 * Cr
+         G = Y - 0.34414 * Cb - 0.71414 * Cr
+         B = Y + 1.77200 * Cb
+    where Cb and Cr represent the incoming values less CENTERJSAMPLE.
+    (These numbers are derived from TIFF 6.0 section 21, dated 3-June-92.)
+
+    To avoid floating-point arithmetic, we represent the fractional constants
+    as integers scaled up by 2^16 (about 4 digits precision); we have to divide
+    the products by 2^16, with appropriate rounding, to get the correct answer.
+    Notice that Y, being an integral input, does not contribute any fraction
+    so it need not participate in the rounding.
+
+    For even more speed, we avoid doing any multiplications in the inner loop
+    by precalculating the constants times Cb and Cr for all possible values.
+    For 8-bit JSAMPLEs this is very reasonable (only 256 entries per table)
+    for 12-bit samples it is still acceptable.  It's not very reasonable for
+    16-bit samples, but if you want lossless storage you shouldn't be changing
+    colorspace anyway.
+    The Cr=>R and Cb=>B values can be rounded to integers in advance; the
+    values for the G calculation are left scaled up, since we must add them
+    together before rounding.
+
+    returns the CrToR, CrToG, CbToB and CbToG tables
+    """
+    CrToR, CrToG, CbToB, CbToG = [0]*256, [0]*256, [0]*256, [0]*256
+    # i is the actual input pixel value, in the range 0..MAXJSAMPLE
+    nScale = 1 << 16 # equal to pow(2,16)
+    nHalf = nScale >> 1
+    FIX = lambda x: int((x) * nScale + 0.5)
+    for i in range(256):
+        # The Cb or Cr value we are thinking of is x = i - CENTERJSAMPLE
+        # We also add in ONE_HALF so that need not do it in inner loop
+        x = i - 128
+        # Cr=>R value is nearest int to 1.40200 * x
+        CrToR[i] = (int) ( FIX(1.40200) * x + nHalf ) >> 16
+        # Cb=>B value is nearest int to 1.77200 * x
+        CbToB[i] = (int) ( FIX(1.77200) * x + nHalf ) >> 16
+        # Cr=>G value is scaled-up -0.71414 * x
+        CrToG[i] = (int) (- FIX(0.71414) * x)
+        # Cb=>G value is scaled-up -0.34414 * x
+        CbToG[i] = (int) (- FIX(0.34414) * x + nHalf)
+    return CrToR, CrToG, CbToB, CbToG
+
+
+# the tables that do not depend on the image, built once
+RANGE_TABLE = build_range_table()
+# RANGE_TABLE for the idct output, centered on CENTERJSAMPLE
+IDCT_RANGE_LIMIT = RANGE_TABLE[256+128:]
+# RANGE_TABLE for the color conversion; this is to handle negative offsets
+RGB_RANGE_LIMIT = RANGE_TABLE[256:] + RANGE_TABLE[:256]
+COLOR_TABLES = build_color_tables()
+
+
+# to clear the coefficients of a block
+ZERO_COEFFS = [0]*64
+
+# fixed point helpers of the idcts
+MULTIPLY = lambda var, cons: int(var*cons)>>8
+DESCALE = lambda x, n: (x + (1 << (n - 1))) >> n
+
+
+# Lightweight description of an image, as returned by TonyJpegDecoder.get_info
+JpegInfo = namedtuple('JpegInfo', [
+    'width', 'height', 'precision', 'components', 'sampling',
+    'restart_interval', 'quality'
+])
+
+
 class JPEGComponentInfo(object):
     component_id = 0        # identifier for this component (0..255)
     component_index = 0        # its index in SOF or cinfo->comp_info[]
@@ -134,8 +361,10 @@ class HuffTable(object):
         self.valptr = [0]*17
         self.bits = [0]*17
         self.huffval = [0]*256
-        self.look_nbits = [0]*256
-        self.look_sym = [0]*256
+        # (bits, run, size, value) by the next HUFF_LOOKAHEAD bits, see compute
+        self.lookup = [HUFF_INVALID] * (1 << HUFF_LOOKAHEAD)
+        # second level tables of the entries in lookup which are None
+        self.lookup2 = {}
 
     def compute(self):
         """Compute the derived values for a Huffman table."""
@@ -177,87 +406,329 @@ class HuffTable(object):
                 self.maxcode[l] = -1             # -1 if no codes of this length
         self.maxcode[17] = 0xFFFFF  # ensures jpeg_huff_decode terminates
 
-        """ Compute lookahead tables to speed up decoding.
-         First we set all the table entries to 0, indicating "too long"
-         then we iterate through the Huffman codes that are short enough and
-         fill in all the entries that correspond to bit sequences starting
-         with that code.     """
-        self.look_nbits = [0]*256
-        HUFF_LOOKAHEAD = 8
+        """ Compute lookup tables to decode a code in one step.
+         The entries of the first level table, indexed by the next
+         HUFF_LOOKAHEAD bits, are tuples (bits, run, size, value): bits
+         Huffman code bits to drop, and the symbol split into the run of
+         zero ac coefficients and the size of the value bits after the code.
+         If these fit in the lookahead as well they are decoded already:
+         bits covers them, size is 0 and value is the sign extended value.
+         Codes longer than HUFF_LOOKAHEAD bits have a None entry, and are
+         looked up with the next HUFF_LOOKAHEAD2 bits in lookup2[prefix]. """
+        self.lookup = lookup = [HUFF_INVALID] * (1 << HUFF_LOOKAHEAD)
+        self.lookup2 = {}
         p = 0
-        for l in range(1, HUFF_LOOKAHEAD+1):
-            for _ in range(1, self.bits[l]+1):
-                """ l = current code's length,
-                p = its index in huffcode[] & huffval[]. Generate left-justified
-                code followed by all possible bit sequences """
-                lookbits = huffcode[p] << (HUFF_LOOKAHEAD-l)
-                ctr = 1 << (HUFF_LOOKAHEAD-l)
-                while ctr > 0:
-                    self.look_nbits[lookbits] = l
-                    self.look_sym[lookbits] = self.huffval[p]
-                    lookbits += 1
-                    ctr -= 1
+        for l in range(1, 17):
+            for _ in range(self.bits[l]):
+                run, size = self.huffval[p] >> 4, self.huffval[p] & 15
+                if l <= HUFF_LOOKAHEAD:
+                    # all the bit sequences starting with the code
+                    spare = HUFF_LOOKAHEAD - l
+                    first = huffcode[p] << spare
+                    for lookbits in range(first, first + (1 << spare)):
+                        if size <= spare:
+                            offset = (lookbits >> (spare - size)) & ((1 << size) - 1)
+                            lookup[lookbits] = (l + size, run, 0, huff_extend(offset, size))
+                        else:
+                            lookup[lookbits] = (l, run, size, 0)
+                else:
+                    prefix = huffcode[p] >> (l - HUFF_LOOKAHEAD)
+                    lookup[prefix] = None
+                    if prefix not in self.lookup2:
+                        self.lookup2[prefix] = [HUFF_INVALID] * (1 << HUFF_LOOKAHEAD2)
+                    spare = 16 - l
+                    first = (huffcode[p] << spare) & ((1 << HUFF_LOOKAHEAD2) - 1)
+                    for lookbits in range(first, first + (1 << spare)):
+                        self.lookup2[prefix][lookbits] = (l, run, size, 0)
                 p += 1
 
 
 class TonyJpegDecoder(object):
-    def __init__(self):
-        """set up the decoder"""
+    def __init__(self, use_numpy=None):
+        """set up the decoder
+        use_numpy: reconstruct rows of tiles with numpy_backend, by default
+        if NumPy is installed"""
+        if use_numpy is None:
+            use_numpy = numpy_backend.available
+        self.use_numpy = use_numpy
+        # working buffers, kept across images, see alloc_buffers:
+        # the dct coefficients of each block of a tile
+        self.coeffs = []
+        # the idct output, the samples of the blocks of a tile
+        self.samples = []
+        # buffers data between the idct passes
+        self.workspace = [0]*64
+        # number of times the buffers were allocated
+        self.buffer_allocations = 0
+        # keep the EXIF data of the images in self.exif rather than skip it
+        self.save_exif = False
+        # the stats.DecodeStats of the image, and the hook called with it,
+        # see enable_stats
+        self.stats = None
+        self.stats_hook = None
+        # with stats, the Huffman codes decoded with the first and with the
+        # second level lookup table, see HuffTable
+        self.huffman_counts = None
+        self.reset()
+
+    def enable_stats(self, hook=None):
+        """collect the counters and stage times of each image decoded from
+        now on in self.stats, a stats.DecodeStats, and call hook with it at
+        the end of the image; a decoder without them runs at full speed.
+        Calling it again only replaces hook."""
+        from pymaging_jpg.stats import instrument
+        instrument(self, hook)
+
+    def reset(self):
+        """forget the image decoded last, to decode another one with the
+        same decoder and its buffers; the decode and iter_bands methods do
+        this themselves, call it before feeding another image"""
+        # numpy_backend.Reconstructor, and the coefficients of the tiles
+        # of the current row it has still to reconstruct
+        self.reconstructor = None
+        self.row_coeffs = []
+        # where the first of those tiles goes, see decompress
+        self.row_outpos = 0
+        self.row_left = 0
         self.Quality = 0
-        self.Scale = 0
-        self.tblRange = [0]*(5*256+128)
+        # decode at 1/Scale of the size, see SCALES
+        self.Scale = 1
+        # the output mode and its bytes per pixel, see MODES
+        self.mode = 'RGB'
+        self.PixelSize = 3
+        self.channels = CHANNELS['RGB']
+        # the (width, height) of the planes of the YCbCr mode
+        self.plane_sizes = []
+        self.tblRange = RANGE_TABLE
         # To speed up, we save YCbCr=>RGB color map tables
-        self.CrToR = {}
-        self.CrToG = {}
-        self.CbToB = {}
-        self.CbToG = {}
-        # To speed up, we precompute two DCT quant tables
-        self.qtblY = {}
-        self.qtblCbCr = {}
-        self.htblYDC = HuffTable()
-        self.htblYAC = HuffTable()
-        self.htblCbCrDC = HuffTable()
-        self.htblCbCrAC = HuffTable()
+        self.CrToR, self.CrToG, self.CbToB, self.CbToG = COLOR_TABLES
+        # the quant table of each block of an MCU, scaled for the AA&N idct,
+        # and as in the file for the reduced size idcts, see init_quant_table
+        self.block_quant = []
+        self.block_quant_raw = []
+        # all the DHT tables by their index byte, 0..3 for dc, 16..19 for ac
+        self.huff_tables = {}
+        # the (dc, ac) Huffman tables of each block of an MCU
+        self.block_tables = []
         # per image parameters
         self.Width = 0
         self.Height = 0
-        self.McuSize = 0
+        # the MCU covers McuWidth*McuHeight pixels, its blocks are those of
+        # the components in order, mcu_components has the component of each
+        self.McuWidth = 0
+        self.McuHeight = 0
         self.BlocksInMcu = 0
-        self.dcY = 0
-        self.dcCb = 0
-        self.dcCr = 0
+        self.mcu_components = []
+        # the first idct_blocks blocks of an MCU are reconstructed, all of
+        # them or only those of Y for the L mode
+        self.idct_blocks = 0
+        # size of the decoded tiles and blocks, and of the image, at Scale
+        self.TileWidth = 0
+        self.TileHeight = 0
+        self.BlockBits = 3
+        self.ScaledWidth = 0
+        self.ScaledHeight = 0
+        # for each component, the positions in self.samples of the samples
+        # of each row of a tile, see build_sample_maps
+        self.sample_maps = []
+        # the dc prediction of each component
+        self.dc_pred = []
         self.GetBits = 0
         self.GetBuff = 0
         self.DataBytesLeft = 0
-        self.Data = ""
+        self.Data = b""
+        # self.Data is a memoryview, without find(), see compat.as_buffer
+        self.DataView = False
         self.DataPos = 0
+        # position of self.Data in the jpeg stream
+        self.DataOffset = 0
+        # optional file object self.Data is refilled from, see set_input
+        self.fileobj = None
+        self.chunk_size = 0
+        # True once there is no more input to wait for
+        self.eof = False
+        # bytes of a skipped marker that are still to come, see feed
+        self.skip_pending = 0
         self.Precision = 0
         self.Component = 0
+        # (h, v) sampling factors of the components as in the SOF marker
+        self.sampling = ()
+        self.Progressive = False
         self.restart_interval = 0
         self.restarts_to_go = 0
         self.unread_marker = 0
         self.next_restart_num = 0
         self.comp_info = [JPEGComponentInfo(), JPEGComponentInfo(), JPEGComponentInfo()]
-
-    def read_headers(self, jpegsrc):
+        # raw quantization tables from DQT, natural order, by table number
+        self.qtables = {}
+        # the TIFF data of the EXIF APP1 segment if save_exif, see get_app1
+        self.exif = None
+        # output state, see start_output; no tiles until the headers are read
+        self.whole_image = False
+        self.outbuf = None
+        # optional (x, y, width, height) crop of the image to decode
+        self.region = None
+        # the decoded rectangle of the image, see start_output
+        self.out_x = 0
+        self.out_y = 0
+        self.out_width = 0
+        self.out_height = 0
+        self.cxTile = 0
+        self.cyTile = 0
+        self.nRowBytes = 0
+        self.next_tile = 0
+        self.last_tile = 0
+        # the row of tiles being decompressed, see decompress
+        self.band = None
+        self.band_y = 0
+        self.band_height = 0
+        # progressive images: the dct coefficients of all the blocks of each
+        # component, which the scans add to, see alloc_coef_buffer
+        self.coef_buffer = None
+        self.coef_widths = []
+        # the blocks of each component with samples in the image
+        self.comp_blocks = []
+        # the blocks of the tile to output, see buffered_tile
+        self.tile_blocks = []
+        # stop after that many scans, for a preview
+        self.max_scans = None
+        self.scans_completed = 0
+        self.scans_done = False
+        # the current scan: (component index, dc table, ac table) of its
+        # components, spectral selection and successive approximation
+        self.scan_info = []
+        self.Ss = 0
+        self.Se = 63
+        self.Ah = 0
+        self.Al = 0
+        # MCUs of the scan, the next one to decode, and its decoding state
+        self.scan_mcus = 0
+        self.scan_mcu = 0
+        self.EOBRUN = 0
+
+    def set_input(self, fileobj, chunk_size):
+        """read the jpeg stream from fileobj, chunk_size bytes at a time"""
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.eof = False
+        self.Data = b""
+        self.DataView = False
+        self.DataPos = 0
+        self.DataOffset = 0
+
+    def set_buffer(self, inbuf):
+        """read the jpeg stream from inbuf, all of it in memory: bytes, or
+        any object with the buffer interface, eg. a bytearray, a memoryview
+        or an mmap.mmap of a file, or a slice of a memoryview of it, which is
+        read without a copy; see compat.as_buffer"""
+        self.fileobj = None
+        self.eof = True
+        self.Data = as_buffer(inbuf)
+        self.DataView = isinstance(self.Data, memoryview)
+        self.DataPos = 0
+        self.DataOffset = 0
+
+    def peek_stream(self, pos, nbytes):
+        """up to nbytes of the jpeg stream at pos, as bytes; the decoding
+        continues where it was"""
+        current = self.DataOffset + self.DataPos
+        self.seek_input(pos)
+        self.fill_input(nbytes)
+        data = bytes(self.Data[self.DataPos:self.DataPos + nbytes])
+        self.seek_input(current)
+        return data
+
+    def seek_input(self, pos):
+        """continue reading at pos of the jpeg stream"""
+        if self.fileobj is None:
+            self.DataPos = pos - self.DataOffset
+        else:
+            self.fileobj.seek(pos)
+            self.eof = False
+            self.Data = b""
+            self.DataPos = 0
+            self.DataOffset = pos
+        self.DataBytesLeft = len(self.Data) - self.DataPos
+
+    def fill_input(self, nbytes):
+        """make sure nbytes are available at self.DataPos, returns False at EOF"""
+        if len(self.Data) - self.DataPos >= nbytes:
+            return True
+        if self.fileobj is None or self.eof:
+            return False
+        # drop the bytes we are done with before reading more
+        self.DataOffset += self.DataPos
+        self.Data = self.Data[self.DataPos:]
+        self.DataPos = 0
+        while len(self.Data) < nbytes:
+            chunk = self.fileobj.read(max(self.chunk_size, nbytes - len(self.Data)))
+            if not chunk:
+                self.eof = True
+                break
+            self.Data += as_buffer(chunk)
+        self.DataBytesLeft = len(self.Data)
+        return len(self.Data) >= nbytes
+
+    def skip_input(self, nbytes):
+        """skip nbytes without keeping them in memory"""
+        available = len(self.Data) - self.DataPos
+        if nbytes <= available:
+            self.DataPos += nbytes
+            return
+        nbytes -= available
+        self.DataOffset += len(self.Data)
+        self.Data = b""
+        self.DataPos = 0
+        while nbytes > 0 and self.fileobj is not None:
+            chunk = self.fileobj.read(min(self.chunk_size, nbytes))
+            if not chunk:
+                self.eof = True
+                break
+            nbytes -= len(chunk)
+            self.DataOffset += len(chunk)
+        # the rest has to be dropped from the data given to feed
+        self.skip_pending = nbytes
+
+    def get_info(self):
+        """describe the image from the headers read so far"""
+        quality = 0
+        if 0 in self.qtables:
+            quality = estimate_quality(self.qtables[0])
+        return JpegInfo(self.Width, self.Height, self.Precision, self.Component,
+                        self.sampling, self.restart_interval, quality)
+
+    def read_headers(self, jpegsrc=None):
         """reads Width, Height, headsize"""
-        self.read_markers(jpegsrc)
-        if self.Width <= 0 or self.Height <= 0:
+        ret = self.read_markers(jpegsrc)
+        if ret == JPEG_SUSPENDED:
+            return JPEG_SUSPENDED
+        if ret != JPEG_REACHED_SOS or self.Width <= 0 or self.Height <= 0:
             raise ValueError("Error reading the file header")
-        self.DataBytesLeft = len(jpegsrc) - self.DataPos
+        self.DataBytesLeft = len(self.Data) - self.DataPos
         self.init_decoder()
+        return JPEG_REACHED_SOS
+
+    # self.Data indexes to ints, see compat.as_buffer
 
     def read_byte(self):
         byte = self.Data[self.DataPos]
         self.DataPos += 1
-        output = byteord(byte)
-        return output
+        return byte
+
+    def read_bytes(self, nbytes):
+        """the next nbytes, as a bytearray"""
+        data = bytearray(self.Data[self.DataPos:self.DataPos + nbytes])
+        self.DataPos += nbytes
+        return data
 
     def read_word(self):
-        byte1, byte2 = self.Data[self.DataPos:self.DataPos+2]
+        pos = self.DataPos
         self.DataPos += 2
-        output = (byteord(byte1)<<8) + byteord(byte2)
-        return output
+        return (self.Data[pos] << 8) + self.Data[pos + 1]
+
+    def peek_word(self, offset=0):
+        pos = self.DataPos + offset
+        return (self.Data[pos] << 8) + self.Data[pos + 1]
 
     def read_one_marker(self):
         """read exact marker, two bytes, no stuffing allowed"""
@@ -268,7 +739,16 @@ class TonyJpegDecoder(object):
     def skip_marker(self):
         """Skip over an unknown or uninteresting variable-length marker"""
         length = self.read_word()
-        self.DataPos += length - 2
+        self.skip_input(length - 2)
+
+    def get_app1(self):
+        """keep the TIFF data of the first EXIF APP1 segment in self.exif,
+        skip the others, eg. XMP"""
+        length = self.read_word() - 2
+        data = self.Data[self.DataPos:self.DataPos + length]
+        self.DataPos += length
+        if self.exif is None and data[:6] == b'Exif\x00\x00':
+            self.exif = bytes(data[6:])
 
     def get_dqt(self):
         length = self.read_word() - 2
@@ -276,12 +756,10 @@ class TonyJpegDecoder(object):
             n = self.read_byte()
             length -= 1
             n &= 0x0F
-            if n == 0:
-                qtb = self.qtblY
-            else:
-                qtb = self.qtblCbCr
-            for i in range(64):
-                qtb[jpeg_natural_order[i]] = self.read_byte()
+            raw = [0]*64
+            for i, q in enumerate(self.read_bytes(64)):
+                raw[jpeg_natural_order[i]] = q
+            self.qtables[n] = raw
             length -= 64
 
 
@@ -292,61 +770,74 @@ class TonyJpegDecoder(object):
         self.Height = self.read_word()
         self.Width = self.read_word()
         self.Component = self.read_byte()
+        self.Progressive = is_prog
         length -= 8
+        self.comp_info = []
+        data = self.read_bytes(3 * self.Component)
         for ci in range(self.Component):
             comp = JPEGComponentInfo()
             comp.component_index = ci
-            comp.component_id = self.read_byte()
-            c = self.read_byte()
+            comp.component_id, c, comp.quant_tbl_no = data[3 * ci:3 * ci + 3]
             comp.h_samp_factor = (c >> 4) & 15
             comp.v_samp_factor = (c     ) & 15
-            comp.quant_tbl_no = self.read_byte()
-            self.comp_info[ci] = comp
-        if self.comp_info[0].h_samp_factor == 1 and self.comp_info[0].v_samp_factor == 1:
-            self.McuSize = 8
-            self.BlocksInMcu = 3
-        else:
-            self.McuSize = 16
-            self.BlocksInMcu = 6
+            self.comp_info.append(comp)
+        self.sampling = tuple(
+            (comp.h_samp_factor, comp.v_samp_factor) for comp in self.comp_info)
+        if self.Component == 1:
+            # the scan of a single component is not interleaved, an MCU is
+            # one block whatever the sampling factors say (section A.2.2)
+            comp.h_samp_factor = comp.v_samp_factor = 1
+        self.init_mcu_layout()
+
+    def init_mcu_layout(self):
+        """the MCU of the interleaved scans, from the sampling factors: each
+        component has h_samp_factor*v_samp_factor blocks in it, row by row"""
+        hmax = max(comp.h_samp_factor for comp in self.comp_info)
+        vmax = max(comp.v_samp_factor for comp in self.comp_info)
+        self.McuWidth = 8 * hmax
+        self.McuHeight = 8 * vmax
+        self.mcu_components = []
+        for comp in self.comp_info:
+            if not comp.h_samp_factor or not comp.v_samp_factor:
+                raise ValueError("Invalid sampling factors")
+            self.mcu_components.extend(
+                [comp.component_index] * (comp.h_samp_factor * comp.v_samp_factor))
+        self.BlocksInMcu = len(self.mcu_components)
+        if self.BlocksInMcu > 10:
+            raise ValueError("Too many blocks in an MCU: %d" % self.BlocksInMcu)
 
     def get_dht(self):
         length = self.read_word() - 2
         while length > 0:
             index = self.read_byte()
-            htbl = HuffTable()
-            count = 0
-            # read in bits[]
-            htbl.bits[0] = 0
-            for i in range(1, 17):
-                htbl.bits[i] = self.read_byte()
-                count += htbl.bits[i]
-            # read in huffval
-            for i in range(count):
-                htbl.huffval[i] = self.read_byte()
-            length -= count + 17
-            if index == 0:
-                self.htblYDC = htbl
-            elif index == 16:
-                self.htblYAC = htbl
-            elif index == 1:
-                self.htblCbCrDC = htbl
-            elif index == 17:
-                self.htblCbCrAC = htbl
+            # read in bits[1..16], then huffval
+            bits = self.read_bytes(16)
+            huffval = self.read_bytes(sum(bits))
+            length -= len(huffval) + 17
+            htbl = huffman_tables.get(bytes(bits + huffval), build_huffman_table)
+            self.huff_tables[index] = htbl
 
     def get_sos(self):
         self.read_word()
         # number of components
         n = self.read_byte()
         # Collect the component-spec parameters
+        self.scan_info = []
         for _ in range(n):
-            self.read_byte()
-            self.read_byte()
-            # find the match comp_id; Current we do nothing
-            # (the C code here is commented out)
+            cc = self.read_byte()
+            c = self.read_byte()
+            for comp in self.comp_info:
+                if comp.component_id == cc:
+                    break
+            else:
+                raise ValueError("Invalid component in scan: %d" % cc)
+            self.scan_info.append((comp.component_index, (c >> 4) & 15, c & 15))
         # Collect the additional scan parameters Ss, Se, Ah/Al.
-        self.read_byte()
-        self.read_byte()
-        self.read_byte()
+        self.Ss = self.read_byte()
+        self.Se = self.read_byte()
+        c = self.read_byte()
+        self.Ah = (c >> 4) & 15
+        self.Al = c & 15
         self.next_restart_num = 0
 
     def get_dri(self):
@@ -354,18 +845,42 @@ class TonyJpegDecoder(object):
         self.restart_interval = self.read_word()
         self.restarts_to_go = self.restart_interval
 
-    def read_markers(self, inbuf):
-        """raises an error or returns if successfull"""
-        self.Data = inbuf
+    def read_markers(self, inbuf=None):
+        """raises an error or returns JPEG_REACHED_SOS if successfull
+        without inbuf, the data is read from the file object given to set_input
+        or to feed; then JPEG_SUSPENDED is returned if more data is needed"""
+        if inbuf is not None:
+            self.set_buffer(inbuf)
         while True:
+            # make sure the whole marker segment is there before parsing it,
+            # (skipped markers are dropped as they come, see skip_input)
+            if self.unread_marker:
+                # the marker after a scan, found by the entropy decoder
+                marker, offset = self.unread_marker, 0
+            else:
+                if not self.fill_input(2):
+                    return self.suspend_markers()
+                marker, offset = self.Data[self.DataPos + 1], 2
+            if marker not in (M_SOI, M_EOI):
+                if not self.fill_input(offset + 2):
+                    return self.suspend_markers()
+                if (marker in (M_DQT, M_DHT, M_DRI, M_SOS) or M_SOF0 <= marker <= M_SOF15
+                        or (marker == M_APP1 and self.save_exif)):
+                    if not self.fill_input(offset + self.peek_word(offset)):
+                        return self.suspend_markers()
             # IJG use first_marker() and next_marker()
-            marker = self.read_one_marker()
+            if self.unread_marker:
+                self.unread_marker = 0
+            else:
+                marker = self.read_one_marker()
             # read more info according to the marker
             # the order of cases is in jpg file made by ms paint
             if marker == M_SOI:
                 # if not self.get_soi(cinfo):
                 #   return -1  # JPEG_SUSPENDED
                 pass
+            elif marker == M_APP1 and self.save_exif:
+                self.get_app1()
             elif marker in (M_APP0, M_APP1, M_APP2, M_APP3, M_APP4, M_APP5, M_APP6, M_APP7, M_APP8, M_APP9, M_APP10, M_APP11, M_APP12, M_APP13, M_APP14, M_APP15):
                 self.skip_marker() # JFIF APP0 marker, or Adobe APP14 marker
             elif marker == M_DQT:
@@ -375,7 +890,7 @@ class TonyJpegDecoder(object):
                 self.get_sof(False, False)
             elif marker == M_SOF2:
                 # Progressive, Huffman
-                raise ValueError("Prog + Huff is not supported")
+                self.get_sof(True, False)
             elif marker == M_SOF9:
                 # Extended sequential, arithmetic
                 raise ValueError("Sequential + Arith is not supported")
@@ -388,12 +903,15 @@ class TonyJpegDecoder(object):
             elif marker == M_SOS:
                 # Start of Scan
                 self.get_sos()
-                return
+                return JPEG_REACHED_SOS
             elif marker == M_COM:
                 # the following marker are not needed for jpg made by ms paint
                 self.skip_marker()
             elif marker == M_DRI:
                 self.get_dri()
+            elif marker == M_EOI:
+                # after the last scan of a progressive image
+                return JPEG_REACHED_EOI
             # elif marker in (M_SOF3, M_SOF5, M_SOF6, M_SOF7, M_JPG, M_SOF11, M_SOF13, M_SOF14, M_SOF15):
             # # currently unsupported SOFn types:
             #   raise ValueError("Unsupported marker: %d" % marker)
@@ -422,11 +940,18 @@ class TonyJpegDecoder(object):
             # Successfully processed marker, so reset state variable
             self.unread_marker = 0
 
+    def suspend_markers(self):
+        """the marker at self.DataPos is read again once there is more data"""
+        if self.eof:
+            raise ValueError("Premature end of JPEG file")
+        return JPEG_SUSPENDED
+
     def read_restart_marker(self):
         # Obtain a marker unless we already did.
         # Note that next_marker will complain if it skips any data.
         if self.unread_marker == 0:
             self.unread_marker = self.read_one_marker()
+        self.DataBytesLeft = len(self.Data) - self.DataPos
         if self.unread_marker == M_RST0 + self.next_restart_num:
             # Normal case --- swallow the marker and let entropy decoder continue
             self.unread_marker = 0
@@ -447,267 +972,820 @@ class TonyJpegDecoder(object):
         """
         self.GetBits = 0
         self.GetBuff = 0
-        self.dcY = 0
-        self.dcCb = 0
-        self.dcCr = 0
+        self.dc_pred = [0] * self.Component
         # prepare range limiting table to limit idct outputs
         self.set_range_table()
         # convert table, from bgr to ycbcr
         self.init_color_table()
-        # prepare two quant tables, one for Y, and another for CbCr
+        # pick the quant table of each block
         self.init_quant_table()
-        # prepare four huffman tables:
+        # and its huffman tables
         self.init_huffman_table()
 
     def set_range_table(self):
-        """
-        prepare_range_limit_table(): Set self.tblRange[5*256+128 = 1408]
-        range table is used for range limiting of idct results
-        On most machines, particularly CPUs with pipelines or instruction prefetch,
-        a (subscript-check-less) C table lookup
-              x = sample_range_limit[x]
-        is faster than explicit tests
-                if (x < 0)  x = 0
-                else if (x > MAXJSAMPLE)  x = MAXJSAMPLE
-        """
-        # self.tblRange[0, ..., 255], limit[x] = 0 for x < 0
-        # self.tblRange[256, ..., 511], limit[x] = x
-        # self.tblRange[512, ..., 895]: first half of post-IDCT table
-        # self.tblRange[896, ..., 1280]: Second half of post-IDCT table
-        # self.tblRange[1280, 1407] = self.tblRange[256, 384]
-        self.tblRange = [0]*256 + list(range(256)) + [255]*(512-128) + [0]*384 + list(range(128))
-
-        """YCbCr -> RGB conversion: most common case
-
-        YCbCr is defined per CCIR 601-1, except that Cb and Cr are
-        normalized to the range 0..MAXJSAMPLE rather than -0.5 .. 0.5.
-        The conversion equations to be implemented are therefore
-             R = Y                + 1.40200 * Cr
-             G = Y - 0.34414 * Cb - 0.71414 * Cr
-             B = Y + 1.77200 * Cb
-        where Cb and Cr represent the incoming values less CENTERJSAMPLE.
-        (These numbers are derived from TIFF 6.0 section 21, dated 3-June-92.)
-
-        To avoid floating-point arithmetic, we represent the fractional constants
-        as integers scaled up by 2^16 (about 4 digits precision); we have to divide
-        the products by 2^16, with appropriate rounding, to get the correct answer.
-        Notice that Y, being an integral input, does not contribute any fraction
-        so it need not participate in the rounding.
-
-        For even more speed, we avoid doing any multiplications in the inner loop
-        by precalculating the constants times Cb and Cr for all possible values.
-        For 8-bit JSAMPLEs this is very reasonable (only 256 entries per table)
-        for 12-bit samples it is still acceptable.  It's not very reasonable for
-        16-bit samples, but if you want lossless storage you shouldn't be changing
-        colorspace anyway.
-        The Cr=>R and Cb=>B values can be rounded to integers in advance; the
-        values for the G calculation are left scaled up, since we must add them
-        together before rounding.
-        """
+        """range table is used for range limiting of idct results,
+        see build_range_table"""
+        self.tblRange = RANGE_TABLE
 
     def init_color_table(self):
-        # i is the actual input pixel value, in the range 0..MAXJSAMPLE
-        nScale = 1 << 16 # equal to pow(2,16)
-        nHalf = nScale >> 1
-        FIX = lambda x: int((x) * nScale + 0.5)
-        for i in range(256):
-            # The Cb or Cr value we are thinking of is x = i - CENTERJSAMPLE
-            # We also add in ONE_HALF so that need not do it in inner loop
-            x = i - 128
-            # Cr=>R value is nearest int to 1.40200 * x
-            self.CrToR[i] = (int) ( FIX(1.40200) * x + nHalf ) >> 16
-            # Cb=>B value is nearest int to 1.77200 * x
-            self.CbToB[i] = (int) ( FIX(1.77200) * x + nHalf ) >> 16
-            # Cr=>G value is scaled-up -0.71414 * x
-            self.CrToG[i] = (int) (- FIX(0.71414) * x)
-            # Cb=>G value is scaled-up -0.34414 * x
-            self.CbToG[i] = (int) (- FIX(0.34414) * x + nHalf)
+        """YCbCr => RGB color map tables, see build_color_tables"""
+        self.CrToR, self.CrToG, self.CbToB, self.CbToG = COLOR_TABLES
 
     def init_quant_table(self):
-        """init_quant_table will produce customized quantization table into: self.tblYQuant[0..63] and self.tblCbCrQuant[0..63]"""
-        # These are the sample quantization tables given in JPEG spec section K.1.
-        # The spec says that the values given produce "good" quality, and
-        # when divided by 2, "very good" quality.
-
-        #   scalefactor[0] = 1
-        #   scalefactor[k] = cos(k*PI/16) * sqrt(2)    for k=1..7
-        # We apply a further scale factor of 8.
-        aanscales = [
-          # precomputed values scaled up by 14 bits
-          16384, 22725, 21407, 19266, 16384, 12873,  8867,  4520,
-          22725, 31521, 29692, 26722, 22725, 17855, 12299,  6270,
-          21407, 29692, 27969, 25172, 21407, 16819, 11585,  5906,
-          19266, 26722, 25172, 22654, 19266, 15137, 10426,  5315,
-          16384, 22725, 21407, 19266, 16384, 12873,  8867,  4520,
-          12873, 17855, 16819, 15137, 12873, 10114,  6967,  3552,
-           8867, 12299, 11585, 10426,  8867,  6967,  4799,  2446,
-           4520,  6270,  5906,  5315,  4520,  3552,  2446,  1247]
-        def ScaleQuantTable(tblStd, tblAan):
-            half = 1 << 11
-            # scaling needed for AA&N algorithm
-            return [(tblStd[i] * tblAan[i] + half) >> 12 for i in range(64)]
-
-        # Scale the Y and CbCr quant table, respectively
-        self.qtblY = ScaleQuantTable(self.qtblY, aanscales)
-        self.qtblCbCr = ScaleQuantTable(self.qtblCbCr, aanscales)
-        # If no qtb got from jpg file header, then use std quant tbl
-        # self.qtblY = ScaleQuantTable(std_luminance_quant_tbl, aanscales)
-        # self.qtblCbCr = ScaleQuantTable(std_chrominance_quant_tbl, aanscales)
+        """init_quant_table will produce the quantization table of each block
+        of an MCU, the one of its component, into self.block_quant"""
+        scaled = {}
+        for comp in self.comp_info:
+            n = comp.quant_tbl_no
+            if n not in self.qtables:
+                raise ValueError("Quantization table %d is not defined" % n)
+            # Scale the quant table for the AA&N idct
+            if n not in scaled:
+                scaled[n] = quant_tables.get(bytes(bytearray(self.qtables[n])), build_aan_quant_table)
+        table_numbers = [self.comp_info[ci].quant_tbl_no for ci in self.mcu_components]
+        self.block_quant = [scaled[n] for n in table_numbers]
+        # the reduced size idcts use the quant tables as they are
+        self.block_quant_raw = [self.qtables[n] for n in table_numbers]
 
     def init_huffman_table(self):
-        """Prepare four Huffman tables:
-           HUFFMAN_TABLE self.htblYDC, self.htblYAC, self.htblCbCrDC, self.htblCbCrAC"""
-        #    Using dht got from jpeg file header
-        self.htblYDC.compute()
-        self.htblYAC.compute()
-        self.htblCbCrDC.compute()
-        self.htblCbCrAC.compute()
-
-
-    def decode(self, inbuf):
+        """The Huffman tables are computed as the DHT markers are read, see
+           build_huffman_table; this picks the ones of each block of an MCU,
+           as the scan selects them for its component, into self.block_tables"""
+        if self.Progressive:
+            # each scan picks its own, see decode_scan
+            return
+        if len(self.scan_info) != self.Component:
+            raise ValueError("Non-interleaved sequential scans are not supported")
+        tables = {}
+        for ci, td, ta in self.scan_info:
+            dctbl, actbl = self.huff_tables.get(td), self.huff_tables.get(16 + ta)
+            if dctbl is None or actbl is None:
+                raise ValueError("Huffman table is not defined")
+            tables[ci] = (dctbl, actbl)
+        self.block_tables = [tables[ci] for ci in self.mcu_components]
+
+
+    def decode(self, inbuf, region=None, scale=1, scans=None, mode='RGB', index=None):
         """decode(), the main function in this class !!
            inbuf is source data in jpg format
-           return is bmp bgr format, bottom_up"""
-        self.read_headers(inbuf)
-        outbuf = [0] * (self.Width * self.Height * 3)
+           return is a bytearray of Width*Height RGB pixels, top-down
+           region: only decode the (x, y, width, height) crop of the image,
+           the return is then out_width*out_height pixels of it
+           scale: decode at 1/2, 1/4 or 1/8 of the size, the image is then
+           ScaledWidth*ScaledHeight pixels, and region is in those pixels
+           scans: only decode that many scans of a progressive image, for a
+           coarse preview; the first one usually holds the dc coefficients
+           mode: 'RGB', 'BGR', 'RGBA' (opaque), or 'L' for Width*Height
+           bytes of luma, without the work on the chroma besides its entropy
+           decoding; for 'YCbCr' the return is a list of a bytearray per
+           component instead, the planes of plane_sizes, not up-sampled
+           index: an index.EntropyIndex of the image, lets the decoder skip to
+           the first row of tiles of region faster"""
+        self.reset()
+        self.set_buffer(inbuf)
+        self.whole_image = True
+        self.region = region
+        self.Scale = scale
+        self.max_scans = scans
+        self.mode = mode
+        self.seek_region(index)
+        self.decompress_image()
+        return self.outbuf
+
+    def decode_stream(self, fileobj, chunk_size=CHUNK_SIZE, region=None, scale=1, scans=None, mode='RGB', index=None):
+        """like decode(), but reads the jpg data from fileobj chunk_size bytes
+           at a time, so only about that much input is held in memory
+           the jpeg has to start at position 0 of fileobj to use an index"""
+        self.reset()
+        self.set_input(fileobj, chunk_size)
+        self.whole_image = True
+        self.region = region
+        self.Scale = scale
+        self.max_scans = scans
+        self.mode = mode
+        self.seek_region(index)
+        self.decompress_image()
+        return self.outbuf
+
+    def seek_region(self, index):
+        """with an index, skip to the first row of tiles of the region from
+           the last checkpoint before it, instead of entropy decoding all the
+           tiles above it"""
+        if index is None:
+            return
+        self.read_headers()
+        self.start_output()
+        self.seek_tile(self.out_y // self.TileHeight * self.cxTile, index)
+
+    def iter_bands(self, inbuf, start_y=0, index=None, mode='RGB'):
+        """decode inbuf one row of tiles at a time, yields (y, height, band)
+           where band holds height rows of Width pixels of mode, top-down,
+           starting at row y of the image.
+           The first band is the one with row start_y; index, an
+           index.EntropyIndex of the image, lets the decoder skip to it faster"""
+        self.reset()
+        self.set_buffer(inbuf)
+        self.mode = mode
+        return self.bands(start_y, index)
+
+    def iter_bands_stream(self, fileobj, chunk_size=CHUNK_SIZE, start_y=0, index=None, mode='RGB'):
+        """like iter_bands(), but reads the jpg data like decode_stream()
+           the jpeg has to start at position 0 of fileobj to use an index"""
+        self.reset()
+        self.set_input(fileobj, chunk_size)
+        self.mode = mode
+        return self.bands(start_y, index)
+
+    def bands(self, start_y=0, index=None):
+        if start_y:
+            self.read_headers()
+            self.start_output()
+            self.seek_tile(start_y // self.TileHeight * self.cxTile, index)
+        while self.decompress() == JPEG_ROW_COMPLETED:
+            yield self.band_y, self.band_height, self.band
+
+    def feed(self, data):
+        """push-style decoding: decode as far as data and what was fed before
+           allow. Returns JPEG_SUSPENDED until all tiles are decoded, then
+           JPEG_REACHED_EOI. Call close() after the last data."""
+        self.whole_image = True
+        if self.skip_pending:
+            skipped = min(self.skip_pending, len(data))
+            self.skip_pending -= skipped
+            self.DataOffset += skipped
+            data = data[skipped:]
+        self.DataOffset += self.DataPos
+        self.Data = self.Data[self.DataPos:] + as_buffer(data)
+        self.DataView = False
+        self.DataPos = 0
+        self.DataBytesLeft = len(self.Data)
+        return self.decompress_image()
+
+    def close(self):
+        """end of the data given to feed(), return is like decode()"""
+        self.eof = True
+        self.decompress_image()
+        return self.outbuf
+
+    def render(self):
+        """the image from the scans of a progressive image decoded so far,
+           like decode(); for previews while the data is fed, once
+           scans_completed is at least 1"""
+        if not self.Progressive or not self.scans_completed:
+            raise ValueError("No progressive scan decoded yet")
+        next_tile, scans_done = self.next_tile, self.scans_done
+        self.next_tile = 0
+        self.scans_done = True
+        try:
+            self.decompress_image()
+        finally:
+            self.next_tile, self.scans_done = next_tile, scans_done
+        return self.outbuf
+
+    def start_output(self):
+        """set up the output once the headers are read"""
         #    horizontal and vertical count of tile, macroblocks,
-        #    MCU(Minimum Coded Unit),
-        #        case 1: maybe is 16*16 pixels, 6 blocks
-        #        case 2: may be 8*8 pixels, only 3 blocks
-        cxTile = (self.Width  + self.McuSize - 1) / self.McuSize
-        cyTile = (self.Height + self.McuSize - 1) / self.McuSize
-
-        #    BMP row width, must be divided by 4
-        nRowBytes = (self.Width * 3 + 3) // 4 * 4
-
-        # FIXME: source ptr (don't need to read as we already read the header)
-        # self.Data = inbuf
-        # self.DataPos = 0
-        #    Decompress all the tiles, or macroblocks, or MCUs
-        for yTile in range(int(cyTile)):
-            # print "decompressing row %d/%d" % (yTile, cyTile)
-            for xTile in range(int(cxTile)):
+        #    MCU(Minimum Coded Unit), see init_mcu_layout
+        #        eg. 16*16 pixels, 6 blocks for 4:2:0, 16*8 pixels, 4 blocks
+        #        for 4:2:2, or 8*8 pixels, 3 blocks for 4:4:4, 1 for grayscale
+        self.cxTile = (self.Width  + self.McuWidth - 1) // self.McuWidth
+        self.cyTile = (self.Height + self.McuHeight - 1) // self.McuHeight
+        self.next_tile = 0
+        if self.Component not in (1, 3):
+            raise ValueError("Unsupported number of components: %d" % self.Component)
+        for comp in self.comp_info:
+            # chroma is up-sampled by whole factors only
+            if self.McuWidth % (8 * comp.h_samp_factor) or self.McuHeight % (8 * comp.v_samp_factor):
+                raise ValueError("Unsupported sampling factors: %d*%d" % (comp.h_samp_factor, comp.v_samp_factor))
+        if self.Scale not in SCALES:
+            raise ValueError("Unsupported scale: %r" % self.Scale)
+        if self.mode not in MODES:
+            raise ValueError("Unsupported mode: %r" % self.mode)
+        if self.mode == 'YCbCr' and (self.region is not None or not self.whole_image):
+            raise ValueError("Planar output is for whole images only")
+        self.PixelSize = MODES[self.mode]
+        self.channels = CHANNELS.get(self.mode)
+        self.idct_blocks = self.BlocksInMcu
+        if self.mode == 'L':
+            # Y is the first component
+            self.idct_blocks = self.mcu_components.count(0)
+        self.BlockBits = SCALES[self.Scale]
+        self.TileWidth = self.McuWidth // self.Scale
+        self.TileHeight = self.McuHeight // self.Scale
+        self.ScaledWidth = (self.Width + self.Scale - 1) // self.Scale
+        self.ScaledHeight = (self.Height + self.Scale - 1) // self.Scale
+        if self.region is None:
+            self.out_x, self.out_y = 0, 0
+            self.out_width, self.out_height = self.ScaledWidth, self.ScaledHeight
+        else:
+            x, y, width, height = self.region
+            self.out_x, self.out_y = max(x, 0), max(y, 0)
+            self.out_width = min(x + width, self.ScaledWidth) - self.out_x
+            self.out_height = min(y + height, self.ScaledHeight) - self.out_y
+            if self.out_width <= 0 or self.out_height <= 0:
+                raise ValueError("The region is outside of the image")
+        # decoding stops after the last row of tiles with pixels to output
+        self.last_tile = ((self.out_y + self.out_height - 1) // self.TileHeight + 1) * self.cxTile
+        self.nRowBytes = self.out_width * self.PixelSize
+        # the samples of a component, at 1/Scale like the image
+        hmax, vmax = self.McuWidth // 8, self.McuHeight // 8
+        self.plane_sizes = []
+        for comp in self.comp_info:
+            width = (self.Width * comp.h_samp_factor + hmax - 1) // hmax
+            height = (self.Height * comp.v_samp_factor + vmax - 1) // vmax
+            self.plane_sizes.append(((width + self.Scale - 1) // self.Scale,
+                                     (height + self.Scale - 1) // self.Scale))
+        self.alloc_buffers()
+        self.build_sample_maps()
+        self.reconstructor = None
+        # the NumPy backend does full size tiles only
+        if self.use_numpy and self.Scale == 1:
+            self.reconstructor = numpy_backend.Reconstructor(self)
+            self.row_coeffs = []
+        if self.mode == 'YCbCr':
+            self.outbuf = [bytearray(width * height) for width, height in self.plane_sizes]
+        elif self.whole_image:
+            # the tiles are written straight to their place in the image
+            self.outbuf = self.alloc_pixels(self.nRowBytes * self.out_height)
+        else:
+            self.outbuf = None
+
+    def alloc_pixels(self, nbytes):
+        """an output buffer of nbytes, with the alpha of RGBA set already"""
+        if self.mode == 'RGBA':
+            return bytearray(b'\xff') * nbytes
+        return bytearray(nbytes)
+
+    def alloc_buffers(self):
+        """(re)allocate the working buffers, unless they fit the image"""
+        block_samples = 1 << (2 * self.BlockBits)
+        if len(self.coeffs) != self.BlocksInMcu or len(self.samples) != self.BlocksInMcu * block_samples:
+            self.coeffs = [[0]*64 for _ in range(self.BlocksInMcu)]
+            self.samples = [0] * (self.BlocksInMcu * block_samples)
+            self.buffer_allocations += 1
+
+    def build_sample_maps(self):
+        """for each component, the positions in self.samples of the samples
+        of each pixel of each row of a tile: the up-sampling of the chroma
+        of 4:2:0, 4:2:2, 4:4:0... is in them"""
+        bbits = self.BlockBits
+        bmask = (1 << bbits) - 1
+        self.sample_maps = []
+        first = 0
+        for comp in self.comp_info:
+            h, v = comp.h_samp_factor, comp.v_samp_factor
+            hs = self.McuWidth // (8 * h)
+            vs = self.McuHeight // (8 * v)
+            rows = []
+            for j in range(self.TileHeight):
+                y = j // vs
+                rows.append([
+                    ((first + (y >> bbits) * h + (x >> bbits)) << (2 * bbits)) +
+                    ((y & bmask) << bbits) + (x & bmask)
+                    for x in [i // hs for i in range(self.TileWidth)]])
+            self.sample_maps.append(rows)
+            first += h * v
+
+    def decompress_image(self):
+        """decompress() all the rows of tiles into self.outbuf"""
+        ret = self.decompress()
+        while ret == JPEG_ROW_COMPLETED:
+            ret = self.decompress()
+        return ret
+
+    def decompress(self):
+        """Decompress the tiles, or macroblocks, or MCUs of one row of them,
+           returns JPEG_ROW_COMPLETED with the pixels in self.band (see
+           iter_bands) or in self.outbuf for whole_image, JPEG_REACHED_EOI
+           after the last row, or JPEG_SUSPENDED if it has to wait for more
+           data to be fed"""
+        if not self.cxTile:
+            if self.read_headers() == JPEG_SUSPENDED:
+                return JPEG_SUSPENDED
+            self.start_output()
+        if self.Progressive and not self.scans_done:
+            # all the scans come before the output
+            if self.decode_scans() == JPEG_SUSPENDED:
+                return JPEG_SUSPENDED
+        nRowBytes, PixelSize = self.nRowBytes, self.PixelSize
+        TileWidth, TileHeight = self.TileWidth, self.TileHeight
+        out_x, out_y = self.out_x, self.out_y
+        out_right = out_x + self.out_width
+        out_bottom = out_y + self.out_height
+        while self.next_tile < self.last_tile:
+            # Suspend between tiles only, when a whole one may not be there
+            if not self.Progressive and not self.fill_tile_input():
+                return JPEG_SUSPENDED
+            yTile, xTile = divmod(self.next_tile, self.cxTile)
+            yPixel = yTile * TileHeight
+            #    the rows of the tile inside the region: top to top + nRows
+            top = max(out_y - yPixel, 0)
+            nRows = min(TileHeight, out_bottom - yPixel) - top
+            if xTile == 0:
+                self.band_y = yPixel + top
+                self.band_height = max(nRows, 0)
+                if not self.whole_image:
+                    self.band = self.alloc_pixels(self.band_height * nRowBytes)
+
+            #    Get tile starting pixel position, and the columns of the
+            #    tile inside the region: left to left + nCols
+            xPixel = xTile * TileWidth
+            left = max(out_x - xPixel, 0)
+            nCols = min(TileWidth, out_right - xPixel) - left
+            if self.whole_image:
+                outbuf = self.outbuf
+                outpos = (yPixel + top - out_y) * nRowBytes + (xPixel + left - out_x) * PixelSize
+            else:
+                outbuf = self.band
+                outpos = (xPixel + left - out_x) * PixelSize
+
             # Decompress one macroblock started from self.Data
             # This function will push self.Data ahead
-            # Result is storing in byTile
-                byTile = self.decompress_one_tile()
-
-                #    Get tile starting pixel position
-                xPixel = xTile * self.McuSize
-                yPixel = yTile * self.McuSize
-
-                #    Get the true number of tile columns and rows
-                nTrueRows = self.McuSize
-                nTrueCols = self.McuSize
-                if yPixel + nTrueRows > self.Height:
-                    nTrueRows = self.Height - yPixel
-                if xPixel + nTrueCols > self.Width:
-                    nTrueCols = self.Width - xPixel
-
-                #    Invert output, to bmp format; row 0=>row (self.Height-1)
-                outbufpos = (self.Height - 1 - yPixel) * nRowBytes + xPixel * 3
-                for y in range(nTrueRows):
-                    offset = y * self.McuSize * 3
-                    tilerow = byTile[offset:offset + nTrueCols*3]
-                    outbuf[outbufpos:outbufpos + nTrueCols*3] = tilerow
-                    outbufpos -= nRowBytes
-        return outbuf
+            # Result is stored in outbuf
+            if nRows <= 0 or nCols <= 0:
+                # outside of the region, only keep the entropy decoder going
+                self.decode_one_tile()
+            elif self.mode == 'YCbCr':
+                self.decompress_planar_tile(xTile, yTile)
+            elif self.reconstructor is None:
+                self.decompress_one_tile(outbuf, outpos, nRows, nCols, top, left)
+            else:
+                # the tiles of the row in the region are reconstructed at
+                # once, below
+                if not self.row_coeffs:
+                    self.row_left = left
+                    self.row_outpos = outpos
+                for coeff in self.decode_one_tile():
+                    self.row_coeffs.extend(coeff)
+                if xPixel + TileWidth >= out_right:
+                    self.reconstructor.reconstruct_tiles(
+                        self.row_coeffs, outbuf, self.row_outpos,
+                        nRows, self.out_width, nRowBytes, top, self.row_left)
+                    self.row_coeffs = []
+            self.next_tile += 1
+            if xTile == self.cxTile - 1:
+                return JPEG_ROW_COMPLETED
+        return JPEG_REACHED_EOI
+
+    def fill_tile_input(self):
+        """make sure the input holds a whole tile, unless it is the end of the
+        data; returns False if decoding has to be suspended for more data"""
+        return self.DataBytesLeft >= MAX_MCU_BYTES or self.fill_input(MAX_MCU_BYTES) or self.eof
+
+    def save_entropy_state(self):
+        """the state of the entropy decoder between two tiles, as a tuple of
+        the position in the jpeg stream, the bit buffer, the DC predictions
+        and the restart marker state, see index.EntropyIndex"""
+        # always three DC predictions, those of grayscale are padded with 0
+        dc_pred = (self.dc_pred + [0, 0, 0])[:3]
+        return (self.DataOffset + self.DataPos, self.GetBits,
+                self.GetBuff & ((1 << self.GetBits) - 1)) + tuple(dc_pred) + (
+                self.restarts_to_go, self.next_restart_num, self.unread_marker)
+
+    def restore_entropy_state(self, state):
+        (pos, self.GetBits, self.GetBuff, dc0, dc1, dc2,
+         self.restarts_to_go, self.next_restart_num, self.unread_marker) = state
+        self.dc_pred = [dc0, dc1, dc2][:self.Component]
+        self.seek_input(pos)
+
+    def seek_tile(self, tile, index=None):
+        """continue decoding at tile, by entropy decoding the tiles before it,
+        starting from the last checkpoint of index before it if given"""
+        if self.Progressive:
+            # the tiles are output from the coefficient buffer in any order
+            self.next_tile = tile
+            return
+        if index is not None:
+            index.check(self)
+            first_tile, state = index.checkpoint_before(tile)
+            if first_tile > self.next_tile:
+                self.restore_entropy_state(state)
+                self.next_tile = first_tile
+        while self.next_tile < tile:
+            self.fill_tile_input()
+            self.decode_one_tile()
+            self.next_tile += 1
+
+    def decode_segment(self, segment, first_tile):
+        """decompress the tiles of one restart interval, starting with the
+           tile number first_tile, from segment, its entropy coded data without
+           the restart markers; used for parallel decoding.
+           returns (x, y, width, height, pixels) rectangles, one per row of
+           tiles, with the pixels of mode as a bytearray"""
+        self.Data = as_buffer(segment)
+        self.DataView = isinstance(self.Data, memoryview)
+        self.DataPos = 0
+        self.DataBytesLeft = len(segment)
+        self.GetBits = 0
+        self.GetBuff = 0
+        self.dc_pred = [0] * self.Component
+        self.unread_marker = 0
+        self.restarts_to_go = self.restart_interval
+        last_tile = min(first_tile + self.restart_interval, self.cxTile * self.cyTile)
+        rects = []
+        tile = first_tile
+        while tile < last_tile:
+            yTile, xTile = divmod(tile, self.cxTile)
+            count = min(last_tile - tile, self.cxTile - xTile)
+            x = xTile * self.McuWidth
+            y = yTile * self.McuHeight
+            width = min(count * self.McuWidth, self.Width - x)
+            height = min(self.McuHeight, self.Height - y)
+            # the tiles are written to a rectangle of their own
+            self.nRowBytes = width * self.PixelSize
+            pixels = self.alloc_pixels(self.nRowBytes * height)
+            if self.reconstructor is None:
+                for i in range(count):
+                    nCols = min(self.McuWidth, width - i * self.McuWidth)
+                    self.decompress_one_tile(pixels, i * self.McuWidth * self.PixelSize, height, nCols)
+            else:
+                coeffs = []
+                for i in range(count):
+                    for coeff in self.decode_one_tile():
+                        coeffs.extend(coeff)
+                self.reconstructor.reconstruct_tiles(
+                    coeffs, pixels, 0, height, width, self.nRowBytes)
+            rects.append((x, y, width, height, pixels))
+            tile += count
+        return rects
+
+    def alloc_coef_buffer(self):
+        """the coefficient buffer of a progressive image: the blocks of each
+        component in rows of whole tiles, as the interleaved scans and the
+        output go by tile"""
+        hmax = max(comp.h_samp_factor for comp in self.comp_info)
+        vmax = max(comp.v_samp_factor for comp in self.comp_info)
+        self.coef_buffer = []
+        self.coef_widths = []
+        self.comp_blocks = []
+        for comp in self.comp_info:
+            width = self.cxTile * comp.h_samp_factor
+            height = self.cyTile * comp.v_samp_factor
+            self.coef_buffer.append([[0]*64 for _ in range(width * height)])
+            self.coef_widths.append(width)
+            # the non-interleaved scans only have the blocks with samples
+            samples_x = (self.Width * comp.h_samp_factor + hmax - 1) // hmax
+            samples_y = (self.Height * comp.v_samp_factor + vmax - 1) // vmax
+            self.comp_blocks.append(((samples_x + 7) // 8, (samples_y + 7) // 8))
+        self.tile_blocks = [None] * self.BlocksInMcu
+
+    def buffered_tile(self):
+        """the dct coefficients of the blocks of tile next_tile, from the
+        coefficient buffer of a progressive image"""
+        yTile, xTile = divmod(self.next_tile, self.cxTile)
+        blocks = self.tile_blocks
+        i = 0
+        for comp, buffer, width in zip(self.comp_info, self.coef_buffer, self.coef_widths):
+            for v in range(comp.v_samp_factor):
+                pos = (yTile * comp.v_samp_factor + v) * width + xTile * comp.h_samp_factor
+                for h in range(comp.h_samp_factor):
+                    blocks[i] = buffer[pos + h]
+                    i += 1
+        return blocks
+
+    def decode_scans(self):
+        """decode the scans of a progressive image into the coefficient
+        buffer, up to EOI or max_scans; returns JPEG_SUSPENDED if it has to
+        wait for more data, otherwise JPEG_REACHED_EOI"""
+        if self.coef_buffer is None:
+            self.alloc_coef_buffer()
+            self.start_scan()
+        while True:
+            if self.scan_mcu < self.scan_mcus:
+                if self.decode_scan() == JPEG_SUSPENDED:
+                    return JPEG_SUSPENDED
+                self.scans_completed += 1
+                # the bits left are padding
+                self.GetBits = 0
+                self.GetBuff = 0
+            if self.max_scans is not None and self.scans_completed >= self.max_scans:
+                break
+            ret = self.read_markers()
+            if ret == JPEG_SUSPENDED:
+                return JPEG_SUSPENDED
+            if ret == JPEG_REACHED_EOI:
+                break
+            self.start_scan()
+        self.scans_done = True
+        return JPEG_REACHED_EOI
+
+    def start_scan(self):
+        """set up the decoding of the scan of the last SOS marker"""
+        # the marker segments before the scan were read past DataBytesLeft
+        self.DataBytesLeft = len(self.Data) - self.DataPos
+        if self.Ss == 0:
+            if self.Se != 0:
+                raise ValueError("Invalid progressive scan: %d-%d" % (self.Ss, self.Se))
+        elif self.Se < self.Ss or self.Se > 63 or len(self.scan_info) != 1:
+            raise ValueError("Invalid progressive scan: %d-%d" % (self.Ss, self.Se))
+        if len(self.scan_info) == 1:
+            # one block per MCU, in the order of the blocks of the component
+            width, height = self.comp_blocks[self.scan_info[0][0]]
+            self.scan_mcus = width * height
+        else:
+            self.scan_mcus = self.cxTile * self.cyTile
+        self.scan_mcu = 0
+        self.EOBRUN = 0
+        self.dc_pred = [0] * self.Component
+        self.GetBits = 0
+        self.GetBuff = 0
+        self.restarts_to_go = self.restart_interval
+
+    def decode_scan(self):
+        """decode the MCUs of the current scan, from scan_mcu on, into the
+        coefficient buffer; returns JPEG_SUSPENDED if it has to wait for more
+        data, otherwise JPEG_REACHED_EOI"""
+        if self.Ss == 0:
+            decode_block = self.decode_dc_refine if self.Ah else self.decode_dc_first
+        else:
+            decode_block = self.decode_ac_refine if self.Ah else self.decode_ac_first
+        # the blocks of each component in the scan in an MCU:
+        # (component index, dc table, ac table, rows of blocks, blocks per row)
+        components = []
+        for ci, td, ta in self.scan_info:
+            comp = self.comp_info[ci]
+            if len(self.scan_info) == 1:
+                nRows, nCols = 1, 1
+            else:
+                nRows, nCols = comp.v_samp_factor, comp.h_samp_factor
+            components.append((ci, self.huff_tables.get(td), self.huff_tables.get(16 + ta), nRows, nCols))
+        # blocks per row of MCUs
+        cxMcu = self.comp_blocks[self.scan_info[0][0]][0] if len(components) == 1 else self.cxTile
+        while self.scan_mcu < self.scan_mcus:
+            # Suspend between MCUs only, when a whole one may not be there
+            if not self.fill_tile_input():
+                return JPEG_SUSPENDED
+            if self.restart_interval:
+                if self.restarts_to_go == 0:
+                    self.GetBits = 0
+                    self.read_restart_marker()
+                    self.dc_pred = [0] * self.Component
+                    self.EOBRUN = 0
+                    self.restarts_to_go = self.restart_interval
+                self.restarts_to_go -= 1
+            yMcu, xMcu = divmod(self.scan_mcu, cxMcu)
+            for ci, dctbl, actbl, nRows, nCols in components:
+                buffer, width = self.coef_buffer[ci], self.coef_widths[ci]
+                for v in range(nRows):
+                    pos = (yMcu * nRows + v) * width + xMcu * nCols
+                    for h in range(nCols):
+                        decode_block(buffer[pos + h], ci, dctbl, actbl)
+            self.scan_mcu += 1
+        return JPEG_REACHED_EOI
+
+    def decode_dc_first(self, coeff, ci, dctbl, actbl):
+        """first scan of the dc coefficient, section G.1.2.1"""
+        self.dc_pred[ci] += self.decode_huffman(dctbl)[1]
+        coeff[0] = self.dc_pred[ci] << self.Al
+
+    def decode_dc_refine(self, coeff, ci, dctbl, actbl):
+        """one more bit of the dc coefficient, section G.1.2.1"""
+        if self.get_bits(1):
+            coeff[0] |= 1 << self.Al
+
+    def decode_ac_first(self, coeff, ci, dctbl, actbl):
+        """first scan of the ac coefficients Ss to Se, section G.1.2.2"""
+        if self.EOBRUN:
+            # the block is in a run of blocks with nothing in this band
+            self.EOBRUN -= 1
+            return
+        Se, Al = self.Se, self.Al
+        k = self.Ss
+        while k <= Se:
+            r, s = self.decode_huffman(actbl)
+            if s:
+                k += r
+                coeff[jpeg_natural_order[k]] = s << Al
+            elif r == 15:
+                # ZRL, 16 zeros
+                k += 15
+            else:
+                # EOBr, the end of this block and of 2**r + the r bits after
+                # it - 1 more blocks
+                EOBRUN = 1 << r
+                if r:
+                    EOBRUN += self.get_bits(r)
+                self.EOBRUN = EOBRUN - 1
+                break
+            k += 1
+
+    def decode_ac_refine(self, coeff, ci, dctbl, actbl):
+        """one more bit of the ac coefficients Ss to Se, section G.1.2.3:
+        new coefficients of magnitude 1 << Al among the zero ones, and
+        correction bits for the nonzero ones"""
+        Se = self.Se
+        p1 = 1 << self.Al    # 1 in the bit position being coded
+        m1 = -1 << self.Al    # -1 in the bit position being coded
+        natural_order = jpeg_natural_order
+        get_bits = self.get_bits
+        k = self.Ss
+        if not self.EOBRUN:
+            while k <= Se:
+                r, s = self.decode_huffman(actbl)
+                if s:
+                    # the size of a new coefficient is 1, the bit is its sign
+                    s = p1 if s > 0 else m1
+                elif r != 15:
+                    # EOBr, the rest of the block is done below
+                    self.EOBRUN = 1 << r
+                    if r:
+                        self.EOBRUN += get_bits(r)
+                    break
+                # Advance over already-nonzero coefs and r still-zero coefs,
+                # appending correction bits to the nonzeroes.  A correction bit
+                # is 1 if the absolute value of the coefficient must be increased.
+                while k <= Se:
+                    pos = natural_order[k]
+                    if coeff[pos]:
+                        if get_bits(1) and not coeff[pos] & p1:
+                            coeff[pos] += p1 if coeff[pos] >= 0 else m1
+                    else:
+                        if r == 0:
+                            # reached the target zero coefficient
+                            break
+                        r -= 1
+                    k += 1
+                if s:
+                    coeff[natural_order[k]] = s
+                k += 1
+        if self.EOBRUN:
+            # Scan any remaining coefficient positions after the end-of-band
+            # (the last newly nonzero coefficient, if any).  Append a correction
+            # bit to each already-nonzero coefficient.
+            while k <= Se:
+                pos = natural_order[k]
+                if coeff[pos]:
+                    if get_bits(1) and not coeff[pos] & p1:
+                        coeff[pos] += p1 if coeff[pos] >= 0 else m1
+                k += 1
+            self.EOBRUN -= 1
 
 # //////////////////////////////////////////////////////////////////////////////
-#    function Purpose:    decompress one 16*16 pixels
+#    function Purpose:    decompress one MCU of pixels
 #    source is self.Data
 #    This function will push self.Data ahead for next tile
 
-    def decompress_one_tile(self):
-        """decompress one 16*16 pixel tile. returns output in BGR format, 16*16*3"""
+    def decompress_one_tile(self, outbuf, outpos, nRows, nCols, top=0, left=0):
+        """decompress one tile, an MCU. writes nRows * nCols pixels of it,
+        starting at row top and column left, in the format of self.mode to
+        outbuf at outpos, rows self.nRowBytes apart"""
+        pYCbCr = self.samples
+        block_samples = 1 << (2 * self.BlockBits)
+        coeffs = self.decode_one_tile()
+        # the chroma blocks are only entropy decoded for L
+        for i in range(self.idct_blocks):
+            self.inverse_dct(coeffs[i], i, pYCbCr, i * block_samples)    # De-scale and inverse dct
+        if self.PixelSize == 1:
+            self.Y_to_LEx(pYCbCr, outbuf, outpos, nRows, nCols, top, left)
+        elif self.Component == 1:
+            self.Y_to_RGBEx(pYCbCr, outbuf, outpos, nRows, nCols, top, left)
+        else:
+            #    Color conversion and up-sampling
+            self.YCbCr_to_RGBEx(pYCbCr, outbuf, outpos, nRows, nCols, top, left)
+
+    def decompress_planar_tile(self, xTile, yTile):
+        """decompress one tile into the planes of self.outbuf: the samples of
+        the blocks of each component go to its own plane as they are"""
+        if self.reconstructor is not None:
+            # the tiles of the row are reconstructed at once
+            for coeff in self.decode_one_tile():
+                self.row_coeffs.extend(coeff)
+            if xTile == self.cxTile - 1:
+                self.reconstructor.reconstruct_planes(
+                    self.row_coeffs, self.outbuf, self.plane_sizes, yTile)
+                self.row_coeffs = []
+            return
+        samples = self.samples
+        bbits = self.BlockBits
+        bsize = 1 << bbits
+        for i, coeff in enumerate(self.decode_one_tile()):
+            self.inverse_dct(coeff, i, samples, i << (2 * bbits))
+        block = 0
+        for comp, plane, (width, height) in zip(self.comp_info, self.outbuf, self.plane_sizes):
+            h, v = comp.h_samp_factor, comp.v_samp_factor
+            for bv in range(v):
+                y = (yTile * v + bv) << bbits
+                nRows = min(bsize, height - y)
+                for bh in range(h):
+                    x = (xTile * h + bh) << bbits
+                    nCols = min(bsize, width - x)
+                    # the blocks past the edge of the plane are padding
+                    if nRows > 0 and nCols > 0:
+                        pos = block << (2 * bbits)
+                        for row in range(nRows):
+                            out = (y + row) * width + x
+                            plane[out:out + nCols] = samples[pos:pos + nCols]
+                            pos += bsize
+                    block += 1
+
+    def decode_one_tile(self):
+        """entropy decode one tile, returns the dct coefficients of its blocks"""
+        if self.Progressive:
+            return self.buffered_tile()
         # Process restart marker if needed; may have to suspend
         if self.restart_interval:
             if self.restarts_to_go == 0:
                 self.GetBits = 0
                 self.read_restart_marker()
-                self.dcY, self.dcCb, self.dcCr = 0, 0, 0
+                self.dc_pred = [0] * self.Component
                 self.restarts_to_go = self.restart_interval
+            # Account for restart interval
+            self.restarts_to_go -= 1
 
-        pYCbCr = []
-        #    Do Y/Cb/Cr components,
-        #    if self.BlocksInMcu==6,  Y: 4 blocks; Cb: 1 block; Cr: 1 block
-        #    if self.BlocksInMcu==3,  Y: 1 block; Cb: 1 block; Cr: 1 block
+        #    Do the blocks of the components in order, see init_mcu_layout,
+        #    eg. for 4:2:0,  Y: 4 blocks; Cb: 1 block; Cr: 1 block
+        #    the coefficients go to self.coeffs, which are reused for each tile
         for i in range(self.BlocksInMcu):
-            coeff = self.huffman_decode(i)    # source is self.Data
-            # print "huff[%d]: %s" % (i, " ".join(["%02x" % coeff[i] for i in range(64)]))
-            pYCbCr += self.inverse_dct(coeff, i)    # De-scale and inverse dct
-        #    Color conversion and up-sampling
-        tileoutput = self.YCbCr_to_BGREx(pYCbCr)
-        # print "pbgr[%d]: %s" % (self.DataPos, " ".join(["%02x" % i for i in tileoutput]))
-
-        # Account for restart interval (no-op if not using restarts)
-        self.restarts_to_go -= 1
-
-        return tileoutput
+            self.huffman_decode(i)  # source is self.Data
+        return self.coeffs
 
 
 # //////////////////////////////////////////////////////////////////////////////
-#    if self.BlocksInMcu==3, no need to up-sampling
+#    the up-sampling is done by self.sample_maps, see build_sample_maps
 
-    def YCbCr_to_BGREx(self, pYCbCr):
+    def YCbCr_to_RGBEx(self, pYCbCr, outbuf, outpos, nRows, nCols, top=0, left=0):
         """Color conversion and up-sampling
-        in, Y: 256 or 64 bytes; Cb: 64 bytes; Cr: 64 bytes
-        out, BGR format, 16*16*3 = 768 bytes; or 8*8*3=192 bytes"""
-        # py is meant to function like a set of pointers into pYCbCr
-        pyoffset = [i*64 for i in range(self.BlocksInMcu-2)]
-        pcboffset = (self.BlocksInMcu-2) * 64
-        pcroffset = pcboffset + 64
+        in, the samples of the Y, Cb and Cr blocks of the tile
+        out, nRows * nCols pixels of the tile, starting at row top and column
+        left, in RGB, BGR or RGBA format, written to outbuf at outpos, rows
+        self.nRowBytes apart"""
+        ymaps, cbmaps, crmaps = self.sample_maps
+        samples = pYCbCr.__getitem__
+        right = left + nCols
+        # the positions of the colors in the pixels of the mode
+        R, G, B = self.channels
+        step = self.PixelSize
         # this is to handle negative offsets...
-        range_limit = self.tblRange[256:] + self.tblRange[:256]
-        pByte = []
-        for j in range(self.McuSize): # vertical axis
-            for i in range(self.McuSize): # horizontal axis:
-            # block number is ((j/2) * 8 + i/2)={0, 1, 2, 3}
-                blocknum = ((j//2) * 8 + i//2)
-                # if self.McuSize==8, will use py[0]
-                pyindex = (j>>3) * 2 + (i>>3)
-                y = pYCbCr[pyoffset[pyindex]]
-                pyoffset[pyindex] += 1
-                iblocknum = int(blocknum)
-                cb = pYCbCr[pcboffset + iblocknum]
-                cr = pYCbCr[pcroffset + iblocknum]
-                # print "blue", y, self.CbToB[cb], len(pYCbCr), len(range_limit)
-                blue = range_limit[ y + self.CbToB[cb] ]
-                green = range_limit[ y + ((self.CbToG[cb] + self.CrToG[cr]) >> 16) ]
-                red = range_limit[ y + self.CrToR[cr] ]
-                # print "ycbcr %d %d %d %d %d / %d %d" % (j, i, y, cb, cr, pyindex, blocknum)
-                # print "exbgr %d %d %d / %d %d %d / %d %d %d %d" % (j, i, y, blue, green, red, self.CbToB[cb], self.CbToG[cb], self.CrToG[cr], self.CrToR[cr])
-                # print "exred %d %d %d / %d %d %d / %d %d %d / %d" % (j, i, y, pyoffset[(j>>3) * 2 + (i>>3)], pYCbCr[pcroffset + j/2 * 8 + i/2], cr, self.CrToR[cr], y + self.CrToR[cr], range_limit[ y + self.CrToR[cr] ], red)
-                pByte += [blue, green, red]
-        return pByte
-
-    def inverse_dct(self, coeff, nBlock):
+        range_limit = RGB_RANGE_LIMIT
+        CrToR, CbToG, CrToG, CbToB = self.CrToR, self.CbToG, self.CrToG, self.CbToB
+        for j in range(top, top + nRows): # vertical axis
+            pos = outpos + (j - top) * self.nRowBytes
+            # horizontal axis
+            for y, cb, cr in zip(map(samples, ymaps[j][left:right]),
+                                 map(samples, cbmaps[j][left:right]),
+                                 map(samples, crmaps[j][left:right])):
+                outbuf[pos + R] = range_limit[ y + CrToR[cr] ]
+                outbuf[pos + G] = range_limit[ y + ((CbToG[cb] + CrToG[cr]) >> 16) ]
+                outbuf[pos + B] = range_limit[ y + CbToB[cb] ]
+                pos += step
+
+    def Y_to_RGBEx(self, pY, outbuf, outpos, nRows, nCols, top=0, left=0):
+        """Grayscale output, no color conversion: R = G = B = Y
+        in, the samples of the one block of the tile
+        out, like YCbCr_to_RGBEx"""
+        bsize = 1 << self.BlockBits
+        step = self.PixelSize
+        end = nCols * step
+        for j in range(top, top + nRows):
+            pos = outpos + (j - top) * self.nRowBytes
+            row = pY[j * bsize + left:j * bsize + left + nCols]
+            outbuf[pos:pos + end:step] = row
+            outbuf[pos + 1:pos + end:step] = row
+            outbuf[pos + 2:pos + end:step] = row
+
+    def Y_to_LEx(self, pY, outbuf, outpos, nRows, nCols, top=0, left=0):
+        """Luma output, in, the samples of the Y blocks of the tile
+        out, like YCbCr_to_RGBEx, in L format, a byte per pixel"""
+        ymaps = self.sample_maps[0]
+        samples = pY.__getitem__
+        right = left + nCols
+        for j in range(top, top + nRows):
+            pos = outpos + (j - top) * self.nRowBytes
+            outbuf[pos:pos + nCols] = bytearray(map(samples, ymaps[j][left:right]))
+
+    def inverse_dct(self, coeff, nBlock, outbuf, outpos):
         """AA&N DCT algorithm implemention
             coeff             # in, dct coefficients, length = 64
-            data             # out, 64 bytes
-            nBlock           # block index: 0~3:Y; 4:Cb; 5:Cr
+            nBlock           # block index in the MCU, see init_mcu_layout
+            outbuf           # out, 64 samples written at outpos
         """
 
+        if self.Scale != 1:
+            # reduced size output, from the IJG jidctred.c
+            quant = self.block_quant_raw[nBlock]
+            if self.Scale == 2:
+                self.inverse_dct_4x4(coeff, quant, outbuf, outpos)
+            elif self.Scale == 4:
+                self.inverse_dct_2x2(coeff, quant, outbuf, outpos)
+            else:
+                # only the DC coefficient is needed for a 1*1 block
+                outbuf[outpos] = IDCT_RANGE_LIMIT[((coeff[0] * quant[0] + 4) >> 3) & 1023]
+            return
+
         FIX_1_082392200 = 277        # FIX(1.082392200)
         FIX_1_414213562 = 362        # FIX(1.414213562)
         FIX_1_847759065 = 473        # FIX(1.847759065)
         FIX_2_613125930 = 669        # FIX(2.613125930)
 
-        MULTIPLY = lambda var, cons: int(var*cons)>>8
-
-        workspace = [0]*64        # buffers data between passes
+        workspace = self.workspace        # buffers data between passes
 
         inptr = 0
         wsptr = 0 # pointer into workspace
-        outbuf = [0]*64
         outptr = 0
-        range_limit = self.tblRange[256+128:]
+        range_limit = IDCT_RANGE_LIMIT
         dcval, DCTSIZE = 0, 8
 
-        if nBlock < 4:
-            quant = self.qtblY
-        else:
-            quant = self.qtblCbCr
+        quant = self.block_quant[nBlock]
         quantptr = 0
 
         # Pass 1: process columns from input (inptr), store into work array(wsptr)
@@ -719,7 +1797,8 @@ class TonyJpegDecoder(object):
             # DC coefficient (with scale factor as needed).
             # With typical images and quantization tables, half or more of the
             # column DCT calculations can be simplified this way.
-            if reduce(int.__or__, map(int, [coeff[inptr+DCTSIZE*n] for n in range(1,8)])) == 0:
+            if not (coeff[inptr+8] or coeff[inptr+16] or coeff[inptr+24] or coeff[inptr+32] or
+                    coeff[inptr+40] or coeff[inptr+48] or coeff[inptr+56]):
                 """ AC terms all zero """
                 dcval = coeff[inptr + DCTSIZE*0] * quant[quantptr+DCTSIZE*0]
 
@@ -799,11 +1878,10 @@ class TonyJpegDecoder(object):
 
         RANGE_MASK = 1023 # 2 bits wider than legal samples
         PASS1_BITS = 2
-        IDESCALE = lambda x,n:  x >> n
 
         wsptr = 0
         for ctr in range(DCTSIZE):
-            outptr = ctr * 8
+            outptr = outpos + ctr * 8
 
             # Rows of zeroes can be exploited in the same way as we did with columns.
             # However, the column calculation has created many nonzero AC terms, so
@@ -811,7 +1889,8 @@ class TonyJpegDecoder(object):
             # On machines with very fast multiplication, it's possible that the
             # test takes more time than it's worth.  In that case this section
             # may be commented out.
-            if reduce(int.__or__, workspace[wsptr+1:wsptr+8]) == 0:
+            if not (workspace[wsptr+1] or workspace[wsptr+2] or workspace[wsptr+3] or workspace[wsptr+4] or
+                    workspace[wsptr+5] or workspace[wsptr+6] or workspace[wsptr+7]):
                 # AC terms all zero
                 dcval = range_limit[ (workspace[wsptr] >> 5) & RANGE_MASK]
                 outbuf[outptr+0] = dcval
@@ -858,64 +1937,187 @@ class TonyJpegDecoder(object):
 
             # Final output stage: scale down by a factor of 8 and range-limit
 
-            outbuf[outptr+0] = range_limit[IDESCALE(tmp0 + tmp7, PASS1_BITS+3) & RANGE_MASK]
-            outbuf[outptr+7] = range_limit[IDESCALE(tmp0 - tmp7, PASS1_BITS+3) & RANGE_MASK]
-            outbuf[outptr+1] = range_limit[IDESCALE(tmp1 + tmp6, PASS1_BITS+3) & RANGE_MASK]
-            outbuf[outptr+6] = range_limit[IDESCALE(tmp1 - tmp6, PASS1_BITS+3) & RANGE_MASK]
-            outbuf[outptr+2] = range_limit[IDESCALE(tmp2 + tmp5, PASS1_BITS+3) & RANGE_MASK]
-            outbuf[outptr+5] = range_limit[IDESCALE(tmp2 - tmp5, PASS1_BITS+3) & RANGE_MASK]
-            outbuf[outptr+4] = range_limit[IDESCALE(tmp3 + tmp4, PASS1_BITS+3) & RANGE_MASK]
-            outbuf[outptr+3] = range_limit[IDESCALE(tmp3 - tmp4, PASS1_BITS+3) & RANGE_MASK]
+            outbuf[outptr+0] = range_limit[(tmp0 + tmp7) >> (PASS1_BITS+3) & RANGE_MASK]
+            outbuf[outptr+7] = range_limit[(tmp0 - tmp7) >> (PASS1_BITS+3) & RANGE_MASK]
+            outbuf[outptr+1] = range_limit[(tmp1 + tmp6) >> (PASS1_BITS+3) & RANGE_MASK]
+            outbuf[outptr+6] = range_limit[(tmp1 - tmp6) >> (PASS1_BITS+3) & RANGE_MASK]
+            outbuf[outptr+2] = range_limit[(tmp2 + tmp5) >> (PASS1_BITS+3) & RANGE_MASK]
+            outbuf[outptr+5] = range_limit[(tmp2 - tmp5) >> (PASS1_BITS+3) & RANGE_MASK]
+            outbuf[outptr+4] = range_limit[(tmp3 + tmp4) >> (PASS1_BITS+3) & RANGE_MASK]
+            outbuf[outptr+3] = range_limit[(tmp3 - tmp4) >> (PASS1_BITS+3) & RANGE_MASK]
 
             wsptr += DCTSIZE   # advance pointer to next row
 
-        return outbuf
+    def inverse_dct_4x4(self, coeff, quant, outbuf, outpos):
+        """inverse dct of a block to 4*4 samples, the 1/2 scale of
+        inverse_dct; quant is the quantization table as in the file"""
+        FIX_0_211164243 = 1730
+        FIX_0_509795579 = 4176
+        FIX_0_601344887 = 4926
+        FIX_0_765366865 = 6270
+        FIX_0_899976223 = 7373
+        FIX_1_061594337 = 8697
+        FIX_1_451774981 = 11893
+        FIX_1_847759065 = 15137
+        FIX_2_172734803 = 17799
+        FIX_2_562915447 = 20995
+        CONST_BITS, PASS1_BITS, RANGE_MASK = 13, 2, 1023
+        range_limit = IDCT_RANGE_LIMIT
+        workspace = self.workspace
+
+        # Pass 1: process columns, but not column 4, the second pass won't use it
+        for col in (0, 1, 2, 3, 5, 6, 7):
+            d0 = coeff[col] * quant[col]
+            d1 = coeff[col + 8] * quant[col + 8]
+            d2 = coeff[col + 16] * quant[col + 16]
+            d3 = coeff[col + 24] * quant[col + 24]
+            d5 = coeff[col + 40] * quant[col + 40]
+            d6 = coeff[col + 48] * quant[col + 48]
+            d7 = coeff[col + 56] * quant[col + 56]
+            if not (d1 or d2 or d3 or d5 or d6 or d7):
+                # AC terms all zero; we need not examine term 4 for 4x4 output
+                workspace[col] = workspace[col + 8] = workspace[col + 16] = workspace[col + 24] = d0 << PASS1_BITS
+                continue
+            # Even part
+            tmp0 = d0 << (CONST_BITS + 1)
+            tmp2 = d2 * FIX_1_847759065 - d6 * FIX_0_765366865
+            tmp10 = tmp0 + tmp2
+            tmp12 = tmp0 - tmp2
+            # Odd part
+            tmp0 = (- d7 * FIX_0_211164243 + d5 * FIX_1_451774981
+                    - d3 * FIX_2_172734803 + d1 * FIX_1_061594337)
+            tmp2 = (- d7 * FIX_0_509795579 - d5 * FIX_0_601344887
+                    + d3 * FIX_0_899976223 + d1 * FIX_2_562915447)
+            n = CONST_BITS - PASS1_BITS + 1
+            workspace[col] = DESCALE(tmp10 + tmp2, n)
+            workspace[col + 24] = DESCALE(tmp10 - tmp2, n)
+            workspace[col + 8] = DESCALE(tmp12 + tmp0, n)
+            workspace[col + 16] = DESCALE(tmp12 - tmp0, n)
+
+        # Pass 2: process 4 rows from work array, store into output array.
+        for row in range(4):
+            wsptr = row * 8
+            w1, w2, w3 = workspace[wsptr + 1], workspace[wsptr + 2], workspace[wsptr + 3]
+            w5, w6, w7 = workspace[wsptr + 5], workspace[wsptr + 6], workspace[wsptr + 7]
+            out = outpos + row * 4
+            if not (w1 or w2 or w3 or w5 or w6 or w7):
+                outbuf[out] = outbuf[out + 1] = outbuf[out + 2] = outbuf[out + 3] = \
+                    range_limit[DESCALE(workspace[wsptr], PASS1_BITS + 3) & RANGE_MASK]
+                continue
+            # Even part
+            tmp0 = workspace[wsptr] << (CONST_BITS + 1)
+            tmp2 = w2 * FIX_1_847759065 - w6 * FIX_0_765366865
+            tmp10 = tmp0 + tmp2
+            tmp12 = tmp0 - tmp2
+            # Odd part
+            tmp0 = (- w7 * FIX_0_211164243 + w5 * FIX_1_451774981
+                    - w3 * FIX_2_172734803 + w1 * FIX_1_061594337)
+            tmp2 = (- w7 * FIX_0_509795579 - w5 * FIX_0_601344887
+                    + w3 * FIX_0_899976223 + w1 * FIX_2_562915447)
+            n = CONST_BITS + PASS1_BITS + 3 + 1
+            outbuf[out] = range_limit[DESCALE(tmp10 + tmp2, n) & RANGE_MASK]
+            outbuf[out + 3] = range_limit[DESCALE(tmp10 - tmp2, n) & RANGE_MASK]
+            outbuf[out + 1] = range_limit[DESCALE(tmp12 + tmp0, n) & RANGE_MASK]
+            outbuf[out + 2] = range_limit[DESCALE(tmp12 - tmp0, n) & RANGE_MASK]
+
+    def inverse_dct_2x2(self, coeff, quant, outbuf, outpos):
+        """inverse dct of a block to 2*2 samples, the 1/4 scale of
+        inverse_dct; quant is the quantization table as in the file"""
+        FIX_0_720959822 = 5906
+        FIX_0_850430095 = 6967
+        FIX_1_272758580 = 10426
+        FIX_3_624509785 = 29692
+        CONST_BITS, PASS1_BITS, RANGE_MASK = 13, 2, 1023
+        range_limit = IDCT_RANGE_LIMIT
+        workspace = self.workspace
+
+        # Pass 1: process columns, but not columns 2, 4 and 6
+        for col in (0, 1, 3, 5, 7):
+            d1 = coeff[col + 8] * quant[col + 8]
+            d3 = coeff[col + 24] * quant[col + 24]
+            d5 = coeff[col + 40] * quant[col + 40]
+            d7 = coeff[col + 56] * quant[col + 56]
+            if not (d1 or d3 or d5 or d7):
+                workspace[col] = workspace[col + 8] = (coeff[col] * quant[col]) << PASS1_BITS
+                continue
+            # Even part
+            tmp10 = (coeff[col] * quant[col]) << (CONST_BITS + 2)
+            # Odd part
+            tmp0 = (- d7 * FIX_0_720959822 + d5 * FIX_0_850430095
+                    - d3 * FIX_1_272758580 + d1 * FIX_3_624509785)
+            workspace[col] = DESCALE(tmp10 + tmp0, CONST_BITS - PASS1_BITS + 2)
+            workspace[col + 8] = DESCALE(tmp10 - tmp0, CONST_BITS - PASS1_BITS + 2)
+
+        # Pass 2: process 2 rows from work array, store into output array.
+        for row in range(2):
+            wsptr = row * 8
+            w1, w3 = workspace[wsptr + 1], workspace[wsptr + 3]
+            w5, w7 = workspace[wsptr + 5], workspace[wsptr + 7]
+            out = outpos + row * 2
+            if not (w1 or w3 or w5 or w7):
+                outbuf[out] = outbuf[out + 1] = \
+                    range_limit[DESCALE(workspace[wsptr], PASS1_BITS + 3) & RANGE_MASK]
+                continue
+            tmp10 = workspace[wsptr] << (CONST_BITS + 2)
+            tmp0 = (- w7 * FIX_0_720959822 + w5 * FIX_0_850430095
+                    - w3 * FIX_1_272758580 + w1 * FIX_3_624509785)
+            n = CONST_BITS + PASS1_BITS + 3 + 2
+            outbuf[out] = range_limit[DESCALE(tmp10 + tmp0, n) & RANGE_MASK]
+            outbuf[out + 1] = range_limit[DESCALE(tmp10 - tmp0, n) & RANGE_MASK]
 
     def huffman_decode(self, iBlock):
         """source is self.Data
             out DCT coefficients
-            iBlock  0,1,2,3:Y; 4:Cb; 5:Cr; or 0:Y;1:Cb;2:Cr"""
-        if iBlock < self.BlocksInMcu - 2:
-            dctbl = self.htblYDC
-            actbl = self.htblYAC
-            LastDC = "dcY"
-        else:
-            dctbl = self.htblCbCrDC
-            actbl = self.htblCbCrAC
-            if iBlock == self.BlocksInMcu - 2:
-                LastDC = "dcCb"
-            else:
-                LastDC = "dcCr"
+            iBlock  block index in the MCU, see init_mcu_layout"""
+        dctbl, actbl = self.block_tables[iBlock]
+        ci = self.mcu_components[iBlock]
 
-        coeff = [0]*64
+        coeff = self.coeffs[iBlock]
+        coeff[:] = ZERO_COEFFS
 
         # Section F.2.2.1: decode the DC coefficient difference
-        s = self.get_category(dctbl)             # get dc category number, s
-
-        if s:
-            r = self.do_get_bits(s)                 # get offset in this dc category
-            s = self.value_from_category(s, r)    # get dc difference value
+        s = self.decode_huffman(dctbl)[1]
 
         # Convert DC difference to actual value, update last_dc_val
-        s += getattr(self, LastDC)
-        setattr(self, LastDC, s)
+        s += self.dc_pred[ci]
+        self.dc_pred[ci] = s
 
         # Output the DC coefficient (assumes jpeg_natural_order[0] = 0)
         coeff[0] = s
 
         # Section F.2.2.2: decode the AC coefficients
         # Since zeroes are skipped, output area must be cleared beforehand
+        lookup, lookup2 = actbl.lookup, actbl.lookup2
+        counts = self.huffman_counts
         k = 1
         while k < 64:
-            s = self.get_category( actbl )    # s: (run, category)
-            r = s >> 4                       #    r: run length for ac zero, 0 <= r < 16
-            s &= 15                          #    s: category for this non-zero ac
-
+            if self.GetBits < AC_GET_BITS:
+                self.fill_bit_buffer()
+            bits = self.GetBits
+            if bits < AC_GET_BITS:
+                # at the end of the data
+                r, s = self.decode_huffman(actbl)
+            else:
+                # decode_huffman, inline, as the buffer holds a whole code
+                peek = (self.GetBuff >> (bits - 16)) & 0xFFFF
+                entry = lookup[peek >> HUFF_LOOKAHEAD2]
+                if entry is None:
+                    entry = lookup2[peek >> HUFF_LOOKAHEAD2][peek & ((1 << HUFF_LOOKAHEAD2) - 1)]
+                    if counts is not None:
+                        counts[1] += 1
+                elif counts is not None:
+                    counts[0] += 1
+                nbits, r, size, s = entry
+                bits -= nbits
+                if size:
+                    bits -= size
+                    s = (self.GetBuff >> bits) & ((1 << size) - 1)
+                    if s < (1 << (size - 1)):
+                        s += ((-1) << size) + 1
+                self.GetBits = bits
+            # r: run length for ac zero, s: ac value
             if s:
                 k += r                       #    k: position for next non-zero ac
-                r = self.do_get_bits(s)               #    r: offset in this ac category
-                s = self.value_from_category(s, r)  #    s: ac value
-
                 coeff[ jpeg_natural_order[ k ] ] = s
             else: # s = 0, means ac value is 0 ? Only if r = 15.
                 if r != 15:    # means all the left ac are zero
@@ -925,34 +2127,70 @@ class TonyJpegDecoder(object):
 
         return coeff
 
-    def get_category(self, htbl):
-        """get category number for dc, or (0 run length, ac category) for ac"""
-        #    The max length for Huffman codes is 15 bits; so we use 32 bits buffer
+    def decode_huffman(self, htbl):
+        """decode one Huffman code and the value bits after it, returns
+        (run, value): the run length of zero ac coefficients before the value,
+        and the dc difference or ac value, which is 0 for EOB and ZRL"""
+        #    The max length for Huffman codes is 16 bits; so we use 56 bits buffer
         #    self.GetBuff, with the validated length is self.GetBits.
-        #    Usually, more than 95% of the Huffman codes will be 8 or fewer bits long
-        #    To speed up, we should pay more attention on the codes whose length <= 8
-
-        #    If left bits < 8, we should get more data
-        if self.GetBits < 8:
+        if self.GetBits < 16:
             self.fill_bit_buffer()
-
-        #    Call special process if data finished; min bits is 1
-        if self.GetBits < 8:
-            return self.special_decode(htbl, 1)
-
-        #    Peek the first valid byte
-        look = ((self.GetBuff>>(self.GetBits - 8))& 0xFF)
-        nb = htbl.look_nbits[look]
-
-        if nb:
-            self.GetBits -= nb
-            return htbl.look_sym[look]
+        bits = self.GetBits
+        if bits >= 16:
+            peek = (self.GetBuff >> (bits - 16)) & 0xFFFF
         else:
-            # Decode long codes with length >= 9
-            return self.special_decode(htbl, 9)
+            # at the end of the data, look up the bits padded with zeros
+            peek = (self.GetBuff << (16 - bits)) & 0xFFFF
+        entry = htbl.lookup[peek >> HUFF_LOOKAHEAD2]
+        if entry is None:
+            entry = htbl.lookup2[peek >> HUFF_LOOKAHEAD2][peek & ((1 << HUFF_LOOKAHEAD2) - 1)]
+            if self.huffman_counts is not None:
+                self.huffman_counts[1] += 1
+        elif self.huffman_counts is not None:
+            self.huffman_counts[0] += 1
+        nbits, run, size, value = entry
+        bits -= nbits
+        if size:
+            # the value bits did not fit in the lookahead
+            if bits < size:
+                self.GetBits = bits
+                self.fill_bit_buffer()
+                bits = self.GetBits
+            bits -= size
+            if bits >= 0:
+                value = huff_extend((self.GetBuff >> bits) & ((1 << size) - 1), size)
+        if bits < 0:
+            raise ValueError("Premature end of JPEG data")
+        self.GetBits = bits
+        return run, value
+
+    def get_bits(self, nbits):
+        """the next nbits of the entropy coded data"""
+        if self.GetBits < nbits:
+            self.fill_bit_buffer()
+            if self.GetBits < nbits:
+                raise ValueError("Premature end of JPEG data")
+        self.GetBits -= nbits
+        return (self.GetBuff >> self.GetBits) & ((1 << nbits) - 1)
 
     def fill_bit_buffer(self):
-        while self.GetBits < 25:    # #define MIN_GET_BITS  (32-7)
+        # take the bytes up to the next 0xFF at once, all of them are data
+        nbytes = min((MAX_GET_BITS - self.GetBits) >> 3, self.DataBytesLeft)
+        if nbytes > 0 and not self.unread_marker:
+            if self.DataView:
+                end = view_find(self.Data, b'\xff', self.DataPos, self.DataPos + nbytes)
+            else:
+                end = self.Data.find(b'\xff', self.DataPos, self.DataPos + nbytes)
+            if end >= 0:
+                nbytes = end - self.DataPos
+            if nbytes:
+                self.GetBuff = ((self.GetBuff << (nbytes * 8)) |
+                                bytes_to_int(self.Data[self.DataPos:self.DataPos + nbytes]))
+                self.GetBuff &= (1 << MAX_GET_BITS) - 1
+                self.GetBits += nbytes * 8
+                self.DataPos += nbytes
+                self.DataBytesLeft -= nbytes
+        while self.GetBits < MIN_GET_BITS:
             if self.DataBytesLeft > 0: # Are there some data?
                 # Attempt to read a byte
                 if self.unread_marker != 0:
@@ -964,14 +2202,14 @@ class TonyJpegDecoder(object):
                     if (self.GetBits >= 0):
                         break
 
-                uc = byteord(self.Data[self.DataPos])
+                uc = self.Data[self.DataPos]
                 self.DataPos += 1
                 self.DataBytesLeft -= 1
 
                 # If it's 0xFF, check and discard stuffed zero byte
                 if uc == 0xFF:
                     while uc == 0xFF:
-                        uc = byteord(self.Data[self.DataPos])
+                        uc = self.Data[self.DataPos]
                         self.DataPos += 1
                         self.DataBytesLeft -= 1
 
@@ -990,67 +2228,8 @@ class TonyJpegDecoder(object):
                         if (self.GetBits >= 0):
                             break
 
-                self.GetBuff = int(self.GetBuff << 8) | uc
+                self.GetBuff = ((self.GetBuff << 8) | uc) & ((1 << MAX_GET_BITS) - 1)
                 self.GetBits += 8
             else:
                 break
 
-    def do_get_bits(self, nbits):
-        if self.GetBits < nbits:
-            # we should read nbits bits to get next data
-            self.fill_bit_buffer()
-        self.GetBits -= nbits
-        return (self.GetBuff >> self.GetBits) & ((1<<nbits)-1)
-
-
-    def special_decode(self, htbl, nMinBits):
-        """Special Huffman decode:
-        (1) For codes with length > 8
-        (2) For codes with length < 8 while data is finished"""
-        l = nMinBits
-
-        # HUFF_DECODE has determined that the code is at least min_bits
-        # bits long, so fetch that many bits in one swoop.
-
-        code = self.do_get_bits(l)
-
-        # Collect the rest of the Huffman code one bit at a time.
-        # This is per Figure F.16 in the JPEG spec.
-        while code > htbl.maxcode[l]:
-            code <<= 1
-            code |= self.do_get_bits(1)
-            l += 1
-
-        # With garbage input we may reach the sentinel value l = 17.
-        if l > 16:
-            return 0            # fake a zero as the safest result
-
-        return htbl.huffval[ htbl.valptr[l] + (code - htbl.mincode[l]) ]
-
-    def value_from_category(self, nCate, nOffset):
-        """To find dc or ac value according to category and category offset"""
-        # Method 1:
-        # On some machines, a shift and add will be faster than a table lookup.
-        # define HUFF_EXTEND(x,s) \
-        # ((x)< (1<<((s)-1)) ? (x) + (((-1)<<(s)) + 1) : (x))
-        # Method 2: Table lookup
-
-        # If (nOffset < half[nCate]), then value is below zero
-        # Otherwise, value is above zero, and just the nOffset
-        # entry n is 2**(n-1) """
-        half =  \
-          [ 0, 0x0001, 0x0002, 0x0004, 0x0008, 0x0010, 0x0020, 0x0040, 0x0080,
-            0x0100, 0x0200, 0x0400, 0x0800, 0x1000, 0x2000, 0x4000 ]
-
-        # start[i] is the starting value in this category; surely it is below zero
-        # entry n is (-1 << n) + 1
-        start = \
-          [ 0, ((-1)<<1) + 1, ((-1)<<2) + 1, ((-1)<<3) + 1, ((-1)<<4) + 1,
-            ((-1)<<5) + 1, ((-1)<<6) + 1, ((-1)<<7) + 1, ((-1)<<8) + 1,
-            ((-1)<<9) + 1, ((-1)<<10) + 1, ((-1)<<11) + 1, ((-1)<<12) + 1,
-            ((-1)<<13) + 1, ((-1)<<14) + 1, ((-1)<<15) + 1 ]
-
-        if nOffset < half[nCate]:
-            return nOffset + start[nCate]
-        else:
-            return nOffset
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2012, Jonas Obrist
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the Jonas Obrist nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL JONAS OBRIST BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Statistics of the decoding of an image by raw.TonyJpegDecoder, to tell why
+one image takes much longer than another.
+
+A decoder collects them once enable_stats is called: the methods of its
+stages are replaced, on that decoder only, by ones that count and time them,
+so a decoder without statistics runs the same code as before. The counting
+is done after the stages it looks at, from their results, and is left out
+of their times; only the Huffman codes are counted by the decoder itself as
+it looks them up, where a decoder without statistics skips a check.
+
+The pure Python reconstruction is timed by stage, the NumPy one as a
+whole; the parallel decoding of restart interval segments is not counted.
+"""
+from pymaging_jpg.raw import JPEG_REACHED_EOI
+import time
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# the stages timed, and the decoder methods in each
+STAGES = [
+    ('headers', ('read_headers',)),
+    ('entropy', ('decode_one_tile', 'decode_scans')),
+    ('idct', ('inverse_dct',)),
+    ('color', ('YCbCr_to_RGBEx', 'Y_to_RGBEx', 'Y_to_LEx')),
+]
+
+
+class DecodeStats(object):
+    """the counters and stage times of the decoding of one image
+
+    mcus: tiles decoded
+    huffman_lookahead, huffman_long: Huffman codes decoded with the first
+    level lookup table, and the longer ones that need the second level
+    idct_dc_columns, idct_full_columns, idct_dc_rows, idct_full_rows: the
+    columns and rows of the full size inverse DCT passes with AC terms all
+    zero, which are short-circuited, and the others
+    bytes_unstuffed: the 0 bytes after 0xFF data bytes dropped from the
+    entropy coded data
+    restart_markers: RSTn markers read
+    times: the seconds spent in each of STAGES, in 'reconstruct' for the
+    NumPy backend, and in all of the decoding as 'total'
+    """
+    COUNTERS = ('mcus', 'huffman_lookahead', 'huffman_long', 'idct_dc_columns',
+                'idct_full_columns', 'idct_dc_rows', 'idct_full_rows', 'bytes_unstuffed',
+                'restart_markers')
+
+    def __init__(self):
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        self.times = dict((stage, 0.0) for stage, methods in STAGES)
+        self.times['reconstruct'] = 0.0
+        self.times['total'] = 0.0
+        # when the decoding started, for the total time
+        self.start = timer()
+
+    def as_dict(self):
+        """the counters, and the times as 'time_<stage>', in a flat dict for
+        a metrics system"""
+        data = dict((name, getattr(self, name)) for name in self.COUNTERS)
+        for stage, seconds in self.times.items():
+            data['time_' + stage] = seconds
+        return data
+
+    def __repr__(self):
+        return 'DecodeStats(%s)' % ', '.join('%s=%r' % item for item in sorted(self.as_dict().items()))
+
+
+def timed(method, times_of, stage):
+    """method, adding the time of its calls to times_of()[stage]"""
+    def wrapper(*args):
+        start = timer()
+        result = method(*args)
+        times_of()[stage] += timer() - start
+        return result
+    return wrapper
+
+
+def instrument(decoder, hook=None):
+    """make decoder collect a DecodeStats of each image in decoder.stats, and
+    call hook with it once the image is decoded, see the module docstring;
+    for a decoder that does already, only hook is replaced"""
+    decoder.stats_hook = hook
+    if decoder.stats is not None:
+        return
+    times_of = lambda: decoder.stats.times
+    for stage, methods in STAGES:
+        for name in methods:
+            setattr(decoder, name, timed(getattr(decoder, name), times_of, stage))
+    reset = decoder.reset
+    def reset_stats():
+        reset()
+        decoder.stats = DecodeStats()
+        # counted by the decoder itself, see decode_huffman
+        decoder.huffman_counts = [0, 0]
+    decoder.reset = reset_stats
+
+    start_output = decoder.start_output
+    def start_output_stats():
+        start_output()
+        if decoder.reconstructor is not None:
+            reconstructor = decoder.reconstructor
+            for name in ('reconstruct_tiles', 'reconstruct_planes'):
+                setattr(reconstructor, name, timed(getattr(reconstructor, name), times_of, 'reconstruct'))
+    decoder.start_output = start_output_stats
+
+    decode_one_tile = decoder.decode_one_tile
+    def decode_one_tile_stats():
+        coeffs = decode_one_tile()
+        decoder.stats.mcus += 1
+        return coeffs
+    decoder.decode_one_tile = decode_one_tile_stats
+
+    inverse_dct = decoder.inverse_dct
+    def inverse_dct_stats(coeff, nBlock, outbuf, outpos):
+        inverse_dct(coeff, nBlock, outbuf, outpos)
+        if decoder.Scale != 1:
+            return
+        stats = decoder.stats
+        dc_columns = sum(1 for col in range(8) if not any(coeff[col + 8:64:8]))
+        stats.idct_dc_columns += dc_columns
+        stats.idct_full_columns += 8 - dc_columns
+        # the workspace holds the output of the column pass
+        workspace = decoder.workspace
+        dc_rows = sum(1 for row in range(0, 64, 8) if not any(workspace[row + 1:row + 8]))
+        stats.idct_dc_rows += dc_rows
+        stats.idct_full_rows += 8 - dc_rows
+    decoder.inverse_dct = inverse_dct_stats
+
+    fill_bit_buffer = decoder.fill_bit_buffer
+    def fill_bit_buffer_stats():
+        start = decoder.DataPos
+        fill_bit_buffer()
+        unstuffed = bytes(decoder.Data[start:decoder.DataPos]).count(b'\xff\x00')
+        decoder.stats.bytes_unstuffed += unstuffed
+    decoder.fill_bit_buffer = fill_bit_buffer_stats
+
+    read_restart_marker = decoder.read_restart_marker
+    def read_restart_marker_stats():
+        read_restart_marker()
+        decoder.stats.restart_markers += 1
+    decoder.read_restart_marker = read_restart_marker_stats
+
+    decompress = decoder.decompress
+    def decompress_stats():
+        ret = decompress()
+        stats = decoder.stats
+        stats.huffman_lookahead, stats.huffman_long = decoder.huffman_counts
+        if ret == JPEG_REACHED_EOI and not stats.times['total']:
+            stats.times['total'] = timer() - stats.start
+            if decoder.stats_hook is not None:
+                decoder.stats_hook(stats)
+        return ret
+    decoder.decompress = decompress_stats
+    decoder.reset()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2012, Jonas Obrist
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the Jonas Obrist nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL JONAS OBRIST BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Process-wide caches of the tables a decoder derives from the DHT and DQT
+tables of an image, the Huffman lookup tables and the AA&N scaled
+quantization tables. Images from the same camera or encoder share those
+tables, so they are built once for all of them.
+
+The caches are keyed by the raw bytes of a table as it is in the file.
+The tables in them are shared, they must not be changed.
+"""
+from collections import namedtuple, OrderedDict
+import threading
+
+DEFAULT_MAXSIZE = 64
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class TableCache(object):
+    """bounded cache of tables, the least recently used one is dropped"""
+    def __init__(self, maxsize=DEFAULT_MAXSIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.tables = OrderedDict()
+        # decoders may run in threads
+        self.lock = threading.Lock()
+
+    def get(self, key, build):
+        """the table for key, build(key) makes it if it is not cached"""
+        with self.lock:
+            table = self.tables.pop(key, None)
+            if table is not None:
+                self.hits += 1
+                self.tables[key] = table
+                return table
+            self.misses += 1
+        table = build(key)
+        with self.lock:
+            self.tables[key] = table
+            while len(self.tables) > self.maxsize:
+                self.tables.popitem(last=False)
+        return table
+
+    def info(self):
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self.tables))
+
+    def clear(self):
+        """drop the tables and reset the statistics"""
+        with self.lock:
+            self.tables.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+huffman_tables = TableCache()
+quant_tables = TableCache()
+
+
+def cache_info():
+    """hit and miss statistics of the caches, by name"""
+    return {'huffman': huffman_tables.info(), 'quant': quant_tables.info()}
+
+
+def clear_caches():
+    huffman_tables.clear()
+    quant_tables.clear()
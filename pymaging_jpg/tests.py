@@ -28,7 +28,22 @@ from pymaging.colors import Color
 from pymaging.tests.test_basic import PymagingBaseTestCase
 from pymaging.utils import get_test_file
 from pymaging.webcolors import Black, White
-from pymaging_jpg.jpg import JPG
+from pymaging_jpg import benchmark, numpy_backend, parallel, tables
+from pymaging_jpg.batch import decode_many, is_path
+from pymaging_jpg.coefficients import read_coefficients
+from pymaging_jpg.encoder import TonyJpegEncoder
+from pymaging_jpg.exif import decode_thumbnail, read_exif
+from pymaging_jpg.index import EntropyIndex, build_index
+from pymaging_jpg.jpg import JPG, map_file, probe, thumbnail
+from pymaging_jpg.pool import DecoderPool
+from pymaging_jpg.raw import HuffTable, TonyJpegDecoder, JPEG_SUSPENDED
+from pymaging_jpg.transform import transform
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import io
+import mmap
+import os
+import sys
+import unittest
 
 ALMOST_BLACK = Color(8, 8,8 , 255)
 
@@ -42,3 +57,541 @@ class JPGTests(PymagingBaseTestCase):
             [Black, White],
             [White, ALMOST_BLACK] # no clue why this is "almost" black
         ], False)
+
+    def test_probe(self):
+        with open(get_test_file(__file__, 'black-white-100.jpg'), 'rb') as fobj:
+            info = probe(fobj, 16)
+        self.assertEqual((info.width, info.height), (2, 2))
+        self.assertEqual(info.components, 3)
+        self.assertEqual(info.sampling, ((2, 2), (1, 1), (1, 1)))
+        self.assertEqual(info.restart_interval, 0)
+        self.assertEqual(info.quality, 100)
+        # the sampling factors of the file, also those of a single component
+        with open(get_test_file(__file__, 'gradient-gray.jpg'), 'rb') as fobj:
+            jpegsrc = bytearray(fobj.read())
+        sof = jpegsrc.index(b'\xff\xc0')
+        jpegsrc[sof + 11] = 0x22
+        self.assertEqual(probe(io.BytesIO(jpegsrc)).sampling, ((2, 2),))
+
+    def test_exif_thumbnail(self):
+        with open(get_test_file(__file__, 'gradient-exif.jpg'), 'rb') as fobj:
+            jpegsrc = fobj.read()
+        # big endian TIFF data, orientation 6 and a 16x12 jpeg thumbnail
+        info = read_exif(io.BytesIO(jpegsrc), 64)
+        self.assertEqual(info.orientation, 6)
+        self.assertEqual(info.thumbnail[:2], b'\xff\xd8')
+        preview = decode_thumbnail(io.BytesIO(jpegsrc))
+        self.assertTrue(preview.embedded)
+        self.assertEqual((preview.width, preview.height, preview.orientation), (16, 12, 6))
+        self.assertEqual(preview.pixels, TonyJpegDecoder().decode(info.thumbnail))
+        image, orientation = thumbnail(io.BytesIO(jpegsrc), mode='L')
+        self.assertEqual((image.width, image.height, orientation), (16, 12, 6))
+        # the image itself without a thumbnail
+        with open(get_test_file(__file__, 'gradient-420.jpg'), 'rb') as fobj:
+            preview = decode_thumbnail(fobj, scale=4)
+        self.assertFalse(preview.embedded)
+        self.assertEqual((preview.width, preview.height, preview.orientation), (13, 10, 1))
+        # the exif data is skipped unless asked for
+        decoder = TonyJpegDecoder()
+        decoder.decode(jpegsrc)
+        self.assertEqual(decoder.exif, None)
+
+    def test_decode_stream_and_feed(self):
+        with open(get_test_file(__file__, 'black-white-100.jpg'), 'rb') as fobj:
+            jpegsrc = fobj.read()
+        expected = TonyJpegDecoder().decode(jpegsrc)
+        decoder = TonyJpegDecoder()
+        self.assertEqual(decoder.decode_stream(io.BytesIO(jpegsrc), 16), expected)
+        decoder = TonyJpegDecoder()
+        for start in range(0, len(jpegsrc), 10):
+            # the single tile is only decoded once the end of data is known
+            self.assertEqual(decoder.feed(jpegsrc[start:start + 10]), JPEG_SUSPENDED)
+        self.assertEqual(decoder.close(), expected)
+
+    def test_iter_bands(self):
+        with open(get_test_file(__file__, 'black-white-100.jpg'), 'rb') as fobj:
+            jpegsrc = fobj.read()
+        pixels = bytearray([0, 0, 0, 255, 255, 255, 255, 255, 255, 8, 8, 8])
+        self.assertEqual(list(TonyJpegDecoder().iter_bands(jpegsrc)), [(0, 2, pixels)])
+        self.assertEqual(TonyJpegDecoder().decode(jpegsrc), pixels)
+
+    @unittest.skipUnless(numpy_backend.available, "NumPy is not installed")
+    def test_numpy_backend_is_bit_exact(self):
+        for name in ('gradient-420.jpg', 'gradient-444.jpg'):
+            with open(get_test_file(__file__, name), 'rb') as fobj:
+                jpegsrc = fobj.read()
+            self.assertEqual(TonyJpegDecoder(use_numpy=True).decode(jpegsrc),
+                             TonyJpegDecoder(use_numpy=False).decode(jpegsrc))
+
+    def test_parallel_decode(self):
+        with open(get_test_file(__file__, 'gradient-420-restart.jpg'), 'rb') as fobj:
+            jpegsrc = fobj.read()
+        decoder = TonyJpegDecoder()
+        with ThreadPoolExecutor(2) as executor:
+            pixels = parallel.decode(decoder, jpegsrc, executor)
+        self.assertEqual(decoder.restart_interval, 2)
+        self.assertEqual(pixels, TonyJpegDecoder().decode(jpegsrc))
+
+    def test_parallel_decode_processes(self):
+        # the header and segments are pickled to the workers, the rectangles
+        # of pixels back
+        with open(get_test_file(__file__, 'gradient-420-restart.jpg'), 'rb') as fobj:
+            jpegsrc = fobj.read()
+        with ProcessPoolExecutor(2) as executor:
+            for mode in ('RGB', 'L'):
+                pixels = parallel.decode(TonyJpegDecoder(), jpegsrc, executor, mode=mode)
+                self.assertEqual(pixels, TonyJpegDecoder().decode(jpegsrc, mode=mode))
+
+    def test_decode_buffers(self):
+        for name in ('gradient-420-restart.jpg', 'gradient-420-progressive.jpg'):
+            with open(get_test_file(__file__, name), 'rb') as fobj:
+                jpegsrc = fobj.read()
+                expected = TonyJpegDecoder().decode(jpegsrc)
+                mapped = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    self.assertEqual(TonyJpegDecoder().decode(mapped), expected)
+                    with ThreadPoolExecutor(2) as executor:
+                        self.assertEqual(parallel.decode(TonyJpegDecoder(), mapped, executor),
+                                         expected)
+                finally:
+                    mapped.close()
+            for inbuf in (bytearray(jpegsrc), memoryview(jpegsrc), memoryview(bytearray(jpegsrc))):
+                self.assertEqual(TonyJpegDecoder().decode(inbuf), expected)
+        with open(get_test_file(__file__, name), 'rb') as fobj:
+            mapped = map_file(fobj)
+            self.assertTrue(isinstance(mapped, mmap.mmap))
+            mapped.close()
+        self.assertEqual(map_file(io.BytesIO(jpegsrc)), jpegsrc)
+
+    @unittest.skipIf(sys.version < '3', "buffers are copied on Python 2")
+    def test_decode_mmap_slice(self):
+        with open(get_test_file(__file__, 'gradient-420-restart.jpg'), 'rb') as fobj:
+            jpegsrc = fobj.read()
+        expected = TonyJpegDecoder().decode(jpegsrc)
+        # a jpeg at an offset in a mapping, decoded from a view of it in place
+        mapped = mmap.mmap(-1, len(jpegsrc) + 100)
+        mapped[37:37 + len(jpegsrc)] = jpegsrc
+        view = memoryview(mapped)[37:37 + len(jpegsrc)]
+        decoder = TonyJpegDecoder()
+        self.assertEqual(decoder.decode(view), expected)
+        self.assertTrue(decoder.Data.obj is mapped)
+        with ThreadPoolExecutor(2) as executor:
+            self.assertEqual(parallel.decode(TonyJpegDecoder(), view, executor), expected)
+
+    def test_decode_many(self):
+        names = ['gradient-420.jpg', 'gradient-gray.jpg', 'black-white.bmp', 'gradient-444.jpg']
+        paths = [get_test_file(__file__, name) for name in names]
+        with open(paths[0], 'rb') as fobj:
+            jpegsrc = fobj.read()
+        sources = paths + [memoryview(jpegsrc), b'\xff\xd8 broken']
+        with ThreadPoolExecutor(2) as executor:
+            results = sorted(decode_many(iter(sources), workers=1, executor=executor))
+        self.assertEqual([result.index for result in results], list(range(6)))
+        for result, path in zip(results[:2] + results[3:5], paths[:2] + paths[3:] + paths[:1]):
+            self.assertEqual(result.error, None)
+            with open(path, 'rb') as fobj:
+                self.assertEqual(result.pixels, TonyJpegDecoder().decode(fobj.read()))
+        self.assertFalse(is_path(results[4].source))
+        self.assertEqual((results[4].width, results[4].height), (50, 37))
+        for result in (results[2], results[5]):
+            self.assertEqual(result.pixels, None)
+            self.assertTrue(isinstance(result.error, ValueError))
+        # stopping early frees the shared memory of the images in flight
+        shm = os.path.isdir('/dev/shm') and set(os.listdir('/dev/shm'))
+        taken = []
+        def sources():
+            for path in paths * 2:
+                taken.append(path)
+                yield path
+        with ThreadPoolExecutor(2) as executor:
+            results = decode_many(sources(), workers=1, mode='L', executor=executor)
+            produced = []
+            for result in results:
+                produced.append(result)
+                break
+            results.close()
+        # the one image yielded, and the one more in flight for the worker
+        self.assertEqual(len(produced), 1)
+        self.assertEqual(len(taken), 2)
+        if shm is not False:
+            self.assertEqual(set(os.listdir('/dev/shm')), shm)
+
+    def test_decode_many_processes(self):
+        # on a real process pool: the sources and the errors are pickled, the
+        # pixels come back in shared memory that has to be freed
+        path = get_test_file(__file__, 'black-white-100.jpg')
+        with open(path, 'rb') as fobj:
+            jpegsrc = fobj.read()
+        expected = TonyJpegDecoder().decode(jpegsrc)
+        shm = os.path.isdir('/dev/shm') and set(os.listdir('/dev/shm'))
+        sources = [path, memoryview(jpegsrc), b'\xff\xd8 broken', path]
+        results = sorted(decode_many(sources, workers=2))
+        self.assertEqual([result.pixels for result in results], [expected, expected, None, expected])
+        self.assertTrue(isinstance(results[2].error, ValueError))
+        for result in decode_many([path] * 8, workers=2):
+            break
+        if shm is not False:
+            self.assertEqual(set(os.listdir('/dev/shm')), shm)
+
+    def test_entropy_index(self):
+        with open(get_test_file(__file__, 'gradient-420.jpg'), 'rb') as fobj:
+            jpegsrc = fobj.read()
+        index = build_index(io.BytesIO(jpegsrc), interval=2)
+        saved = io.BytesIO()
+        index.save(saved)
+        saved.seek(0)
+        index = EntropyIndex.load(saved)
+        self.assertEqual(len(index.checkpoints), 6)
+        bands = list(TonyJpegDecoder().iter_bands(jpegsrc))
+        self.assertEqual(list(TonyJpegDecoder().iter_bands(jpegsrc, 16, index)), bands[1:])
+        stream = TonyJpegDecoder().iter_bands_stream(io.BytesIO(jpegsrc), 100, 32, index)
+        self.assertEqual(list(stream), bands[2:])
+        region = (13, 33, 30, 10)
+        crop = TonyJpegDecoder().decode(jpegsrc, region=region)
+        self.assertEqual(TonyJpegDecoder().decode(jpegsrc, region=region, index=index), crop)
+        stream = io.BytesIO(jpegsrc)
+        self.assertEqual(TonyJpegDecoder().decode_stream(stream, 100, region=region, index=index), crop)
+        with open(get_test_file(__file__, 'gradient-420.jpg'), 'rb') as fobj:
+            img = JPG.decode(fobj, region=region, index=index)
+        self.assertEqual((img.width, img.height), (30, 4))
+        # another encoding of an image of the same size
+        with open(get_test_file(__file__, 'gradient-444.jpg'), 'rb') as fobj:
+            other = fobj.read()
+        self.assertEqual(probe(io.BytesIO(other))[:2], probe(io.BytesIO(jpegsrc))[:2])
+        with self.assertRaises(ValueError):
+            list(TonyJpegDecoder().iter_bands(other, 16, index))
+        with self.assertRaises(ValueError):
+            list(TonyJpegDecoder().iter_bands_stream(io.BytesIO(other), 100, 32, index))
+        with self.assertRaises(ValueError):
+            TonyJpegDecoder().decode(other, region=region, index=index)
+
+    def test_decode_region(self):
+        with open(get_test_file(__file__, 'gradient-420.jpg'), 'rb') as fobj:
+            jpegsrc = fobj.read()
+        pixels = TonyJpegDecoder().decode(jpegsrc)
+        decoder = TonyJpegDecoder()
+        crop = decoder.decode(jpegsrc, region=(13, 20, 30, 40))
+        self.assertEqual((decoder.out_width, decoder.out_height), (30, 17))
+        rows = [pixels[(20 + row) * 150 + 39:(20 + row) * 150 + 129] for row in range(17)]
+        self.assertEqual(crop, bytearray().join(rows))
+        with open(get_test_file(__file__, 'gradient-420.jpg'), 'rb') as fobj:
+            img = JPG.decode(fobj, region=(0, 0, 8, 4))
+        self.assertEqual((img.width, img.height), (8, 4))
+
+    def test_decode_scaled(self):
+        with open(get_test_file(__file__, 'gradient-444.jpg'), 'rb') as fobj:
+            jpegsrc = fobj.read()
+        decoder = TonyJpegDecoder()
+        thumbnail = decoder.decode(jpegsrc, scale=8)
+        self.assertEqual((decoder.ScaledWidth, decoder.ScaledHeight), (7, 5))
+        # the top row, as libjpeg decodes it at 1/8
+        self.assertEqual(thumbnail[:21], bytearray([
+            176, 19, 126, 234, 61, 141, 163, 101, 152, 51, 142, 125,
+            27, 182, 138, 121, 227, 153, 201, 252, 115]))
+        with open(get_test_file(__file__, 'gradient-444.jpg'), 'rb') as fobj:
+            img = JPG.decode(fobj, scale=2)
+        self.assertEqual((img.width, img.height), (25, 19))
+
+    def test_sampling_factors(self):
+        with open(get_test_file(__file__, 'gradient-444.jpg'), 'rb') as fobj:
+            expected = TonyJpegDecoder().decode(fobj.read())
+        # gradient-444.jpg saved again as 4:2:2 and as grayscale
+        with open(get_test_file(__file__, 'gradient-422.jpg'), 'rb') as fobj:
+            jpegsrc = fobj.read()
+        decoder = TonyJpegDecoder()
+        pixels = decoder.decode(jpegsrc)
+        self.assertEqual((decoder.McuWidth, decoder.McuHeight, decoder.BlocksInMcu), (16, 8, 4))
+        error = sum(abs(a - b) for a, b in zip(pixels, expected)) / float(len(pixels))
+        self.assertLess(error, 8)
+        self.assertEqual(TonyJpegDecoder(use_numpy=False).decode(jpegsrc), pixels)
+        with open(get_test_file(__file__, 'gradient-gray.jpg'), 'rb') as fobj:
+            jpegsrc = fobj.read()
+        decoder = TonyJpegDecoder()
+        pixels = decoder.decode(jpegsrc)
+        self.assertEqual((decoder.McuWidth, decoder.McuHeight, decoder.BlocksInMcu), (8, 8, 1))
+        self.assertEqual(pixels[0::3], pixels[1::3])
+        self.assertEqual(pixels[0::3], pixels[2::3])
+        luma = [(299 * r + 587 * g + 114 * b + 500) // 1000
+                for r, g, b in zip(expected[0::3], expected[1::3], expected[2::3])]
+        error = sum(abs(a - b) for a, b in zip(pixels[0::3], luma)) / float(len(luma))
+        self.assertLess(error, 2)
+        self.assertEqual(TonyJpegDecoder(use_numpy=False).decode(jpegsrc), pixels)
+
+    def test_luma_mode(self):
+        with open(get_test_file(__file__, 'gradient-gray.jpg'), 'rb') as fobj:
+            jpegsrc = fobj.read()
+        self.assertEqual(TonyJpegDecoder().decode(jpegsrc, mode='L'),
+                         TonyJpegDecoder().decode(jpegsrc)[0::3])
+        for name in ('gradient-420.jpg', 'gradient-444.jpg'):
+            with open(get_test_file(__file__, name), 'rb') as fobj:
+                jpegsrc = fobj.read()
+            expected = TonyJpegDecoder().decode(jpegsrc)
+            luma = [(299 * r + 587 * g + 114 * b + 500) // 1000
+                    for r, g, b in zip(expected[0::3], expected[1::3], expected[2::3])]
+            pixels = TonyJpegDecoder().decode(jpegsrc, mode='L')
+            error = sum(abs(a - b) for a, b in zip(pixels, luma)) / float(len(luma))
+            self.assertLess(error, 1)
+            self.assertEqual(TonyJpegDecoder(use_numpy=False).decode(jpegsrc, mode='L'), pixels)
+        with open(get_test_file(__file__, 'gradient-420.jpg'), 'rb') as fobj:
+            img = JPG.decode(fobj, region=(0, 0, 8, 4), mode='L')
+        self.assertEqual((img.width, img.height, img.pixels.pixelsize), (8, 4, 1))
+
+    def test_output_modes(self):
+        with open(get_test_file(__file__, 'gradient-420.jpg'), 'rb') as fobj:
+            jpegsrc = fobj.read()
+        rgb = TonyJpegDecoder().decode(jpegsrc)
+        bgr = TonyJpegDecoder().decode(jpegsrc, mode='BGR')
+        self.assertEqual((bgr[0::3], bgr[1::3], bgr[2::3]), (rgb[2::3], rgb[1::3], rgb[0::3]))
+        rgba = TonyJpegDecoder().decode(jpegsrc, mode='RGBA')
+        self.assertEqual((rgba[0::4], rgba[1::4], rgba[2::4]), (rgb[0::3], rgb[1::3], rgb[2::3]))
+        self.assertEqual(rgba[3::4], bytearray(b'\xff') * (len(rgb) // 3))
+        decoder = TonyJpegDecoder()
+        planes = decoder.decode(jpegsrc, mode='YCbCr')
+        self.assertEqual(decoder.plane_sizes, [(50, 37), (25, 19), (25, 19)])
+        self.assertEqual([len(plane) for plane in planes], [50 * 37, 25 * 19, 25 * 19])
+        self.assertEqual(planes[0], TonyJpegDecoder().decode(jpegsrc, mode='L'))
+        self.assertEqual(TonyJpegDecoder(use_numpy=False).decode(jpegsrc, mode='YCbCr'), planes)
+        self.assertRaises(ValueError, TonyJpegDecoder().decode, jpegsrc, (0, 0, 8, 8), mode='YCbCr')
+        with open(get_test_file(__file__, 'gradient-420.jpg'), 'rb') as fobj:
+            img = JPG.decode(fobj, mode='RGBA')
+        self.assertEqual(img.pixels.pixelsize, 4)
+
+    def test_read_coefficients(self):
+        with open(get_test_file(__file__, 'gradient-420-sequential.jpg'), 'rb') as fobj:
+            sequential = read_coefficients(fobj, 100)
+        self.assertEqual((sequential.width, sequential.height, sequential.progressive), (50, 37, False))
+        self.assertEqual([(comp.width_in_blocks, comp.height_in_blocks) for comp in sequential.components],
+                         [(8, 6), (4, 3), (4, 3)])
+        # the same coefficients, in a progressive image
+        with open(get_test_file(__file__, 'gradient-420-progressive.jpg'), 'rb') as fobj:
+            progressive = read_coefficients(fobj)
+        self.assertTrue(progressive.progressive)
+        self.assertEqual(progressive.components, sequential.components)
+        with open(get_test_file(__file__, 'gradient-gray.jpg'), 'rb') as fobj:
+            jpegsrc = fobj.read()
+        gray = read_coefficients(io.BytesIO(jpegsrc)).components[0]
+        self.assertEqual(len(gray.coefficients), 7 * 5 * 64)
+        # the dc coefficient is 8 times the mean of the samples of a block - 128
+        pixels = TonyJpegDecoder().decode(jpegsrc, mode='L')
+        mean = sum(pixels[row * 50 + col] for row in range(8) for col in range(8)) / 64.0
+        self.assertAlmostEqual(gray.coefficients[0] * gray.quant_table[0] / 8.0 + 128, mean, delta=1)
+
+    def test_lossless_transform(self):
+        with open(get_test_file(__file__, 'gradient-422.jpg'), 'rb') as fobj:
+            jpegsrc = fobj.read()
+        source = read_coefficients(io.BytesIO(jpegsrc))
+        # no transform, the same coefficients in a new file
+        self.assertEqual(read_coefficients(io.BytesIO(transform(io.BytesIO(jpegsrc)))), source)
+        # the 16x8 MCUs become 8x16, the bottom rows that are not a whole MCU
+        # would end up at the left edge and are dropped
+        rotated = transform(io.BytesIO(jpegsrc), 'rotate-90', optimize=True)
+        coefficients = read_coefficients(io.BytesIO(rotated))
+        self.assertEqual((coefficients.width, coefficients.height), (32, 50))
+        self.assertEqual([(comp.h_samp_factor, comp.v_samp_factor) for comp in coefficients.components],
+                         [(1, 2), (1, 1), (1, 1)])
+        # the top left of the rotated image is the bottom left of the 32 rows kept
+        pixels = TonyJpegDecoder().decode(rotated)
+        original = TonyJpegDecoder().decode(jpegsrc)
+        for channel in range(3):
+            self.assertAlmostEqual(pixels[channel], original[31 * 50 * 3 + channel], delta=3)
+        # rotating back gives the coefficients of the 32 rows kept
+        back = read_coefficients(io.BytesIO(transform(io.BytesIO(rotated), 'rotate-270')))
+        self.assertEqual((back.width, back.height), (50, 32))
+        self.assertEqual(back.components[0].coefficients, source.components[0].coefficients[:8 * 4 * 64])
+        cropped = read_coefficients(io.BytesIO(transform(io.BytesIO(jpegsrc), crop=(16, 8, 20, 20))))
+        self.assertEqual((cropped.width, cropped.height), (20, 20))
+        self.assertEqual(cropped.components[0].coefficients[:64], source.components[0].coefficients[
+            (8 + 2) * 64:(8 + 3) * 64])
+        self.assertRaises(ValueError, transform, io.BytesIO(jpegsrc), crop=(4, 0, 8, 8))
+        self.assertRaises(ValueError, transform, io.BytesIO(jpegsrc), 'rotate-45')
+
+    def test_benchmark(self):
+        results = benchmark.run(['tiny'], repeat=1, memory=False)
+        self.assertEqual(len(results), 16)
+        self.assertEqual([result.name for result in results[:2]], ['tiny-q75-420', 'tiny-q75-420-encode'])
+        for result in results:
+            self.assertTrue(result.mpps > 0)
+        for result in results[::2]:
+            self.assertEqual(sorted(result.stages),
+                             ['color', 'entropy', 'headers', 'idct', 'output'])
+            self.assertTrue(result.stages['entropy'] > 0)
+        self.assertEqual([result.stages for result in results[1::2]], [{}] * 8)
+        # twice as slow as a baseline is a regression, as fast is not
+        baseline = dict((result.name, result._replace(seconds=result.seconds / 2)) for result in results)
+        ratios, regressions = benchmark.compare(results, baseline)
+        self.assertEqual(regressions, [result.name for result in results])
+        baseline = dict((result.name, result) for result in results[:2])
+        self.assertEqual(benchmark.compare(results, baseline), ([(results[0].name, 1.0), (results[1].name, 1.0)], []))
+
+    def test_decode_stats(self):
+        with open(get_test_file(__file__, 'gradient-420-restart.jpg'), 'rb') as fobj:
+            jpegsrc = fobj.read()
+        expected = TonyJpegDecoder(use_numpy=False).decode(jpegsrc)
+        decoder = TonyJpegDecoder(use_numpy=False)
+        self.assertEqual(decoder.stats, None)
+        seen = []
+        decoder.enable_stats(seen.append)
+        self.assertEqual(decoder.decode(jpegsrc), expected)
+        stats = decoder.stats
+        self.assertEqual(seen, [stats])
+        # 4*3 MCUs of 6 blocks, restart markers between MCU rows
+        self.assertEqual((stats.mcus, stats.restart_markers), (12, 5))
+        self.assertEqual(stats.idct_dc_columns + stats.idct_full_columns, 12 * 6 * 8)
+        self.assertEqual(stats.idct_dc_rows + stats.idct_full_rows, 12 * 6 * 8)
+        self.assertTrue(stats.huffman_lookahead > stats.huffman_long > 0)
+        scan = jpegsrc[jpegsrc.index(b'\xff\xda'):]
+        self.assertEqual(stats.bytes_unstuffed, scan.count(b'\xff\x00'))
+        self.assertTrue(stats.times['total'] >= stats.times['entropy'] > 0)
+        self.assertEqual(stats.as_dict()['mcus'], 12)
+        # a new DecodeStats for each image
+        decoder.decode(jpegsrc)
+        self.assertEqual(len(seen), 2)
+        self.assertFalse(seen[1] is stats)
+        self.assertEqual(seen[1].mcus, 12)
+        # enabling them again only replaces the hook
+        again = []
+        decoder.enable_stats(again.append)
+        decoder.decode(jpegsrc)
+        self.assertEqual((len(seen), len(again)), (2, 1))
+        self.assertEqual(again[0].as_dict()['mcus'], 12)
+        self.assertEqual((again[0].huffman_lookahead, again[0].huffman_long),
+                         (stats.huffman_lookahead, stats.huffman_long))
+
+    def test_huffman_long_codes(self):
+        # a code of each length from 1 to 15 bits, and two of 16 bits
+        htbl = HuffTable()
+        htbl.bits = [0] + [1] * 15 + [2]
+        htbl.huffval = [(run << 4) | 1 for run in range(16)] + [0xF0]
+        htbl.compute()
+        codes = ['1' * length + '0' for length in range(16)] + ['1' * 16]
+        # each code is followed by its one value bit, 1 for +1, 0 for -1
+        bitstring = ''.join(code + str(i % 2) for i, code in enumerate(codes[:16]))
+        bitstring += codes[16] + '1' * (-(len(bitstring) + 16) % 8)
+        data = bytearray()
+        for i in range(0, len(bitstring), 8):
+            data.append(int(bitstring[i:i + 8], 2))
+            if data[-1] == 0xFF:
+                data.append(0)
+        decoder = TonyJpegDecoder()
+        decoder.set_buffer(bytes(data))
+        decoder.DataBytesLeft = len(data)
+        for run in range(16):
+            self.assertEqual(decoder.decode_huffman(htbl), (run, 1 if run % 2 else -1))
+        self.assertEqual(decoder.decode_huffman(htbl), (15, 0))
+
+    def test_table_cache(self):
+        with open(get_test_file(__file__, 'gradient-420.jpg'), 'rb') as fobj:
+            jpegsrc = fobj.read()
+        tables.clear_caches()
+        pixels = TonyJpegDecoder().decode(jpegsrc)
+        info = tables.cache_info()
+        self.assertEqual((info['huffman'].hits, info['huffman'].misses), (0, 4))
+        self.assertEqual((info['quant'].hits, info['quant'].misses), (0, 2))
+        self.assertEqual(TonyJpegDecoder().decode(jpegsrc), pixels)
+        info = tables.cache_info()
+        self.assertEqual((info['huffman'].hits, info['huffman'].misses), (4, 4))
+        self.assertEqual((info['quant'].hits, info['quant'].misses), (2, 2))
+        cache = tables.TableCache(maxsize=2)
+        for key in (b'a', b'b', b'a', b'c'):
+            cache.get(key, bytearray)
+        self.assertEqual(list(cache.tables), [b'a', b'c'])
+
+    def test_reuse_decoder(self):
+        sources = []
+        for name in ('gradient-420.jpg', 'gradient-420-restart.jpg', 'gradient-444.jpg'):
+            with open(get_test_file(__file__, name), 'rb') as fobj:
+                sources.append(fobj.read())
+        decoder = TonyJpegDecoder()
+        self.assertEqual(decoder.decode(sources[0]), TonyJpegDecoder().decode(sources[0]))
+        self.assertEqual(decoder.decode(sources[1]), TonyJpegDecoder().decode(sources[1]))
+        # both 4:2:0, the buffers of the first image are used for the second
+        self.assertEqual(decoder.buffer_allocations, 1)
+        self.assertEqual(decoder.decode(sources[2]), TonyJpegDecoder().decode(sources[2]))
+        self.assertEqual(decoder.buffer_allocations, 2)
+        pool = DecoderPool(size=1)
+        with pool.decoder() as first:
+            first.decode(sources[0])
+        with pool.decoder() as second:
+            self.assertIs(second, first)
+            self.assertEqual(second.decode(sources[1]), decoder.decode(sources[1]))
+
+    def test_encode(self):
+        img = Image.open_from_path(get_test_file(__file__, 'gradient-444.jpg'))
+        pixels = img.pixels.data
+        sizes = []
+        # the colors change from pixel to pixel, 4:2:0 loses a lot of them
+        for quality, subsampling, tolerance in ((95, '4:4:4', 3), (75, '4:2:0', 25)):
+            fobj = io.BytesIO()
+            JPG.encode(img, fobj, quality, subsampling)
+            sizes.append(len(fobj.getvalue()))
+            fobj.seek(0)
+            decoded = JPG.decode(fobj)
+            self.assertEqual((decoded.width, decoded.height), (img.width, img.height))
+            error = sum(abs(a - b) for a, b in zip(decoded.pixels.data, pixels))
+            self.assertLess(error / float(len(pixels)), tolerance)
+        self.assertLess(sizes[1], sizes[0])
+        self.assertRaises(ValueError, JPG.encode, img, io.BytesIO(), 0)
+
+    def test_parallel_encode(self):
+        img = Image.open_from_path(get_test_file(__file__, 'gradient-444.jpg'))
+        pixels = img.pixels.data
+        plain = TonyJpegEncoder(subsampling='4:4:4').encode(pixels, img.width, img.height)
+        for optimize in (False, True):
+            encoder = TonyJpegEncoder(subsampling='4:4:4', restart_rows=2, optimize=optimize)
+            with ThreadPoolExecutor(2) as executor:
+                jpegsrc = parallel.encode(encoder, pixels, img.width, img.height, executor=executor)
+            self.assertEqual(jpegsrc, TonyJpegEncoder(
+                subsampling='4:4:4', restart_rows=2, optimize=optimize).encode(pixels, img.width, img.height))
+            decoder = TonyJpegDecoder()
+            self.assertEqual(decoder.decode(jpegsrc), TonyJpegDecoder().decode(plain))
+            self.assertEqual(decoder.restart_interval, 2 * 7)
+        self.assertLess(len(jpegsrc), len(plain))
+
+    def test_parallel_encode_processes(self):
+        # the encoder and the pixels of the strips are pickled to the workers,
+        # the coded strips and symbol counts back
+        img = Image.open_from_path(get_test_file(__file__, 'gradient-444.jpg'))
+        pixels = img.pixels.data
+        with ProcessPoolExecutor(2) as executor:
+            for optimize in (False, True):
+                encoder = TonyJpegEncoder(restart_rows=2, optimize=optimize)
+                jpegsrc = parallel.encode(encoder, pixels, img.width, img.height, executor=executor)
+                self.assertEqual(jpegsrc, TonyJpegEncoder(restart_rows=2, optimize=optimize).encode(
+                    pixels, img.width, img.height))
+
+    def test_progressive(self):
+        with open(get_test_file(__file__, 'gradient-420-progressive.jpg'), 'rb') as fobj:
+            jpegsrc = fobj.read()
+        # the same coefficients in one sequential scan
+        with open(get_test_file(__file__, 'gradient-420-sequential.jpg'), 'rb') as fobj:
+            pixels = TonyJpegDecoder().decode(fobj.read())
+        decoder = TonyJpegDecoder()
+        self.assertEqual(decoder.decode(jpegsrc), pixels)
+        self.assertEqual(decoder.scans_completed, 10)
+        # the DRI of the last scan, with a block per MCU
+        self.assertEqual(decoder.restart_interval, 7)
+        self.assertEqual(decoder.decode_stream(io.BytesIO(jpegsrc), 64), pixels)
+        # previews from the first scans get closer to the image
+        errors = []
+        for scans in (1, 3, 6):
+            preview = decoder.decode(jpegsrc, scans=scans)
+            self.assertEqual(len(preview), len(pixels))
+            errors.append(sum(abs(a - b) for a, b in zip(preview, pixels)))
+        self.assertEqual(errors, sorted(errors, reverse=True))
+        decoder.reset()
+        for pos in range(0, len(jpegsrc) - 128, 128):
+            self.assertEqual(decoder.feed(jpegsrc[pos:pos + 128]), JPEG_SUSPENDED)
+            if decoder.scans_completed == 1:
+                self.assertEqual(len(decoder.render()), len(pixels))
+        decoder.feed(jpegsrc[pos + 128:])
+        self.assertEqual(decoder.close(), pixels)
+        # split inside a scan after a large marker segment, which is read
+        # from the data fed before the scan
+        second = jpegsrc.index(b'\xff\xda', jpegsrc.index(b'\xff\xda') + 2)
+        comment = b'\xff\xfe\x17\x72' + b'x' * 6000
+        jpegsrc = jpegsrc[:second] + comment + jpegsrc[second:]
+        split = second + len(comment) + 20
+        decoder = TonyJpegDecoder()
+        decoder.feed(jpegsrc[:split])
+        decoder.feed(jpegsrc[split:])
+        self.assertEqual(decoder.close(), pixels)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2012, Jonas Obrist
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the Jonas Obrist nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL JONAS OBRIST BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Lossless transforms of a jpeg in the DCT domain, like the IJG jpegtran:
+rotation by 90, 180 or 270 degrees, flips, transposition and cropping on MCU
+boundaries.
+
+The quantized coefficients of the blocks are moved and some of them change
+sign, a flip of the samples negates the coefficients of odd frequency in its
+direction, and the result is entropy coded again; there is no inverse or
+forward DCT, so the image does not lose anything.
+
+A flip moves the partial MCUs at the right or bottom edge of the image to the
+left or top, where they cannot be, so like jpegtran -trim those are dropped:
+the image loses up to an MCU less one pixel in the direction of the flip.
+"""
+from pymaging_jpg.coefficients import (ComponentCoefficients, JpegCoefficients,
+    read_coefficients, write_coefficients)
+from pymaging_jpg.raw import CHUNK_SIZE
+from array import array
+
+# the transforms as a transposition, then horizontal and vertical flips
+TRANSFORMS = {
+    None: (False, False, False),
+    'flip-horizontal': (False, True, False),
+    'flip-vertical': (False, False, True),
+    'transpose': (True, False, False),
+    'transverse': (True, True, True),
+    'rotate-90': (True, True, False),
+    'rotate-180': (False, True, True),
+    'rotate-270': (True, False, True),
+}
+
+
+def block_permutation(transpose, flip_h, flip_v):
+    """the (index, sign) in the block of the source of each coefficient of a
+    transformed block, in natural order"""
+    permutation = []
+    for v in range(8):
+        for u in range(8):
+            # negated if the frequency is odd in one flipped direction
+            odd = (flip_h and u & 1) + (flip_v and v & 1)
+            sign = -1 if odd == 1 else 1
+            permutation.append((u * 8 + v if transpose else v * 8 + u, sign))
+    return permutation
+
+
+def transform_coefficients(coefficients, operation=None, crop=None):
+    """the JpegCoefficients of the image transformed by operation, one of
+    TRANSFORMS, then cropped to crop, a (left, top, width, height) box in the
+    transformed image whose left and top are on MCU boundaries"""
+    if operation not in TRANSFORMS:
+        raise ValueError("Unsupported transform: %r" % (operation,))
+    transpose, flip_h, flip_v = TRANSFORMS[operation]
+    components = coefficients.components
+    if len(components) == 1:
+        # one block per MCU, see write_coefficients
+        components = [components[0]._replace(h_samp_factor=1, v_samp_factor=1)]
+    hmax = max(comp.h_samp_factor for comp in components)
+    vmax = max(comp.v_samp_factor for comp in components)
+    # the size and MCU size of the transposed image
+    width, height = coefficients.width, coefficients.height
+    McuWidth, McuHeight = 8 * hmax, 8 * vmax
+    if transpose:
+        width, height = height, width
+        McuWidth, McuHeight = McuHeight, McuWidth
+    # drop the partial MCUs that a flip would move to the other edge
+    if flip_h:
+        width -= width % McuWidth
+    if flip_v:
+        height -= height % McuHeight
+    if not width or not height:
+        raise ValueError("Image smaller than an MCU, it cannot be flipped: %dx%d"
+                         % (coefficients.width, coefficients.height))
+    if crop is None:
+        crop = (0, 0, width, height)
+    left, top, crop_width, crop_height = crop
+    if left % McuWidth or top % McuHeight:
+        raise ValueError("Crop is not on MCU boundaries of %dx%d: %r" % (McuWidth, McuHeight, crop))
+    if not (0 <= left < left + crop_width <= width and 0 <= top < top + crop_height <= height):
+        raise ValueError("Crop outside of the %dx%d image: %r" % (width, height, crop))
+    permutation = block_permutation(transpose, flip_h, flip_v)
+    cxMcu = (crop_width + McuWidth - 1) // McuWidth
+    cyMcu = (crop_height + McuHeight - 1) // McuHeight
+    result = []
+    for comp in components:
+        h, v = comp.h_samp_factor, comp.v_samp_factor
+        source_width = comp.width_in_blocks
+        source = comp.coefficients
+        if transpose:
+            h, v = v, h
+        # the last block of the flipped rows and columns
+        last_x = width // McuWidth * h - 1
+        last_y = height // McuHeight * v - 1
+        x0 = left // McuWidth * h
+        y0 = top // McuHeight * v
+        blocks_wide, blocks_high = cxMcu * h, cyMcu * v
+        blocks = array('h', [0]) * (blocks_wide * blocks_high * 64)
+        pos = 0
+        for y in range(y0, y0 + blocks_high):
+            sy = last_y - y if flip_v else y
+            for x in range(x0, x0 + blocks_wide):
+                sx = last_x - x if flip_h else x
+                # the block at column sx and row sy of the transposed image
+                if transpose:
+                    first = (sx * source_width + sy) * 64
+                else:
+                    first = (sy * source_width + sx) * 64
+                blocks[pos:pos + 64] = array('h', [source[first + i] * sign for i, sign in permutation])
+                pos += 64
+        quant_table = [comp.quant_table[i] for i, sign in permutation]
+        result.append(ComponentCoefficients(comp.component_id, h, v, blocks_wide, blocks_high,
+                                            quant_table, blocks))
+    return JpegCoefficients(crop_width, crop_height, False, result)
+
+
+def transform(fileobj, operation=None, crop=None, optimize=False, chunk_size=CHUNK_SIZE):
+    """the jpeg in fileobj, transformed by operation and cropped to crop
+    without decoding it to pixels, see transform_coefficients, as a baseline
+    JFIF stream; the markers of the source, EXIF among them, are not copied"""
+    coefficients = read_coefficients(fileobj, chunk_size)
+    return write_coefficients(transform_coefficients(coefficients, operation, crop), optimize)
@@ -7,6 +7,7 @@ setup(
     version = __version__,
     packages = ['pymaging_jpg'],
     install_requires = ['pymaging'],
+    extras_require = {'numpy': ['numpy']},
     entry_points = {'pymaging.formats': ['jpg = pymaging_jpg.jpg:JPG']},
     author = "Jonas Obrist",
     author_email = "ojiidotch@gmail.com",